@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+    Host-side memory access microbenchmark: normal 4K pages vs huge pages.
+
+    Maps an anonymous buffer once with regular pages and once with MAP_HUGETLB, then measures
+    - page-stride sweep: touches one byte per 4K page, i.e. one TLB lookup per access
+    - random pages: reads one byte from randomly chosen 4K pages (defeats the prefetcher)
+
+    Usage:
+        python benchmarks/hugepages.py [--size 1G] [--page-size 2M] [--rounds 5] [--json]
+
+    The host needs enough free huge pages, e.g. `echo 512 | sudo tee /proc/sys/vm/nr_hugepages` for 1G of 2M pages.
+"""
+
+import argparse
+import json
+import mmap
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from vmvm.utils import parse_size
+
+MAP_HUGETLB = getattr(mmap, 'MAP_HUGETLB', 0x40000)
+MAP_HUGE_SHIFT = 26
+SMALL_PAGE = 4096
+
+
+def map_buffer(size: int, huge_page_size: int | None) -> mmap.mmap:
+    flags = mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS
+    if huge_page_size is not None:
+        flags |= MAP_HUGETLB | ((huge_page_size.bit_length() - 1) << MAP_HUGE_SHIFT)
+    buf = mmap.mmap(-1, size, flags=flags, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+    # fault everything in so that page faults are not part of the measurement
+    buf.write(b'\1' * size)
+    return buf
+
+
+def bench_sweep(buf: mmap.mmap, rounds: int) -> float:
+    mv = memoryview(buf)
+    best = float('inf')
+    for _ in range(rounds):
+        t = time.perf_counter()
+        bytes(mv[::SMALL_PAGE])
+        best = min(best, time.perf_counter() - t)
+    mv.release()
+    return best
+
+
+def bench_random(buf: mmap.mmap, rounds: int, accesses: int) -> float:
+    offsets = [ random.randrange(len(buf) // SMALL_PAGE) * SMALL_PAGE for _ in range(accesses) ]
+    best = float('inf')
+    for _ in range(rounds):
+        t = time.perf_counter()
+        for off in offsets:
+            buf[off]
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def run(size: int, huge_page_size: int | None, rounds: int, accesses: int) -> dict:
+    buf = map_buffer(size, huge_page_size)
+    try:
+        pages = size // SMALL_PAGE
+        sweep = bench_sweep(buf, rounds)
+        rand = bench_random(buf, rounds, accesses)
+        return {
+            'sweep_ns_per_page': sweep / pages * 1e9,
+            'random_ns_per_access': rand / accesses * 1e9,
+        }
+    finally:
+        buf.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare memory access cost with normal and huge pages')
+    parser.add_argument('--size', default='1G')
+    parser.add_argument('--page-size', default='2M')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--accesses', type=int, default=1_000_000)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+    huge_page_size = parse_size(args.page_size)
+    if size % huge_page_size:
+        parser.error('--size must be a multiple of --page-size')
+
+    results = { 'size': size, 'huge_page_size': huge_page_size }
+    results['normal'] = run(size, None, args.rounds, args.accesses)
+    try:
+        results['hugepages'] = run(size, huge_page_size, args.rounds, args.accesses)
+    except OSError as e:
+        print(f'cannot map {args.size} with {args.page_size} pages: {e}', file=sys.stderr)
+        results['hugepages'] = None
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    print(f'buffer {args.size}, best of {args.rounds} rounds')
+    print(f'{"mode":<12}{"sweep ns/page":>16}{"random ns/access":>20}')
+    for mode in ('normal', 'hugepages'):
+        r = results[mode]
+        if r is None:
+            print(f'{mode:<12}{"n/a":>16}{"n/a":>20}')
+        else:
+            print(f'{mode:<12}{r["sweep_ns_per_page"]:>16.2f}{r["random_ns_per_access"]:>20.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+    Host-side qcow2 metadata cache benchmark with `qemu-img bench`: QEMU default L2 cache vs
+    the l2-cache-size vmvm computes for the image (whole image mapped).
+
+    A qcow2 image with preallocated metadata is created and read with a step larger than the range one L2 table
+    maps (cluster_size / 8 clusters), so every request needs a different L2 table. Once the tables in use
+    exceed the default cache every request re-reads an L2 table from the image.
+
+    Usage:
+        python benchmarks/qcow2_l2cache.py [--size 256G] [--cluster-size 64K] [--count 200000] [--dir /var/tmp] [--json]
+
+    Needs `qemu-img` and free space for the image metadata (~size / 8192 with 64K clusters).
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from vmvm.qcow2 import read_qcow2_info, l2_cache_size
+from vmvm.utils import parse_size
+
+
+def bench(image: str, count: int, step: int, extra_opts: str) -> float:
+    """ seconds reported by qemu-img bench (wall time if it is not printed) """
+    args = [ 'qemu-img', 'bench', '--image-opts', '-c', str(count), '-d', '1', '-s', '4K', '-S', str(step),
+             f'driver=qcow2,file.filename={image}{extra_opts}' ]
+    t = time.perf_counter()
+    out = subprocess.run(args, check=True, capture_output=True, text=True).stdout
+    elapsed = time.perf_counter() - t
+    m = re.search(r'Run completed in ([0-9.]+) seconds', out)
+    return float(m.group(1)) if m else elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='qcow2 L2 cache size benchmark')
+    parser.add_argument('--size', default='256G', help='virtual image size')
+    parser.add_argument('--cluster-size', default='64K')
+    parser.add_argument('--count', type=int, default=200000, help='requests per run')
+    parser.add_argument('--dir', default=None, help='directory for the scratch image (default: system temp dir)')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    size = parse_size(args.size, default_suffix='B')
+    cluster_size = parse_size(args.cluster_size, default_suffix='B')
+    # one L2 table maps cluster_size / 8 clusters; step past it (plus one cluster so that offsets do not repeat early)
+    step = cluster_size // 8 * cluster_size + cluster_size
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        image = os.path.join(tmp, 'bench.qcow2')
+        subprocess.run([ 'qemu-img', 'create', '-q', '-f', 'qcow2', '-o', f'cluster_size={cluster_size},preallocation=metadata',
+                         image, str(size) ], check=True)
+        full = l2_cache_size(read_qcow2_info(image))
+        results = {
+            'default': { 'l2_cache_size': None, 'seconds': bench(image, args.count, step, '') },
+            'vmvm':    { 'l2_cache_size': full, 'seconds': bench(image, args.count, step, f',l2-cache-size={full}') },
+        }
+
+    for r in results.values():
+        r['requests_per_second'] = args.count / r['seconds']
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print(f'{"l2 cache":<10}{"size":>12}{"seconds":>10}{"req/s":>12}')
+        for name, r in results.items():
+            cache = f'{r["l2_cache_size"] >> 10}K' if r['l2_cache_size'] else 'default'
+            print(f'{name:<10}{cache:>12}{r["seconds"]:>10.3f}{r["requests_per_second"]:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
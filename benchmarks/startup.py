@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+    Startup latency benchmarks for the vmvm CLI and the argument builder.
+
+    - import:      cold `import vmvm.main` in a fresh interpreter (interpreter startup subtracted)
+    - parse_config: parse_config() for every entry of prototypes.prototype_config
+    - common_args / cdrom_args: CmdBuilder with large disk and ISO lists (edk2 directory is injected)
+    - spawn:       `vmvm run` until the QEMU process is spawned, with a stub qemu-system binary,
+                   with and without the compiled config cache
+
+    Usage:
+        python benchmarks/startup.py [--rounds N] [--json] [--save-baseline FILE] [--compare FILE [--tolerance 0.25]]
+
+    --compare exits with code 1 if the median of any benchmark is slower than the baseline by more than the tolerance.
+    Baselines are host specific, generate one on the machine where the comparison runs.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from vmvm.builder import CmdBuilder, RuntimeOptions
+from vmvm.config_parser import parse_config
+from vmvm.prototypes import prototype_config
+
+NUM_DISKS = 64
+NUM_ISOS = 32
+
+STUB_QEMU = '''#!{python}
+import sys, time
+with open({stamp!r}, 'w') as f:
+    f.write(str(time.time_ns()))
+'''
+
+
+def measure(fn, rounds: int) -> list[float]:
+    """ wall time of each call in seconds """
+    samples = []
+    for _ in range(rounds):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return samples
+
+
+def summarize(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    return {
+        'rounds': len(samples),
+        'min_ms': samples[0] * 1e3,
+        'median_ms': statistics.median(samples) * 1e3,
+        'p90_ms': samples[min(len(samples) - 1, int(len(samples) * 0.9))] * 1e3,
+    }
+
+
+def bench_import(rounds: int) -> list[float]:
+    env = dict(os.environ, PYTHONPATH=str(REPO_DIR))
+    run = lambda code: subprocess.run([sys.executable, '-c', code], env=env, check=True)
+    base = statistics.median(measure(lambda: run('pass'), rounds))
+    return [ max(0.0, s - base) for s in measure(lambda: run('import vmvm.main'), rounds) ]
+
+
+def bench_parse_config(rounds: int) -> list[float]:
+    def parse_all():
+        for name in prototype_config:
+            parse_config(dict(name='bench', prototype=name))
+    return measure(parse_all, rounds)
+
+
+def make_builder_options():
+    o = parse_config(dict(name='bench', prototype='w11', disk_virtio='scsi', need_cd=True,
+                          disks=[ f'disk{i}.qcow2' for i in range(NUM_DISKS) ],
+                          os_install=[ f'cd{i}.iso' for i in range(NUM_ISOS) ]))
+    edk2_files = [ 'OVMF_CODE.4m.fd', 'OVMF_CODE.secboot.4m.fd', 'OVMF_VARS.4m.fd' ]
+    builder = CmdBuilder(listdir_fn=lambda _: edk2_files, pathexists_fn=lambda _: True)
+    ro = RuntimeOptions(spice_port=5900, tpm_socket='/tmp/bench-tpm.sock', has_cpu_topoext=True)
+    return o, builder, ro
+
+
+def bench_common_args(rounds: int) -> list[float]:
+    o, builder, ro = make_builder_options()
+    return measure(lambda: builder.common_args(o, ro), rounds)
+
+
+def bench_cdrom_args(rounds: int) -> list[float]:
+    o, builder, _ = make_builder_options()
+    return measure(lambda: builder.cdrom_args(o, mount=True), rounds)
+
+
+def bench_spawn(rounds: int, use_cache: bool) -> list[float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        bin_dir = tmp / 'bin'
+        vm_dir = tmp / 'vm'
+        bin_dir.mkdir()
+        vm_dir.mkdir()
+        stamp = tmp / 'spawned'
+        stub = bin_dir / 'qemu-system-x86_64'
+        stub.write_text(STUB_QEMU.format(python=sys.executable, stamp=str(stamp)))
+        stub.chmod(0o755)
+        (vm_dir / 'vmconfig.yml').write_text('name: bench-spawn\narch: x86_64\ncpus: 2\ndisk: system.qcow2\nspice: none\n')
+
+        env = dict(os.environ, PYTHONPATH=str(REPO_DIR), PATH=f'{bin_dir}:{os.environ["PATH"]}')
+        cmd = [sys.executable, '-m', 'vmvm.main', 'run', str(vm_dir)] + ([] if use_cache else ['--no-cache'])
+        if use_cache:
+            subprocess.run(cmd, env=env, check=True, capture_output=True)   # warm up the cache
+        samples = []
+        for _ in range(rounds):
+            t = time.time_ns()
+            subprocess.run(cmd, env=env, check=True, capture_output=True)
+            samples.append((int(stamp.read_text()) - t) / 1e9)
+        return samples
+
+
+BENCHMARKS = {
+    'import':             bench_import,
+    'parse_config':       bench_parse_config,
+    'common_args':        bench_common_args,
+    'cdrom_args':         bench_cdrom_args,
+    'spawn_no_cache':     lambda rounds: bench_spawn(rounds, use_cache=False),
+    'spawn_cached':       lambda rounds: bench_spawn(rounds, use_cache=True),
+}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]['median_ms']
+        if r['median_ms'] > base * (1 + tolerance):
+            regressions.append(f'{name}: {r["median_ms"]:.3f} ms vs baseline {base:.3f} ms (+{(r["median_ms"] / base - 1) * 100:.0f}%)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='vmvm startup latency benchmarks')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS), help='run only these benchmarks')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE', help='baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown of the median')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        results[name] = summarize(BENCHMARKS[name](args.rounds))
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print(f'{"benchmark":<18}{"min ms":>10}{"median ms":>12}{"p90 ms":>10}')
+        for name, r in results.items():
+            print(f'{name:<18}{r["min_ms"]:>10.3f}{r["median_ms"]:>12.3f}{r["p90_ms"]:>10.3f}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import json
+import socket
+import threading
+
+
+class FakeQMPServer:
+    """
+        minimal in-process QMP server listening on a unix socket. Like QEMU it serves one client at a time,
+        the others wait in the listen backlog without a greeting until the current one disconnects.
+        `handlers` maps command name to either a return value or a callable(arguments) -> return value.
+    """
+    def __init__(self, path: str, handlers: dict):
+        self.path = str(path)
+        self.handlers = handlers
+        self.commands = []
+        self.connections = 0
+        self._conns = []
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def stop(self):
+        if self._sock is not None:
+            self._sock.shutdown(socket.SHUT_RDWR)
+            self._sock.close()
+            self._sock = None
+        self.disconnect_clients()
+
+    def disconnect_clients(self):
+        """ drops established connections, as if QEMU was restarted """
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def executed(self, name: str) -> list:
+        """ arguments of every call of the command `name` """
+        with self._lock:
+            return [args for cmd, args in self.commands if cmd == name]
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections += 1
+                self._conns.append(conn)
+            self._serve(conn)
+            with self._lock:
+                if conn in self._conns:
+                    self._conns.remove(conn)
+
+    def _send(self, conn, msg: dict):
+        conn.sendall(json.dumps(msg).encode() + b'\r\n')
+
+    def _serve(self, conn):
+        decoder = json.JSONDecoder()
+        buf = ''
+        with conn:
+            self._send(conn, {'QMP': {'version': {'qemu': {'major': 9, 'minor': 0, 'micro': 0}, 'package': ''}, 'capabilities': []}})
+            while True:
+                try:
+                    data = conn.recv(65536)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buf += data.decode()
+                while buf.strip():
+                    try:
+                        msg, end = decoder.raw_decode(buf.lstrip())
+                    except json.JSONDecodeError:
+                        break
+                    buf = buf.lstrip()[end:]
+                    try:
+                        self._send(conn, self._handle(msg))
+                    except OSError:
+                        return
+
+    def _handle(self, msg: dict) -> dict:
+        name = msg.get('execute')
+        args = msg.get('arguments', {})
+        reply = {}
+        if 'id' in msg:
+            reply['id'] = msg['id']
+        if name == 'qmp_capabilities':
+            reply['return'] = {}
+            return reply
+        with self._lock:
+            self.commands.append((name, args))
+        if name not in self.handlers:
+            reply['error'] = {'class': 'CommandNotFound', 'desc': f'The command {name} has not been found'}
+            return reply
+        handler = self.handlers[name]
+        try:
+            reply['return'] = handler(args) if callable(handler) else handler
+        except Exception as e:
+            reply['error'] = {'class': 'GenericError', 'desc': str(e)}
+        return reply
@@ -0,0 +1,209 @@
+from vmvm.backup import (backup_disks, new_backup_id, run_backup, backup_vm, restore_vm, read_manifest, guest_agent_execute,
+                         storage_daemon_args, BackupError, BackupDisk)
+from vmvm.config_parser import parse_config
+from .fake_qmp import FakeQMPServer
+from .test_qcow2 import write_qcow2_header
+import os
+import sys
+import json
+import socket
+import shutil
+import threading
+import pytest
+
+# records its arguments; `create` makes an empty target, `convert` copies the top image
+STUB_QEMU_IMG = '''#!{python}
+import sys, shutil
+with open({log!r}, 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+if sys.argv[1] == 'create':
+    open(sys.argv[-2], 'w').close()
+elif sys.argv[1] == 'convert':
+    shutil.copyfile(sys.argv[-2], sys.argv[-1])
+'''
+
+
+def concluded_jobs(nodes, error=None):
+    return [ dict({ 'id': f'backup-{n}', 'type': 'backup', 'status': 'concluded', 'current-progress': 1, 'total-progress': 1 },
+                  **({ 'error': error } if error else {})) for n in nodes ]
+
+
+def test_backup_disks(tmp_path):
+    write_qcow2_header(tmp_path / 'system.qcow2', 20 << 30)
+    write_qcow2_header(tmp_path / 'data.qcow2', 1 << 30)
+    disks = backup_disks(['system.qcow2', { 'file': 'data.qcow2', 'cache': 'none' }], str(tmp_path))
+    assert disks == [ BackupDisk('hd0', str(tmp_path / 'system.qcow2'), 20 << 30), BackupDisk('hd1', str(tmp_path / 'data.qcow2'), 1 << 30) ]
+    for bad in [ 'disk.img', '/dev/sdb', 'missing.qcow2' ]:
+        with pytest.raises(BackupError):
+            backup_disks([bad], str(tmp_path))
+
+
+def test_new_backup_id():
+    now = 1760000000.0
+    first = new_backup_id([], now)
+    assert new_backup_id([ { 'id': first } ], now) == f'{first}-1'
+    assert new_backup_id([ { 'id': first }, { 'id': f'{first}-1' } ], now) == f'{first}-2'
+
+
+def test_run_backup_full(tmp_path):
+    sock = tmp_path / 'qmp.sock'
+    disks = [ BackupDisk('hd0', '/vm/system.qcow2', 1 << 30), BackupDisk('hd1', '/vm/data.qcow2', 1 << 30) ]
+    nodes = [ { 'node-name': 'hd0', 'dirty-bitmaps': [] }, { 'node-name': 'hd1', 'dirty-bitmaps': [ { 'name': 'vmvm-backup' } ] } ]
+    events = []
+    def transaction(args):
+        events.append('transaction')
+        return {}
+    handlers = { 'query-named-block-nodes': nodes, 'blockdev-add': {}, 'transaction': transaction,
+                 'query-jobs': concluded_jobs(['hd0', 'hd1']), 'job-dismiss': {}, 'blockdev-del': {} }
+    with FakeQMPServer(sock, handlers) as server:
+        run_backup(str(sock), disks, { 'hd0': '/b/hd0/1-full.qcow2', 'hd1': '/b/hd1/1-full.qcow2' }, False,
+                   freeze_fn=lambda frozen: events.append(frozen))
+    assert events == [ True, 'transaction', False ]
+    assert server.executed('blockdev-add')[0] == { 'driver': 'qcow2', 'node-name': 'backup-hd0', 'backing': None,
+                                                   'file': { 'driver': 'file', 'filename': '/b/hd0/1-full.qcow2' } }
+    assert server.executed('transaction') == [ {
+        'actions': [
+            { 'type': 'block-dirty-bitmap-add', 'data': { 'node': 'hd0', 'name': 'vmvm-backup', 'persistent': True } },
+            { 'type': 'blockdev-backup', 'data': { 'job-id': 'backup-hd0', 'device': 'hd0', 'target': 'backup-hd0', 'auto-dismiss': False, 'sync': 'full' } },
+            { 'type': 'block-dirty-bitmap-clear', 'data': { 'node': 'hd1', 'name': 'vmvm-backup' } },
+            { 'type': 'blockdev-backup', 'data': { 'job-id': 'backup-hd1', 'device': 'hd1', 'target': 'backup-hd1', 'auto-dismiss': False, 'sync': 'full' } },
+        ],
+        'properties': { 'completion-mode': 'grouped' },
+    } ]
+    assert server.executed('job-dismiss') == [ { 'id': 'backup-hd0' }, { 'id': 'backup-hd1' } ]
+    assert server.executed('blockdev-del') == [ { 'node-name': 'backup-hd0' }, { 'node-name': 'backup-hd1' } ]
+
+
+def test_run_backup_incremental(tmp_path):
+    sock = tmp_path / 'qmp.sock'
+    disks = [ BackupDisk('hd0', '/vm/system.qcow2', 1 << 30) ]
+    handlers = { 'query-named-block-nodes': [ { 'node-name': 'hd0', 'dirty-bitmaps': [ { 'name': 'vmvm-backup' } ] } ],
+                 'blockdev-add': {}, 'transaction': {}, 'query-jobs': concluded_jobs(['hd0']), 'job-dismiss': {}, 'blockdev-del': {} }
+    with FakeQMPServer(sock, handlers) as server:
+        run_backup(str(sock), disks, { 'hd0': '/b/hd0/2-incremental.qcow2' }, True)
+    assert server.executed('transaction')[0]['actions'] == [
+        { 'type': 'blockdev-backup', 'data': { 'job-id': 'backup-hd0', 'device': 'hd0', 'target': 'backup-hd0', 'auto-dismiss': False,
+                                               'sync': 'incremental', 'bitmap': 'vmvm-backup' } },
+    ]
+
+    # no bitmap: the changes since the last backup are unknown
+    handlers['query-named-block-nodes'] = [ { 'node-name': 'hd0', 'dirty-bitmaps': [] } ]
+    with FakeQMPServer(tmp_path / 'qmp2.sock', handlers) as server:
+        with pytest.raises(BackupError, match='take a full backup'):
+            run_backup(str(tmp_path / 'qmp2.sock'), disks, { 'hd0': '/b/hd0/2-incremental.qcow2' }, True)
+    assert server.executed('transaction') == []
+
+
+def test_run_backup_full_failure_drops_bitmap(tmp_path):
+    sock = tmp_path / 'qmp.sock'
+    handlers = { 'query-named-block-nodes': [ { 'node-name': 'hd0' } ], 'blockdev-add': {}, 'transaction': {},
+                 'query-jobs': concluded_jobs(['hd0'], 'No space left on device'), 'job-dismiss': {}, 'blockdev-del': {},
+                 'block-dirty-bitmap-remove': {} }
+    with FakeQMPServer(sock, handlers) as server:
+        with pytest.raises(BackupError, match='backup-hd0: No space left on device'):
+            run_backup(str(sock), [ BackupDisk('hd0', '/vm/system.qcow2', 1 << 30) ], { 'hd0': '/b/hd0/1-full.qcow2' }, False)
+    assert server.executed('block-dirty-bitmap-remove') == [ { 'node': 'hd0', 'name': 'vmvm-backup' } ]
+    assert server.executed('blockdev-del') == [ { 'node-name': 'backup-hd0' } ]
+
+
+def test_storage_daemon_args():
+    assert storage_daemon_args([ BackupDisk('hd0', '/vm/system.qcow2', 1 << 30) ], '/tmp/x/qmp.sock') == [
+        '--blockdev', 'driver=qcow2,node-name=hd0,file.driver=file,file.filename=/vm/system.qcow2',
+        '--chardev', 'socket,id=qmp0,path=/tmp/x/qmp.sock,server=on,wait=off', '--monitor', 'chardev=qmp0',
+    ]
+
+
+def test_backup_chain_and_restore(tmp_path, monkeypatch):
+    log = tmp_path / 'qemu-img.log'
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    stub = bin_dir / 'qemu-img'
+    stub.write_text(STUB_QEMU_IMG.format(python=sys.executable, log=str(log)))
+    stub.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}:{os.environ["PATH"]}')
+
+    vm_dir = tmp_path / 'vm'
+    vm_dir.mkdir()
+    write_qcow2_header(vm_dir / 'system.qcow2', 1 << 30)
+    options = parse_config(dict(name=f'backup-test-{os.getpid()}', disk='system.qcow2'))
+    dest = str(tmp_path / 'backups')
+    bitmaps = []
+    daemon_disks = []
+
+    def storage_daemon(disks, fn):
+        """ stands in for qemu-storage-daemon, keeps the bitmap between "runs" """
+        daemon_disks.append(disks)
+        handlers = { 'query-named-block-nodes': lambda a: [ { 'node-name': 'hd0', 'dirty-bitmaps': list(bitmaps) } ],
+                     'blockdev-add': {}, 'transaction': lambda a: bitmaps.append({ 'name': 'vmvm-backup' }) or {},
+                     'query-jobs': concluded_jobs(['hd0']), 'job-dismiss': {}, 'blockdev-del': {} }
+        sock = str(tmp_path / 'qsd.sock')
+        with FakeQMPServer(sock, handlers):
+            fn(sock)
+        os.remove(sock)
+
+    with pytest.raises(BackupError, match='full backup first'):
+        backup_vm(options, str(vm_dir), dest, incremental=True, storage_daemon=storage_daemon)
+    full = backup_vm(options, str(vm_dir), dest, incremental=False, storage_daemon=storage_daemon)
+    inc = backup_vm(options, str(vm_dir), dest, incremental=True, storage_daemon=storage_daemon)
+    assert daemon_disks[0] == [ BackupDisk('hd0', str(vm_dir / 'system.qcow2'), 1 << 30) ]
+    assert [ b['id'] for b in read_manifest(dest) ] == [ full['id'], inc['id'] ]
+    assert full['disks'] == { 'hd0': f'hd0/{full["id"]}-full.qcow2' }
+    assert inc['type'] == 'incremental' and not inc['frozen']
+    assert log.read_text().splitlines() == [
+        f'create -f qcow2 {dest}/hd0/{full["id"]}-full.qcow2 {1 << 30}',
+        f'create -f qcow2 -b {full["id"]}-full.qcow2 -F qcow2 {dest}/hd0/{inc["id"]}-incremental.qcow2 {1 << 30}',
+    ]
+
+    (tmp_path / 'backups' / 'hd0' / f'{inc["id"]}-incremental.qcow2').write_bytes(b'restored')
+    assert restore_vm(options, str(vm_dir), dest) == [ str(vm_dir / 'system.qcow2') ]
+    assert (vm_dir / 'system.qcow2').read_bytes() == b'restored'
+    assert restore_vm(options, str(vm_dir), dest, full['id'], str(tmp_path / 'out')) == [ str(tmp_path / 'out' / 'system.qcow2') ]
+    assert f'convert -O qcow2 {dest}/hd0/{full["id"]}-full.qcow2 {tmp_path}/out/system.qcow2.restoring' in log.read_text()
+    with pytest.raises(BackupError):
+        restore_vm(options, str(vm_dir), dest, 'no-such-id')
+
+
+def test_backup_vm_failure_removes_targets(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    stub = bin_dir / 'qemu-img'
+    stub.write_text(STUB_QEMU_IMG.format(python=sys.executable, log=str(tmp_path / 'log')))
+    stub.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}:{os.environ["PATH"]}')
+    write_qcow2_header(tmp_path / 'system.qcow2', 1 << 30)
+    options = parse_config(dict(name=f'backup-test-{os.getpid()}', disk='system.qcow2'))
+
+    def storage_daemon(disks, fn):
+        raise BackupError('qemu-storage-daemon exited with code 1')
+    with pytest.raises(BackupError):
+        backup_vm(options, str(tmp_path), str(tmp_path / 'backups'), incremental=False, storage_daemon=storage_daemon)
+    assert os.listdir(tmp_path / 'backups' / 'hd0') == []
+    assert read_manifest(str(tmp_path / 'backups')) == []
+
+
+def test_guest_agent_execute(tmp_path):
+    path = str(tmp_path / 'qga.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    received = []
+
+    def agent():
+        conn, _ = server.accept()
+        with conn:
+            f = conn.makefile('rwb')
+            # reply to a command of an earlier client, still in the channel
+            f.write(b'{"return": 3}\n')
+            for line in f:
+                msg = json.loads(line)
+                received.append(msg['execute'])
+                if msg['execute'] == 'guest-sync':
+                    f.write(json.dumps({ 'return': msg['arguments']['id'] }).encode() + b'\n')
+                else:
+                    f.write(b'{"return": 2}\n')
+                f.flush()
+    threading.Thread(target=agent, daemon=True).start()
+
+    assert guest_agent_execute(path, 'guest-fsfreeze-freeze') == 2
+    assert received == [ 'guest-sync', 'guest-fsfreeze-freeze' ]
+    server.close()
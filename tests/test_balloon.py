@@ -0,0 +1,95 @@
+from vmvm.balloon import BalloonPolicy, balloon_target, guest_available_memory, read_host_memory, control_step, run_controller_async
+from vmvm.qmp import QMPPool, qmp_execute
+from .fake_qmp import FakeQMPServer
+import asyncio
+import threading
+
+G = 1 << 30
+M = 1 << 20
+
+
+def write_meminfo(path, total, available):
+    path.write_text(f'MemTotal:       {total >> 10} kB\nMemFree:        1024 kB\nMemAvailable:   {available >> 10} kB\n')
+
+
+def test_read_host_memory(tmp_path):
+    write_meminfo(tmp_path / 'meminfo', 64 * G, 20 * G)
+    assert read_host_memory(str(tmp_path / 'meminfo')) == (64 * G, 20 * G)
+
+
+def test_guest_available_memory():
+    assert guest_available_memory({ 'stats': { 'stat-available-memory': 3 * G }, 'last-update': 100 }) == 3 * G
+    assert guest_available_memory({ 'stats': { 'stat-available-memory': -1, 'stat-free-memory': G, 'stat-disk-caches': G }, 'last-update': 100 }) == 2 * G
+    # the guest driver did not report yet
+    assert guest_available_memory({ 'stats': { 'stat-available-memory': -1 }, 'last-update': 0 }) is None
+
+
+def test_balloon_target():
+    policy = BalloonPolicy(min_bytes=2 * G, max_bytes=8 * G)
+    # idle guest using 1G: shrinks to used + 20% of 8G headroom, bounded by min
+    assert balloon_target(policy, 8 * G, 7 * G, 64 * G, 32 * G) == G + int(0.2 * 8 * G)
+    assert balloon_target(policy, 8 * G, int(7.9 * G), 64 * G, 32 * G) == 2 * G
+    # busy guest grows up to max
+    assert balloon_target(policy, 4 * G, 100 * M, 64 * G, 32 * G) == int(4 * G - 100 * M + 0.2 * 8 * G)
+    assert balloon_target(policy, 7 * G, 0, 64 * G, 32 * G) == 8 * G
+    # ... but not into the host reserve (10% of 64G)
+    assert balloon_target(policy, 4 * G, 0, 64 * G, int(6.4 * G) + 512 * M) == 4 * G + 512 * M
+    assert balloon_target(policy, 4 * G, 0, 64 * G, 4 * G) is None
+    # small changes are skipped
+    assert balloon_target(policy, 4 * G, int(0.2 * 8 * G) + 10 * M, 64 * G, 32 * G) is None
+    # host under pressure halves the headroom
+    assert balloon_target(policy, 8 * G, 4 * G, 64 * G, 4 * G) == 4 * G + int(0.1 * 8 * G)
+
+
+def test_control_step(tmp_path):
+    write_meminfo(tmp_path / 'meminfo', 64 * G, 32 * G)
+    stats = { 'stats': { 'stat-available-memory': 7 * G }, 'last-update': 100 }
+    handlers = {
+        'query-balloon': { 'actual': 8 * G },
+        'qom-get': lambda args: stats,
+        'qom-set': {},
+        'balloon': {},
+    }
+    policy = BalloonPolicy(min_bytes=2 * G, max_bytes=8 * G)
+    with FakeQMPServer(tmp_path / 'qmp.sock', handlers) as server:
+        async def run():
+            async with QMPPool({ 'vm': server.path }) as pool:
+                return await control_step(pool, 'vm', policy, str(tmp_path / 'meminfo'))
+        target = asyncio.run(run())
+        assert server.executed('balloon') == [ { 'value': target } ]
+        assert server.executed('qom-get') == [ { 'path': '/machine/peripheral/balloon0', 'property': 'guest-stats' } ]
+
+        # no stats yet: nothing is done
+        stats = { 'stats': {}, 'last-update': 0 }
+        assert asyncio.run(run()) is None
+        assert len(server.executed('balloon')) == 1
+
+        # the loop enables guest stats polling and stops on request
+        stop = threading.Event()
+        handlers['query-balloon'] = lambda args: stop.set() or { 'actual': 8 * G }
+        asyncio.run(run_controller_async(server.path, policy, interval=0, stop=stop, meminfo_path=str(tmp_path / 'meminfo')))
+        assert server.executed('qom-set') == [ { 'path': '/machine/peripheral/balloon0', 'property': 'guest-stats-polling-interval', 'value': 5 } ]
+
+
+def test_controller_leaves_qmp_to_other_clients(tmp_path):
+    write_meminfo(tmp_path / 'meminfo', 64 * G, 32 * G)
+    handlers = {
+        'query-balloon': { 'actual': 8 * G },
+        'qom-get': { 'stats': {}, 'last-update': 0 },
+        'qom-set': {},
+        'query-status': { 'status': 'running', 'running': True },
+    }
+    policy = BalloonPolicy(min_bytes=2 * G, max_bytes=8 * G)
+    stop = threading.Event()
+    with FakeQMPServer(tmp_path / 'qmp.sock', handlers) as server:
+        controller = threading.Thread(target=lambda: asyncio.run(run_controller_async(server.path, policy, interval=0.05, stop=stop,
+                                                                                      meminfo_path=str(tmp_path / 'meminfo'))))
+        controller.start()
+        try:
+            # one-shot clients, e.g. `vmvm query`, get through while the controller runs
+            for _ in range(3):
+                assert qmp_execute(server.path, 'query-status', timeout=2) == { 'status': 'running', 'running': True }
+        finally:
+            stop.set()
+            controller.join(10)
+        assert len(server.executed('query-balloon')) >= 1
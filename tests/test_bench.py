@@ -0,0 +1,139 @@
+from vmvm.bench import (bench_args, ephemeral_disks, percentile, summarize, format_summary, boot_once, watch_guest_agent,
+                        BootTimeline, ReadyProbe)
+from vmvm.utils import get_unix_sock_path, SockType
+from .fake_qmp import FakeQMPServer
+from types import SimpleNamespace
+import os
+import sys
+import socket
+import threading
+import subprocess
+
+
+def test_percentile_and_summary():
+    assert percentile([3.0, 1.0, 2.0], 50) == 2.0
+    assert percentile([1.0, 2.0], 50) == 1.5
+    assert percentile([5.0], 99) == 5.0
+    assert abs(percentile([ float(i) for i in range(1, 11) ], 90) - 9.1) < 1e-9
+    summary = summarize([ { 'spawn': 0.01, 'qmp': 0.03, 'ready': 2.0 }, { 'spawn': 0.02, 'qmp': 0.05 } ])
+    assert sorted(summary) == ['qmp', 'ready', 'spawn']
+    assert summary['spawn']['count'] == 2 and summary['ready']['count'] == 1
+    assert summary['qmp']['min'] == 0.03 and summary['qmp']['max'] == 0.05 and abs(summary['qmp']['p50'] - 0.04) < 1e-9
+    text = format_summary(summary, 2)
+    assert 'handoff' in text and '2000.0' in text
+
+
+def test_bench_args():
+    args = bench_args('/tmp/b/serial.log', None)
+    assert args == ['-snapshot', '-chardev', 'file,id=benchserial,path=/tmp/b/serial.log', '-serial', 'chardev:benchserial']
+    args = bench_args('/tmp/b/serial.log', '/tmp/b/qga.sock')
+    assert 'socket,id=benchqga,path=/tmp/b/qga.sock,server=on,wait=off' in args
+    assert 'virtserialport,bus=benchvirtio0.0,chardev=benchqga,name=org.qemu.guest_agent.0' in args
+
+
+def test_ephemeral_disks(tmp_path):
+    calls = []
+    def overlay(path, base, cwd=None, spec=None, base_format=None):
+        calls.append((path, base, cwd, base_format))
+        return 0
+    disks = ephemeral_disks(['system.qcow2', { 'file': 'data.img', 'cache': 'none', 'format': 'qcow2', 'base': '/golden/data.img' }],
+                            '/vms/a', str(tmp_path), overlay)
+    assert disks == [ { 'file': str(tmp_path / 'disk0.qcow2'), 'format': 'qcow2' },
+                      { 'file': str(tmp_path / 'disk1.qcow2'), 'cache': 'none', 'format': 'qcow2' } ]
+    assert calls == [ (str(tmp_path / 'disk0.qcow2'), 'system.qcow2', '/vms/a', 'qcow2'), (str(tmp_path / 'disk1.qcow2'), 'data.img', '/vms/a', 'qcow2') ]
+
+
+def fake_app(name, launched, guest_agent=False):
+    class FakeApp:
+        """ 'boots' a sleeping process: writes the serial log, serves QMP until quit and answers guest-ping """
+        def __init__(self, vm_dir, use_cache=True):
+            assert not use_cache
+            self.options = SimpleNamespace(name=name, disks=['system.qcow2'], control_socket=False, guest_agent=guest_agent)
+            self.extra_args = []
+            self.on_started = None
+
+        def act_run(self):
+            launched.append((self.options.disks, self.options.control_socket, list(self.extra_args)))
+            serial_path = self.extra_args[2].split('path=')[1]
+            proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+            qmp_sock = get_unix_sock_path(SockType.QMP, name)
+            if os.path.exists(qmp_sock):
+                os.remove(qmp_sock)
+            agent = None
+            if guest_agent:
+                qga_sock = get_unix_sock_path(SockType.QGA, name)
+                if os.path.exists(qga_sock):
+                    os.remove(qga_sock)
+                agent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                agent.bind(qga_sock)
+                agent.listen()
+                def answer():
+                    conn, _ = agent.accept()
+                    with conn:
+                        conn.recv(4096)
+                        conn.sendall(b'{"return": {}}\n')
+                threading.Thread(target=answer, daemon=True).start()
+            with FakeQMPServer(qmp_sock, { 'query-status': { 'status': 'running' }, 'quit': lambda a: proc.terminate() or {} }):
+                self.on_started(proc)
+                with open(serial_path, 'w') as f:
+                    f.write('EFI stub: Booting Linux Kernel...\n')
+                    f.flush()
+                    f.write('Welcome\nbench login: ')
+                proc.wait(20)
+            os.remove(qmp_sock)
+            if agent is not None:
+                agent.close()
+                os.remove(qga_sock)
+            return 0
+    return FakeApp
+
+
+def test_boot_once():
+    name = f'bench-test-{os.getpid()}'
+    launched = []
+    marks = boot_once('/vms/a', ReadyProbe(timeout=20), app_factory=fake_app(name, launched), overlay_fn=lambda *a, **kw: 0)
+    assert sorted(marks) == ['handoff', 'qmp', 'ready', 'spawn']
+    assert marks['spawn'] <= marks['handoff'] <= marks['ready']
+    disks, control_socket, extra_args = launched[0]
+    assert disks[0]['file'].endswith('disk0.qcow2') and control_socket
+    assert not os.path.exists(os.path.dirname(disks[0]['file']))
+
+
+def test_boot_once_vm_guest_agent():
+    name = f'bench-qga-test-{os.getpid()}'
+    launched = []
+    marks = boot_once('/vms/a', ReadyProbe(guest_agent=True, timeout=20), app_factory=fake_app(name, launched, guest_agent=True),
+                      overlay_fn=lambda *a, **kw: 0)
+    assert 'ready' in marks
+    # the agent channel of the VM is used, no second org.qemu.guest_agent.0 port is added
+    _, _, extra_args = launched[0]
+    assert not any('guest_agent' in arg or 'benchqga' in arg for arg in extra_args)
+
+
+def test_watch_guest_agent(tmp_path):
+    path = str(tmp_path / 'qga.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    pings = []
+
+    def agent():
+        conn, _ = server.accept()
+        with conn:
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    return
+                pings.append(data)
+                # the agent "starts" on the third ping
+                if len(pings) >= 3:
+                    conn.sendall(b'{"return": {}}\n')
+    threading.Thread(target=agent, daemon=True).start()
+
+    timeline = BootTimeline()
+    t = threading.Thread(target=watch_guest_agent, args=(path, timeline))
+    t.start()
+    assert timeline.ready.wait(10)
+    t.join(5)
+    server.close()
+    assert 'ready' in timeline.marks and len(pings) >= 3
@@ -1,5 +1,6 @@
 
-from vmvm.builder import VMOptions, RuntimeOptions, CmdBuilder
+from vmvm.builder import VMOptions, RuntimeOptions, CmdBuilder, CopyFileCommand
+from vmvm.utils import get_virtiofs_sock_path, get_passt_sock_path, get_unix_sock_path, SockType
 import pytest
 
 
@@ -26,7 +27,6 @@ def test_default():
         enable_tpm = False,
         disk_virtio_mode = "blk",
         usbdevices = [],
-        pcidevices = [],
         isoimages = [],
         need_cd = False,
         floppy = None,
@@ -90,7 +90,6 @@ vmoptions_linux_1 = VMOptions(
     enable_tpm = False,
     disk_virtio_mode = "blk",
     usbdevices = [],
-    pcidevices = [],
     isoimages = ["anything here"],
     need_cd = False,
     floppy = None,
@@ -127,7 +126,7 @@ def test_linux_1():
         '-device', 'virtserialport,chardev=spicechannel0,name=com.redhat.spice.0',
         '-chardev', 'spicevmc,id=spicechannel0,name=vdagent',
         '-blockdev', 'driver=qcow2,node-name=hd0,file.driver=file,file.filename=system.qcow2,discard=unmap,detect-zeroes=unmap',
-        '-device', 'virtio-blk-pci,id=virtblk0,num-queues=4,drive=hd0,bootindex=1',
+        '-device', 'virtio-blk-pci,id=virtblk0,num-queues=8,drive=hd0,bootindex=1',
         '-device', 'qemu-xhci',
         '-device', 'usb-tablet',
         '-netdev', 'user,id=net0,hostfwd=tcp::2222-:22',
@@ -213,6 +212,26 @@ def test_linux_efi():
 
 
 
+def test_efi_firmware_descriptor():
+    fw = {
+        'name': '50-edk2-ovmf-x64-sb-enrolled.json',
+        'code': '/usr/share/edk2/ovmf/OVMF_CODE_4M.secboot.qcow2', 'code_format': 'qcow2',
+        'vars_template': '/usr/share/edk2/ovmf/OVMF_VARS_4M.secboot.qcow2', 'vars_format': 'qcow2',
+        'targets': [['x86_64', ['pc-q35-*']]],
+        'features': ['requires-smm', 'secure-boot', 'enrolled-keys'],
+    }
+    b = CmdBuilder(listdir_fn=lambda _: [], pathexists_fn=lambda p: p.startswith('/usr/share'))
+    result = b.common_args(make_vmoptions_linux_efi_secboot(), RuntimeOptions(spice_port=5900,tpm_socket="",has_cpu_topoext=False,firmware=fw))
+    assert is_sublist([
+        '-drive', 'if=pflash,format=qcow2,readonly=on,file=/usr/share/edk2/ovmf/OVMF_CODE_4M.secboot.qcow2',
+        '-drive', 'if=pflash,format=qcow2,file=./OVMF_VARS_4M.secboot.qcow2',
+        '-machine', 'smm=on', '-global', 'driver=cfi.pflash01,property=secure,value=on',
+    ], result.args)
+    # the variables store is copied in-process
+    assert result.pre_commands == [ CopyFileCommand(src='/usr/share/edk2/ovmf/OVMF_VARS_4M.secboot.qcow2', dst='./OVMF_VARS_4M.secboot.qcow2') ]
+
+
+
 def test_cdrom():
     vmoptions_cdrom = VMOptions(
         disks = [],
@@ -229,7 +248,6 @@ def test_cdrom():
         enable_tpm = False,
         disk_virtio_mode = "blk",
         usbdevices = [],
-        pcidevices = [],
         isoimages = ["foo.iso"],
         need_cd = False,
         floppy = None,
@@ -271,7 +289,6 @@ def test_linux_3daccel():
         enable_tpm = False,
         disk_virtio_mode = "blk",
         usbdevices = [],
-        pcidevices = [],
         isoimages = ["foo.iso"],
         need_cd = False,
         floppy = None,
@@ -319,8 +336,6 @@ def test_topoext():
         nic_forward_ports = [],
         soundcard_model = "none",
         gpu_model = "none",
-        gpu_passthrough = None,
-        lg_shm = False,
         display = "gtk",
         spice = "none",
         control_socket = False,
@@ -329,3 +344,382 @@ def test_topoext():
     cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=True)).args
     assert is_sublist(['-cpu', 'host,+topoext'], cmdline)
 
+
+
+def test_smp_topology():
+    from vmvm.hw_caps import HostTopology
+    vmoptions = VMOptions(
+        disks = [],
+        name = "bar",
+        cpus = 8,
+        ram = "4G",
+        arch = "x86_64",
+        machine = "q35",
+        enable_efi = False,
+        enable_kvm = True,
+        cpu_model = "host",
+        enable_boot_menu = False,
+        enable_secureboot = False,
+        enable_tpm = False,
+        disk_virtio_mode = "blk",
+        usbdevices = [],
+        isoimages = [],
+        need_cd = False,
+        floppy = None,
+        share_dir_as_fat = None,
+        share_dir_as_floppy = None,
+        share_dir_as_fsd = None,
+        nic_model = "none",
+        nic_forward_ports = [],
+        soundcard_model = "none",
+        gpu_model = "none",
+        display = "none",
+        spice = "none",
+        control_socket = False,
+        topology = "host",
+    )
+    b = CmdBuilder()
+    host = HostTopology(cpus=[], sockets=1, cores=8, threads=2)
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False,host_topology=host)).args
+    assert is_sublist(['-smp', '8,sockets=1,cores=4,threads=2'], cmdline)
+
+    vmoptions.topology = dict(sockets=2, cores=4)
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args
+    assert is_sublist(['-smp', '8,sockets=2,cores=4,threads=1'], cmdline)
+    assert '-qmp' not in cmdline
+
+    vmoptions.cpu_pinning = dict(vcpus='auto')
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args
+    assert '-qmp' in cmdline
+
+
+def test_hugepages():
+    vmoptions = VMOptions(
+        disks = [],
+        name = "bar",
+        cpus = 4,
+        ram = "8G",
+        arch = "x86_64",
+        machine = "q35",
+        enable_efi = False,
+        enable_kvm = True,
+        cpu_model = "host",
+        enable_boot_menu = False,
+        enable_secureboot = False,
+        enable_tpm = False,
+        disk_virtio_mode = "blk",
+        usbdevices = [],
+        isoimages = [],
+        need_cd = False,
+        floppy = None,
+        share_dir_as_fat = None,
+        share_dir_as_floppy = None,
+        share_dir_as_fsd = None,
+        nic_model = "none",
+        nic_forward_ports = [],
+        soundcard_model = "none",
+        gpu_model = "none",
+        display = "none",
+        spice = "none",
+        control_socket = False,
+        hugepages = dict(size='2M', prealloc=True, share=False, backend='memfd', fallback=False),
+    )
+    b = CmdBuilder()
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args
+    assert is_sublist([
+        '-m', '8G',
+        '-object', 'memory-backend-memfd,id=mem0,size=8G,hugetlb=on,hugetlbsize=2M,prealloc=on',
+        '-machine', 'memory-backend=mem0',
+        ], cmdline)
+
+    vmoptions.hugepages = dict(size='1G', prealloc=False, share=True, backend='file', fallback=False)
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False,hugetlbfs_path='/dev/hugepages1G')).args
+    assert is_sublist([
+        '-object', 'memory-backend-file,id=mem0,size=8G,mem-path=/dev/hugepages1G,share=on',
+        ], cmdline)
+
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False,use_hugepages=False)).args
+    assert 'memory-backend=mem0' not in cmdline
+
+
+def test_disk_iothreads():
+    vmoptions = VMOptions(
+        disks = [
+            "system.qcow2",
+            dict(file="db1.qcow2", iothread="db", queues=2),
+            dict(file="db2.raw", iothread="db"),
+            dict(file="/dev/nvme1n1", iothread=True),
+        ],
+        name = "bar",
+        cpus = 6,
+        ram = "8G",
+        arch = "x86_64",
+        machine = "q35",
+        enable_efi = False,
+        enable_kvm = True,
+        cpu_model = "host",
+        enable_boot_menu = False,
+        enable_secureboot = False,
+        enable_tpm = False,
+        disk_virtio_mode = "blk",
+        usbdevices = [],
+        isoimages = [],
+        need_cd = False,
+        floppy = None,
+        share_dir_as_fat = None,
+        share_dir_as_floppy = None,
+        share_dir_as_fsd = None,
+        nic_model = "none",
+        nic_forward_ports = [],
+        soundcard_model = "none",
+        gpu_model = "none",
+        display = "none",
+        spice = "none",
+        control_socket = False,
+    )
+    b = CmdBuilder()
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args
+    assert is_sublist([
+        '-object', 'iothread,id=iothread-db',
+        '-object', 'iothread,id=iothread3',
+        '-blockdev', 'driver=qcow2,node-name=hd0,file.driver=file,file.filename=system.qcow2,discard=unmap,detect-zeroes=unmap',
+        '-device', 'virtio-blk-pci,id=virtblk0,num-queues=6,drive=hd0,bootindex=1',
+        '-blockdev', 'driver=qcow2,node-name=hd1,file.driver=file,file.filename=db1.qcow2,discard=unmap,detect-zeroes=unmap',
+        '-device', 'virtio-blk-pci,id=virtblk1,num-queues=2,iothread=iothread-db,drive=hd1,bootindex=2',
+        '-blockdev', 'driver=raw,node-name=hd2,file.driver=file,file.filename=db2.raw,discard=unmap,detect-zeroes=unmap',
+        '-device', 'virtio-blk-pci,id=virtblk2,num-queues=6,iothread=iothread-db,drive=hd2,bootindex=3',
+        '-blockdev', 'driver=raw,node-name=hosthd3,file.driver=host_device,file.filename=/dev/nvme1n1,file.aio=native,cache.direct=on,discard=unmap,detect-zeroes=unmap',
+        '-device', 'virtio-blk-pci,id=virtblk3,num-queues=6,iothread=iothread3,drive=hosthd3,bootindex=4',
+        ], cmdline)
+
+    vmoptions.disk_virtio_mode = 'scsi'
+    vmoptions.disk_iothreads = True
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args
+    assert is_sublist([
+        '-object', 'iothread,id=iothread-scsi0',
+        '-device', 'virtio-scsi-pci,id=scsi0,num_queues=6,iothread=iothread-scsi0',
+        ], cmdline)
+
+
+def test_disk_cache_aio():
+    vmoptions = VMOptions(
+        disks = [
+            "system.qcow2",
+            dict(file="scratch.qcow2", cache="unsafe", aio="threads"),
+            dict(file="data.raw", aio="native"),
+            dict(file="/dev/sdb", cache="writeback", aio="io_uring"),
+        ],
+        name = "bar",
+        cpus = 4,
+        ram = "4G",
+        arch = "x86_64",
+        machine = "q35",
+        enable_efi = False,
+        enable_kvm = True,
+        cpu_model = "host",
+        enable_boot_menu = False,
+        enable_secureboot = False,
+        enable_tpm = False,
+        disk_virtio_mode = "blk",
+        usbdevices = [],
+        isoimages = [],
+        need_cd = False,
+        floppy = None,
+        share_dir_as_fat = None,
+        share_dir_as_floppy = None,
+        share_dir_as_fsd = None,
+        nic_model = "none",
+        nic_forward_ports = [],
+        soundcard_model = "none",
+        gpu_model = "none",
+        display = "none",
+        spice = "none",
+        control_socket = False,
+    )
+    b = CmdBuilder()
+    blockdevs = lambda cmdline: [ cmdline[i+1] for i, a in enumerate(cmdline) if a == '-blockdev' ]
+
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False,has_io_uring=True)).args
+    assert blockdevs(cmdline) == [
+        'driver=qcow2,node-name=hd0,file.driver=file,file.filename=system.qcow2,file.aio=io_uring,discard=unmap,detect-zeroes=unmap',
+        'driver=qcow2,node-name=hd1,file.driver=file,file.filename=scratch.qcow2,file.aio=threads,cache.direct=off,cache.no-flush=on,discard=unmap,detect-zeroes=unmap',
+        'driver=raw,node-name=hd2,file.driver=file,file.filename=data.raw,file.aio=native,cache.direct=on,discard=unmap,detect-zeroes=unmap',
+        'driver=raw,node-name=hosthd3,file.driver=host_device,file.filename=/dev/sdb,file.aio=io_uring,cache.direct=off,discard=unmap,detect-zeroes=unmap',
+    ]
+
+    # without io_uring images keep QEMU defaults
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False,has_io_uring=False)).args
+    assert blockdevs(cmdline)[0] == 'driver=qcow2,node-name=hd0,file.driver=file,file.filename=system.qcow2,discard=unmap,detect-zeroes=unmap'
+
+    vmoptions.disk_cache = 'none'
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False,has_io_uring=False)).args
+    assert blockdevs(cmdline)[0] == 'driver=qcow2,node-name=hd0,file.driver=file,file.filename=system.qcow2,cache.direct=on,discard=unmap,detect-zeroes=unmap'
+
+
+def test_disk_l2_cache():
+    vmoptions = VMOptions(
+        disks = [
+            "system.qcow2",
+            dict(file="data.qcow2", cache_clean_interval=900),
+            "data.raw",
+        ],
+        name = "bar",
+        cpus = 4,
+        ram = "4G",
+        arch = "x86_64",
+        machine = "q35",
+        enable_efi = False,
+        enable_kvm = True,
+        cpu_model = "host",
+        enable_boot_menu = False,
+        enable_secureboot = False,
+        enable_tpm = False,
+        disk_virtio_mode = "blk",
+        usbdevices = [],
+        isoimages = [],
+        need_cd = False,
+        floppy = None,
+        share_dir_as_fat = None,
+        share_dir_as_floppy = None,
+        share_dir_as_fsd = None,
+        nic_model = "none",
+        nic_forward_ports = [],
+        soundcard_model = "none",
+        gpu_model = "none",
+        display = "none",
+        spice = "none",
+        control_socket = False,
+    )
+    b = CmdBuilder()
+    blockdevs = lambda cmdline: [ cmdline[i+1] for i, a in enumerate(cmdline) if a == '-blockdev' ]
+
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False,disk_l2_cache_sizes=[64 << 20, None, None])).args
+    assert blockdevs(cmdline) == [
+        'driver=qcow2,node-name=hd0,file.driver=file,file.filename=system.qcow2,l2-cache-size=67108864,discard=unmap,detect-zeroes=unmap',
+        'driver=qcow2,node-name=hd1,file.driver=file,file.filename=data.qcow2,cache-clean-interval=900,discard=unmap,detect-zeroes=unmap',
+        'driver=raw,node-name=hd2,file.driver=file,file.filename=data.raw,discard=unmap,detect-zeroes=unmap',
+    ]
+
+    # only the configured format wins over the file name, the image header is never looked at
+    vmoptions.disks[2] = dict(file="data.raw", format="qcow2")
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args
+    assert blockdevs(cmdline)[2].startswith('driver=qcow2,node-name=hd2,file.driver=file,file.filename=data.raw,')
+
+
+def test_shared_dirs():
+    share = lambda path, tag, transport='virtiofs': dict(path=path, tag=tag, transport=transport, cache='auto', thread_pool_size=None)
+    vmoptions = VMOptions(
+        disks = [],
+        name = "bar",
+        cpus = 4,
+        ram = "4G",
+        arch = "x86_64",
+        machine = "q35",
+        enable_efi = False,
+        enable_kvm = True,
+        cpu_model = "host",
+        enable_boot_menu = False,
+        enable_secureboot = False,
+        enable_tpm = False,
+        disk_virtio_mode = "blk",
+        usbdevices = [],
+        isoimages = [],
+        need_cd = False,
+        floppy = None,
+        share_dir_as_fat = None,
+        share_dir_as_floppy = None,
+        share_dir_as_fsd = [ share('src', 'hostshare'), share('/data', 'data'), share('/old', 'legacy', '9p') ],
+        nic_model = "none",
+        nic_forward_ports = [],
+        soundcard_model = "none",
+        gpu_model = "none",
+        display = "none",
+        spice = "none",
+        control_socket = False,
+    )
+    b = CmdBuilder(base_dir='/vms/bar')
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args
+    # virtiofsd maps guest RAM
+    assert is_sublist([ '-object', 'memory-backend-memfd,id=mem0,size=4G,share=on', '-machine', 'memory-backend=mem0' ], cmdline)
+    assert is_sublist([
+        '-chardev', f'socket,id=fsd0,path={get_virtiofs_sock_path("bar", "hostshare")}',
+        '-device', 'vhost-user-fs-pci,queue-size=1024,chardev=fsd0,tag=hostshare',
+        '-chardev', f'socket,id=fsd1,path={get_virtiofs_sock_path("bar", "data")}',
+        '-device', 'vhost-user-fs-pci,queue-size=1024,chardev=fsd1,tag=data',
+        '-fsdev', 'local,security_model=passthrough,id=fsdev2,path=/old',
+        '-device', 'virtio-9p-pci,fsdev=fsdev2,mount_tag=legacy',
+    ], cmdline)
+
+    # hugepages backend is made shareable
+    vmoptions.hugepages = dict(size='2M', prealloc=False, share=False, backend='memfd', fallback=False)
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args
+    assert 'memory-backend-memfd,id=mem0,size=4G,hugetlb=on,hugetlbsize=2M,share=on' in cmdline
+
+
+def test_net():
+    vmoptions = VMOptions(
+        disks = [],
+        name = "bar",
+        cpus = 4,
+        ram = "4G",
+        arch = "x86_64",
+        machine = "q35",
+        enable_efi = False,
+        enable_kvm = True,
+        cpu_model = "host",
+        enable_boot_menu = False,
+        enable_secureboot = False,
+        enable_tpm = False,
+        disk_virtio_mode = "blk",
+        usbdevices = [],
+        isoimages = [],
+        need_cd = False,
+        floppy = None,
+        share_dir_as_fat = None,
+        share_dir_as_floppy = None,
+        share_dir_as_fsd = None,
+        nic_model = "none",
+        nic_forward_ports = [],
+        soundcard_model = "none",
+        gpu_model = "none",
+        display = "none",
+        spice = "none",
+        control_socket = False,
+        net = [
+            dict(type='user', model='virtio', forward_ports=[dict(host=2222, guest=22), dict(host=5353, guest=53, proto='udp')], mac=None),
+            dict(type='tap', model='virtio', ifname='tap0', queues=4, vhost=True, mac='52:54:00:00:00:01'),
+            dict(type='bridge', model='e1000', bridge='br0', queues=1, vhost=True, mac='52:54:00:00:00:02'),
+        ],
+    )
+    b = CmdBuilder()
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False,bridge_helper='/usr/libexec/qemu-bridge-helper')).args
+    assert is_sublist([
+        '-netdev', 'user,id=net0,hostfwd=tcp::2222-:22,hostfwd=udp::5353-:53', '-device', 'virtio-net-pci,netdev=net0',
+        '-netdev', 'tap,id=net1,ifname=tap0,script=no,downscript=no,queues=4,vhost=on',
+        '-device', 'virtio-net-pci,netdev=net1,mq=on,vectors=10,mac=52:54:00:00:00:01',
+        '-netdev', 'tap,id=net2,helper=/usr/libexec/qemu-bridge-helper --br=br0,vhost=on', '-device', 'e1000,netdev=net2,mac=52:54:00:00:00:02',
+    ], cmdline)
+
+    # no access to /dev/vhost-net, no bridge helper installed
+    cmdline = b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False,has_vhost_net=False)).args
+    assert is_sublist([ '-netdev', 'tap,id=net1,ifname=tap0,script=no,downscript=no,queues=4' ], cmdline)
+    assert is_sublist([ '-netdev', 'bridge,id=net2,br=br0' ], cmdline)
+
+    vmoptions.net = [ dict(type='passt', model='virtio', forward_ports=[], mac=None) ]
+    assert is_sublist([
+        '-netdev', f'stream,id=net0,server=off,addr.type=unix,addr.path={get_passt_sock_path("bar", 0)}', '-device', 'virtio-net-pci,netdev=net0',
+    ], b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args)
+
+    vmoptions.net = []
+    assert is_sublist([ '-nic', 'none' ], b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args)
+
+    vmoptions.balloon = dict(free_page_reporting=True, deflate_on_oom=True, auto=False, min=1 << 30)
+    assert is_sublist([ '-device', 'virtio-balloon-pci,id=balloon0,free-page-reporting=on,deflate-on-oom=on' ],
+                      b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args)
+
+    vmoptions.guest_agent = True
+    assert is_sublist([
+        '-chardev', f'socket,id=qga0,path={get_unix_sock_path(SockType.QGA, "bar")},server=on,wait=off',
+        '-device', 'virtio-serial-pci,id=qgaserial0',
+        '-device', 'virtserialport,bus=qgaserial0.0,chardev=qga0,name=org.qemu.guest_agent.0',
+    ], b.common_args(vmoptions, RuntimeOptions(spice_port=0,tpm_socket="",has_cpu_topoext=False)).args)
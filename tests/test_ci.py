@@ -0,0 +1,98 @@
+from vmvm.ci import ci_args, make_headless, remap_forward_ports, run_ci, CIJob, CIError, CI_PORT_BASE, TIMEOUT_EXIT_CODE
+from vmvm.config_parser import parse_config
+from vmvm.port_registry import PortRegistry
+from vmvm.utils import get_runtime_dir, get_unix_sock_path, SockType
+from .fake_qmp import FakeQMPServer
+from types import SimpleNamespace
+import os
+import sys
+import pytest
+import threading
+import subprocess
+
+
+def test_ci_args():
+    args = ci_args('/logs/a-0.serial.log', CIJob(command='make test ARGS=-j4,-v', timeout=600), 3)
+    assert args == [
+        '-snapshot',
+        '-chardev', 'file,id=ciserial,path=/logs/a-0.serial.log', '-serial', 'chardev:ciserial',
+        '-fw_cfg', 'name=opt/vmvm/ci/instance,string=3',
+        '-fw_cfg', 'name=opt/vmvm/ci/command,string=make test ARGS=-j4,,-v',
+        '-fw_cfg', 'name=opt/vmvm/ci/timeout,string=600',
+    ]
+    assert ci_args('/logs/a-0.serial.log', CIJob(), 0)[-2:] == ['-fw_cfg', 'name=opt/vmvm/ci/instance,string=0']
+
+
+def test_remap_forward_ports():
+    ports = iter([40001, 40002])
+    remapped, mapping = remap_forward_ports([{'host': 2222, 'guest': 22}, {'host': 5353, 'guest': 53, 'proto': 'udp'}],
+                                            lambda proto: next(ports))
+    assert remapped == [{'host': 40001, 'guest': 22}, {'host': 40002, 'guest': 53, 'proto': 'udp'}]
+    assert mapping == [('tcp', 2222, 40001), ('udp', 5353, 40002)]
+
+
+def test_make_headless():
+    o = parse_config(dict(name='runner', gpu='virtio-vga-gl', spice='none', sound='hda',
+                          net=[{'type': 'user', 'forward_ports': [{'host': 2222, 'guest': 22}]}, {'type': 'bridge', 'bridge': 'br0'}]))
+    mapping = make_headless(o, 'runner-ci1-0', 2, port_fn=lambda proto: 40000)
+    assert (o.name, o.display, o.spice, o.soundcard_model, o.gpu_model, o.control_socket) == \
+        ('runner-ci1-0', 'none', 'none', 'none', 'virtio-vga', True)
+    assert mapping == [('tcp', 2222, 40000)]
+    assert o.net[0]['forward_ports'] == [{'host': 40000, 'guest': 22}] and o.net[0]['mac'] is None
+    assert o.net[1]['mac'].startswith('52:54:00:')
+
+    o = parse_config(dict(name='runner', net=[{'type': 'tap', 'ifname': 'tap0'}]))
+    make_headless(o, 'runner-ci1-0', 1, port_fn=lambda proto: 40000)
+    with pytest.raises(CIError):
+        make_headless(parse_config(dict(name='runner', net=[{'type': 'tap', 'ifname': 'tap0'}])), 'runner-ci1-0', 2, port_fn=lambda proto: 40000)
+
+
+def test_run_ci(tmp_path):
+    name = f'ci-test-{os.getpid()}'
+    both_running = threading.Barrier(2, timeout=20)
+    launched = []
+
+    class FakeApp:
+        """ instance 0 passes and powers off, instance 1 hangs until quit over QMP """
+        def __init__(self, vm_dir, use_cache=True):
+            assert not use_cache
+            self.options = parse_config(dict(name=name, disks=['system.qcow2'], nic='virtio', nic_forward_ports=[{'host': 2222, 'guest': 22}]))
+            self.extra_args = []
+            self.on_started = None
+
+        def act_run(self):
+            o = self.options
+            launched.append((o.name, o.disks[0]['file'], o.nic_forward_ports[0]['host']))
+            serial_path = self.extra_args[2].split('path=')[1]
+            index = int(self.extra_args[6].split('string=')[1])
+            proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+            qmp_sock = get_unix_sock_path(SockType.QMP, o.name)
+            with FakeQMPServer(qmp_sock, { 'quit': lambda a: proc.terminate() or {} }):
+                if self.on_started is not None:
+                    self.on_started(proc)
+                both_running.wait()
+                with open(serial_path, 'w') as f:
+                    f.write(f'instance {index}: ' + ('JOB PASSED\n' if index == 0 else 'hanging\n'))
+                if index == 0:
+                    proc.terminate()
+                proc.wait(20)
+            os.remove(qmp_sock)
+            return 0
+
+    job = CIJob(timeout=1.0, pass_regex='JOB PASSED', log_dir=str(tmp_path / 'logs'), overlay_dir=str(tmp_path))
+    results = run_ci('/vms/runner', 2, job, app_factory=FakeApp, overlay_fn=lambda *a, **kw: 0)
+    assert [ (r.exit_code, r.timed_out) for r in results ] == [ (0, False), (TIMEOUT_EXIT_CODE, True) ]
+    assert results[0].name != results[1].name and all(r.name.startswith(f'{name}-ci') for r in results)
+    assert results[0].serial_log == str(tmp_path / 'logs' / f'{name}-0.serial.log')
+    assert open(results[1].serial_log).read() == 'instance 1: hanging\n'
+    assert len({ disk for _, disk, _ in launched }) == 2
+    assert len({ port for _, _, port in launched }) == 2 and all(port >= CI_PORT_BASE for _, _, port in launched)
+    # overlay directories, port leases and runtime directories are gone
+    assert sorted(os.listdir(tmp_path)) == ['logs']
+    assert not any(lease.startswith(f'{name}-ci') for lease in PortRegistry(CI_PORT_BASE, name='ci-ports').leases())
+    assert not any(os.path.exists(os.path.join(get_runtime_dir(), r.name)) for r in results)
+
+    # the pass regex decides for instances that exit cleanly
+    results = run_ci('/vms/runner', 2, CIJob(pass_regex='never printed', log_dir=str(tmp_path / 'logs'), timeout=1.0),
+                     app_factory=FakeApp, overlay_fn=lambda *a, **kw: 0)
+    assert results[0].exit_code == 1
@@ -0,0 +1,110 @@
+from vmvm.clone import clone_config, clone_vm, flatten, CloneError
+from vmvm.config_parser import parse_config, ConfigParserError
+from .fake_qmp import FakeQMPServer
+import os
+import sys
+import yaml
+import pytest
+
+# records its arguments and creates the overlay file
+STUB_QEMU_IMG = '''#!{python}
+import sys
+with open({log!r}, 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+if sys.argv[1] == 'create':
+    open(sys.argv[-1], 'w').close()
+'''
+
+
+def test_clone_config():
+    conf = dict(name='golden', prototype='w11', disks=['system.img', {'file': 'data.qcow2', 'cache': 'none', 'format': 'qcow2', 'from': '/templates/data.qcow2'}],
+                os_install=['win.iso', '/isos/virtio.iso'], floppy='drivers.img')
+    clone = clone_config(conf, '/vms/golden', 'test-01')
+    assert clone['name'] == 'test-01'
+    assert clone['disks'] == [
+        {'file': 'system.qcow2', 'format': 'qcow2', 'base': '/vms/golden/system.img', 'base_format': 'raw'},
+        {'file': 'data.qcow2', 'cache': 'none', 'format': 'qcow2', 'base': '/vms/golden/data.qcow2', 'base_format': 'qcow2'},
+    ]
+    assert clone['os_install'] == ['/vms/golden/win.iso', '/isos/virtio.iso']
+    assert clone['floppy'] == '/vms/golden/drivers.img'
+    assert conf['name'] == 'golden'
+    o = parse_config(clone)
+    assert o.disks[0] == {'file': 'system.qcow2', 'format': 'qcow2', 'base': '/vms/golden/system.img', 'base_format': 'raw'}
+    with pytest.raises(CloneError):
+        clone_config(dict(name='golden', disk='/dev/sda'), '/vms/golden', 'x')
+    # template disks with the same stem get distinct overlays
+    clone = clone_config(dict(name='golden', disks=['a/disk.img', 'b/disk.qcow2']), '/vms/golden', 'x')
+    assert [ (d['file'], d['base']) for d in clone['disks'] ] == [ ('disk.qcow2', '/vms/golden/a/disk.img'), ('hd1-disk.qcow2', '/vms/golden/b/disk.qcow2') ]
+
+
+def test_clone_config_shares():
+    conf = dict(name='golden', disks=['system.img'], share_dir_as_fsd=['src', {'path': '~/data', 'tag': 'data'}, {'path': '/srv/www', 'tag': 'www'}],
+                share_dir_as_fat='fat', share_dir_as_floppy='drivers', log_file={'path': 'logs/qemu.log', 'backups': 2})
+    clone = clone_config(conf, '/vms/golden', 'test-01')
+    assert clone['share_dir_as_fsd'] == ['/vms/golden/src', {'path': os.path.expanduser('~/data'), 'tag': 'data'}, {'path': '/srv/www', 'tag': 'www'}]
+    assert (clone['share_dir_as_fat'], clone['share_dir_as_floppy']) == ('/vms/golden/fat', '/vms/golden/drivers')
+    assert clone['log_file'] == {'path': '/vms/golden/logs/qemu.log', 'backups': 2}
+    assert clone_config(dict(conf, share_dir_as_fsd='src', log_file='qemu.log'), '/vms/golden', 'x')['share_dir_as_fsd'] == '/vms/golden/src'
+    assert clone_config(dict(name='golden', log_file='qemu.log'), '/vms/golden', 'x')['log_file'] == '/vms/golden/qemu.log'
+    o = parse_config(clone)
+    assert [ share['path'] for share in o.share_dir_as_fsd ] == ['/vms/golden/src', os.path.expanduser('~/data'), '/srv/www']
+
+
+def test_base_requires_qcow2_overlay():
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='x', disks=[{'file': 'system.img', 'base': 'golden.qcow2'}]))
+
+
+def test_clone_vm(tmp_path, monkeypatch):
+    log = tmp_path / 'qemu-img.log'
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    stub = bin_dir / 'qemu-img'
+    stub.write_text(STUB_QEMU_IMG.format(python=sys.executable, log=str(log)))
+    stub.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}:{os.environ["PATH"]}')
+
+    golden = tmp_path / 'golden'
+    golden.mkdir()
+    (golden / 'vmconfig.yml').write_text('name: golden-test-template\nprototype: linux\ndisk: { file: system.img, format: qcow2 }\nspice: none\n')
+    (golden / 'system.img').write_bytes(b'QFI\xfb')
+    (golden / 'OVMF_VARS.fd').write_bytes(b'vars')
+    new_dir = tmp_path / 'clones' / 'web-01'
+
+    assert clone_vm(str(golden), str(new_dir)) == 0
+
+    conf = yaml.safe_load((new_dir / 'vmconfig.yml').read_text())
+    assert conf['name'] == 'web-01'
+    assert conf['disks'] == [{'file': 'system.qcow2', 'format': 'qcow2', 'base': str(golden / 'system.img'), 'base_format': 'qcow2'}]
+    assert (new_dir / 'OVMF_VARS.fd').read_bytes() == b'vars'
+    assert log.read_text() == f'create -f qcow2 -b {golden / "system.img"} -F qcow2 system.qcow2\n'
+    assert not (os.stat(golden / 'system.img').st_mode & 0o222)
+    with pytest.raises(CloneError):
+        clone_vm(str(golden), str(new_dir))
+
+
+def test_flatten(tmp_path):
+    sock = tmp_path / 'qmp.sock'
+    polls = []
+    def query_jobs(args):
+        polls.append(1)
+        if len(polls) < 2:
+            return [{'id': 'flatten-hd0', 'type': 'stream', 'status': 'running', 'current-progress': 1, 'total-progress': 2},
+                    {'id': 'flatten-hd2', 'type': 'stream', 'status': 'running', 'current-progress': 0, 'total-progress': 2}]
+        return [{'id': 'flatten-hd0', 'type': 'stream', 'status': 'concluded', 'current-progress': 2, 'total-progress': 2},
+                {'id': 'flatten-hd2', 'type': 'stream', 'status': 'concluded', 'current-progress': 2, 'total-progress': 2}]
+    with FakeQMPServer(sock, {'block-stream': {}, 'query-jobs': query_jobs, 'job-dismiss': {}}) as server:
+        flatten(str(sock), ['hd0', 'hd2'])
+    assert server.executed('block-stream') == [
+        {'job-id': 'flatten-hd0', 'device': 'hd0', 'auto-dismiss': False},
+        {'job-id': 'flatten-hd2', 'device': 'hd2', 'auto-dismiss': False},
+    ]
+    assert server.executed('job-dismiss') == [{'id': 'flatten-hd0'}, {'id': 'flatten-hd2'}]
+
+
+def test_flatten_error(tmp_path):
+    sock = tmp_path / 'qmp.sock'
+    jobs = [{'id': 'flatten-hd0', 'type': 'stream', 'status': 'concluded', 'current-progress': 0, 'total-progress': 2, 'error': 'No space left on device'}]
+    with FakeQMPServer(sock, {'block-stream': {}, 'query-jobs': jobs, 'job-dismiss': {}}):
+        with pytest.raises(CloneError, match='hd0: No space left on device'):
+            flatten(str(sock), ['hd0'])
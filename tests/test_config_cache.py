@@ -0,0 +1,116 @@
+from vmvm.config_cache import ConfigCache, CACHE_FILE_NAME
+from vmvm.config_parser import parse_config, load_config
+from vmvm.builder import RuntimeOptions, CommonArgsBuildResult, ExecCommand
+
+
+def make_config(tmp_path, text='name: foo\ncpus: 2\n'):
+    conf = tmp_path / 'vmconfig.yml'
+    conf.write_text(text)
+    return str(conf)
+
+
+def counting_parser(calls: list):
+    def parse(conf_bytes):
+        calls.append(1)
+        return parse_config(load_config(conf_bytes))
+    return parse
+
+
+def test_options_cached(tmp_path):
+    conf = make_config(tmp_path)
+    calls = []
+
+    cache = ConfigCache(conf)
+    o = cache.options(counting_parser(calls))
+    cache.save()
+    assert (tmp_path / CACHE_FILE_NAME).exists()
+
+    cache = ConfigCache(conf)
+    o_cached = cache.options(counting_parser(calls))
+    assert o_cached == o
+    assert len(calls) == 1
+
+    # any change of the config invalidates the cache
+    make_config(tmp_path, 'name: foo\ncpus: 3\n')
+    cache = ConfigCache(conf)
+    assert cache.options(counting_parser(calls)).cpus == 3
+    assert len(calls) == 2
+
+
+def test_options_cache_keyed_by_home(tmp_path, monkeypatch):
+    conf = make_config(tmp_path, 'name: foo\ndisks: [ ~/system.qcow2 ]\n')
+    monkeypatch.setenv('HOME', '/home/a')
+    cache = ConfigCache(conf)
+    assert cache.options(counting_parser([])).disks == ['/home/a/system.qcow2']
+    cache.save()
+    monkeypatch.setenv('HOME', '/home/b')
+    assert ConfigCache(conf).options(counting_parser([])).disks == ['/home/b/system.qcow2']
+
+
+def test_disabled(tmp_path):
+    conf = make_config(tmp_path)
+    calls = []
+    for _ in range(2):
+        cache = ConfigCache(conf, enabled=False)
+        cache.options(counting_parser(calls))
+        cache.save()
+    assert len(calls) == 2
+    assert not (tmp_path / CACHE_FILE_NAME).exists()
+
+
+def test_host_caps_and_argv_cached(tmp_path):
+    conf = make_config(tmp_path)
+    cache = ConfigCache(conf)
+    o = cache.options(counting_parser([]))
+    probes = []
+    assert cache.host_cap(o, 'has_io_uring', lambda: probes.append(1) or True) == True
+    cache.save()
+
+    cache = ConfigCache(conf)
+    o = cache.options(counting_parser([]))
+    assert cache.host_cap(o, 'has_io_uring', lambda: probes.append(1) or False) == True
+    assert len(probes) == 1
+
+    ro = RuntimeOptions(spice_port=5900, tpm_socket=None, has_cpu_topoext=False)
+    builds = []
+    def build():
+        builds.append(1)
+        return CommonArgsBuildResult(args=['-name', 'foo'], pre_commands=[], messages=[[20, 'control socket available']])
+    assert cache.build_args(o, 'run', ro, build).args == ['-name', 'foo']
+    cached = cache.build_args(o, 'run', ro, build)
+    assert cached.args == ['-name', 'foo']
+    # build messages are data, the launcher logs them on a cache hit too
+    assert cached.messages == [[20, 'control socket available']]
+    assert len(builds) == 1
+    # different runtime options or mode are different entries
+    cache.build_args(o, 'run', RuntimeOptions(spice_port=5901, tpm_socket=None, has_cpu_topoext=False), build)
+    cache.build_args(o, 'install', ro, build)
+    assert len(builds) == 3
+
+    # a value rejected by valid_fn is probed again
+    assert cache.host_cap(o, 'has_io_uring', lambda: probes.append(1) or False, valid_fn=lambda v: v == False) == False
+    assert cache.host_cap(o, 'has_io_uring', lambda: probes.append(1) or True, valid_fn=lambda v: v == False) == False
+    assert len(probes) == 2
+
+
+def test_argv_with_pre_commands_or_missing_firmware_rebuilt(tmp_path):
+    conf = make_config(tmp_path)
+    cache = ConfigCache(conf)
+    o = cache.options(counting_parser([]))
+    ro = RuntimeOptions(spice_port=5900, tpm_socket=None, has_cpu_topoext=False)
+    vars_fd = tmp_path / 'OVMF_VARS.fd'
+    builds = []
+    def build():
+        builds.append(1)
+        pre_commands = [] if vars_fd.exists() else [ExecCommand(exe='cp', args=['x', '.'])]
+        return CommonArgsBuildResult(args=['-drive', f'if=pflash,format=raw,file={vars_fd}'], pre_commands=pre_commands)
+
+    assert cache.build_args(o, 'run', ro, build).pre_commands
+    vars_fd.write_bytes(b'')
+    assert not cache.build_args(o, 'run', ro, build).pre_commands
+    cache.build_args(o, 'run', ro, build)
+    assert len(builds) == 2
+
+    vars_fd.unlink()
+    assert cache.build_args(o, 'run', ro, build).pre_commands
+    assert len(builds) == 3
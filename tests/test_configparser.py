@@ -50,4 +50,193 @@ def test_nokvm():
     o = parse_config(dict(name='foo',kvm=False))
 
     assert o.enable_kvm == False
-    assert o.cpu_model == 'max'
\ No newline at end of file
+    assert o.cpu_model == 'max'
+
+def test_topology():
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    o = parse_config(dict(name='foo', cpus=8, topology=dict(cores=4, threads=2)))
+    assert o.topology == dict(cores=4, threads=2)
+    o = parse_config(dict(name='foo', cpus=8, topology='host', cpu_pinning='auto'))
+    assert o.cpu_pinning == dict(vcpus='auto')
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', cpus=8, topology=dict(sockets=3, cores=2)))
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', cpu_pinning=dict(vcpu='0-3')))
+
+
+def test_hugepages():
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    o = parse_config(dict(name='foo', hugepages=True))
+    assert o.hugepages == dict(size='2M', prealloc=False, share=False, backend='memfd', fallback=False)
+    o = parse_config(dict(name='foo', hugepages=dict(size='1g', prealloc=True)))
+    assert o.hugepages['size'] == '1G' and o.hugepages['prealloc']
+    assert parse_config(dict(name='foo')).hugepages is None
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', hugepages='4M'))
+
+
+def test_disk_dict():
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    o = parse_config(dict(name='foo', disks=['a.qcow2', dict(file='~/b.qcow2', iothread='db', queues=2)]))
+    assert o.disks[0] == 'a.qcow2'
+    assert o.disks[1]['file'].endswith('/b.qcow2') and '~' not in o.disks[1]['file']
+    assert o.disks[1]['iothread'] == 'db'
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', disks=[dict(iothread=True)]))
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', disks=[dict(file='a.qcow2', queue=2)]))
+
+
+def test_disk_cache_aio():
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    o = parse_config(dict(name='foo', disk_cache='none', disks=['a.qcow2', dict(file='b.qcow2', aio='native')]))
+    assert o.disk_cache == 'none'
+    assert o.disks[1]['aio'] == 'native'
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', disks=[dict(file='a.qcow2', cache='directsync')]))
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', disk_aio='native', disk_cache='writeback'))
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', disk_cache='writeback', disks=[dict(file='a.qcow2', aio='native')]))
+
+
+def test_disk_iothread_queues_blk_only():
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    o = parse_config(dict(name='foo', disks=[dict(file='a.qcow2', iothread=True, queues=2)]))
+    assert o.disks[0]['queues'] == 2
+    o = parse_config(dict(name='foo', disk_virtio='scsi', disk_iothreads=True, disks=['a.qcow2']))
+    assert o.disk_iothreads
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', disk_virtio='scsi', disks=[dict(file='a.qcow2', iothread=True)]))
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', disk_virtio='scsi', disks=[dict(file='a.qcow2', queues=4)]))
+
+
+def test_disk_qcow2_options():
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    o = parse_config(dict(name='foo', disks=[
+        dict(file='db.qcow2', size='500G', cluster_size='128K', preallocation='metadata', lazy_refcounts=True, extended_l2=True,
+             l2_cache='auto', cache_clean_interval=900),
+        dict(file='logs.qcow2', l2_cache=False),
+        dict(file='scratch.qcow2', l2_cache='8M'),
+    ]))
+    assert o.disks[0] == dict(file='db.qcow2', size=500 << 30, cluster_size=128 << 10, preallocation='metadata', lazy_refcounts=True,
+                              extended_l2=True, l2_cache='auto', cache_clean_interval=900)
+    assert o.disks[1]['l2_cache'] is None
+    assert o.disks[2]['l2_cache'] == 8 << 20
+
+    for disk in [ dict(file='data.raw', cluster_size='64K'),
+                  dict(file='a.qcow2', cluster_size='96K'),
+                  dict(file='a.qcow2', cluster_size='4K', extended_l2=True),
+                  dict(file='a.qcow2', preallocation='sparse') ]:
+        with pytest.raises(ConfigParserError):
+            parse_config(dict(name='foo', disks=[disk]))
+
+
+def test_shared_dirs():
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    o = parse_config(dict(name='foo', share_dir_as_fsd='src'))
+    assert o.share_dir_as_fsd == [ dict(path='src', tag='hostshare', transport='virtiofs', cache='auto', thread_pool_size=None) ]
+    o = parse_config(dict(name='foo', share_dir_as_fsd=[ 'src', dict(path='/data', cache='always', thread_pool_size=0),
+                                                         dict(path='/old', tag='old', transport='9p') ]))
+    assert [ s['tag'] for s in o.share_dir_as_fsd ] == ['hostshare', 'hostshare1', 'old']
+
+    for shares in [ dict(tag='x'), dict(path='a', cache='loose'), dict(path='a', transport='nfs'), dict(path='a', thread_pool_size=-1),
+                    dict(path='a', transport='9p', thread_pool_size=4), dict(path='a', dax='2G'), [ dict(path='a', tag='t'), dict(path='b', tag='t') ] ]:
+        with pytest.raises(ConfigParserError):
+            parse_config(dict(name='foo', share_dir_as_fsd=shares))
+
+
+def test_net():
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    assert parse_config(dict(name='foo')).net is None
+    o = parse_config(dict(name='foo', cpus=4, net=[ 'user', dict(type='tap', ifname='tap0'), dict(type='bridge', bridge='br0', model='e1000') ]))
+    assert o.net[0] == dict(type='user', model='virtio', ifname=None, bridge=None, queues=1, vhost=False, mac=None, forward_ports=[])
+    assert o.net[1]['queues'] == 4 and o.net[1]['vhost'] == True
+    # stable per VM and NIC
+    assert o.net[1]['mac'] == parse_config(dict(name='foo', cpus=4, net=[ 'user', dict(type='tap', ifname='tap0') ])).net[1]['mac']
+    assert o.net[1]['mac'] != o.net[2]['mac']
+
+    # `net: passt` takes over nic_forward_ports
+    o = parse_config(dict(name='foo', nic_forward_ports=[ dict(host=2222, guest=22), dict(host=5353, guest=53, proto='udp') ], net='passt'))
+    assert o.net[0]['type'] == 'passt' and len(o.net[0]['forward_ports']) == 2
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', nic_forward_ports=[ dict(host=2222, guest=22, proto='sctp') ]))
+
+    for net in [ 'vde', dict(type='tap'), dict(type='passt', queues=2), dict(type='bridge', bridge='br0', queues=2), dict(type='user', ifname='tap0'),
+                 dict(type='tap', ifname='tap0', queues=0), dict(type='tap', ifname='tap0', mac='52:54:00') ]:
+        with pytest.raises(ConfigParserError):
+            parse_config(dict(name='foo', cpus=4, net=net))
+
+
+def test_balloon():
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    assert parse_config(dict(name='foo', ram='4G')).balloon is None
+    o = parse_config(dict(name='foo', ram='4G', balloon=True))
+    assert o.balloon == dict(free_page_reporting=True, deflate_on_oom=True, auto=False, min=2 << 30)
+    assert not o.qmp_enabled
+    o = parse_config(dict(name='foo', ram='4G', balloon=dict(auto=True, min='1G')))
+    assert o.balloon['min'] == 1 << 30
+    # the controller talks QMP
+    assert o.qmp_enabled
+
+    for balloon in [ 'yes', dict(target='1G'), dict(min='8G') ]:
+        with pytest.raises(ConfigParserError):
+            parse_config(dict(name='foo', ram='4G', balloon=balloon))
+
+
+def test_disk_format():
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    o = parse_config(dict(name='foo', disks=[{'file': 'system.img', 'format': 'qcow2', 'cluster_size': '2M'}]))
+    assert o.disks[0]['format'] == 'qcow2'
+    o = parse_config(dict(name='foo', disks=[{'file': 'system.qcow2', 'base': 'golden.img', 'base_format': 'raw'}]))
+    assert o.disks[0]['base_format'] == 'raw'
+    for disk in [ {'file': 'system.img', 'format': 'iso'}, {'file': 'system.qcow2', 'format': 'raw', 'l2_cache': '4M'},
+                  {'file': 'system.qcow2', 'base': 'golden.img', 'base_format': 'iso'}, {'file': 'system.qcow2', 'base_format': 'raw'} ]:
+        with pytest.raises(ConfigParserError):
+            parse_config(dict(name='foo', disks=[disk]))
+
+
+def test_disk_from():
+    import os
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    o = parse_config(dict(name='foo', disks=[{'file': 'system.qcow2', 'from': '~/templates/debian.qcow2'}]))
+    assert o.disks[0]['from'] == os.environ['HOME'] + '/templates/debian.qcow2'
+    assert o.disks[0]['format'] == 'qcow2'
+    # a copy of a raw image stays raw, whatever its name
+    o = parse_config(dict(name='foo', disks=[{'file': 'system.qcow2', 'from': 'debian.img'}]))
+    assert o.disks[0]['format'] == 'raw'
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', disks=[{'file': 'system.qcow2', 'from': 'a.qcow2', 'base': 'b.qcow2'}]))
+
+
+def test_guest_agent():
+    import pytest
+    from vmvm.config_parser import ConfigParserError
+
+    assert not parse_config(dict(name='foo')).guest_agent
+    assert parse_config(dict(name='foo', guest_agent=True)).guest_agent
+    with pytest.raises(ConfigParserError):
+        parse_config(dict(name='foo', guest_agent='yes'))
@@ -0,0 +1,65 @@
+from vmvm.cpu_pinning import make_pinning_plan, apply_pinning, CpuPinningError
+from vmvm.hw_caps import HostTopology, HostCpu
+from .fake_qmp import FakeQMPServer
+import pytest
+
+
+def host_1s4c2t() -> HostTopology:
+    return HostTopology(cpus=[HostCpu(cpu=cpu, package=0, core=cpu % 4) for cpu in range(8)], sockets=1, cores=4, threads=2)
+
+
+def test_plan_auto_skips_emulator_cpus():
+    plan = make_pinning_plan({'vcpus': 'auto', 'emulator': '0,4'}, 4, host_1s4c2t())
+    assert plan.vcpus == [1, 5, 2, 6]
+    assert plan.emulator == [0, 4]
+
+
+def test_plan_explicit():
+    plan = make_pinning_plan({'vcpus': '4-7'}, 4, host_1s4c2t())
+    assert plan.vcpus == [4, 5, 6, 7]
+    assert plan.emulator == []
+
+
+def test_plan_errors():
+    with pytest.raises(CpuPinningError):
+        make_pinning_plan({'vcpus': '0-1'}, 4, host_1s4c2t())
+    with pytest.raises(CpuPinningError):
+        make_pinning_plan({'vcpus': '6-9'}, 4, host_1s4c2t())
+    with pytest.raises(CpuPinningError):
+        make_pinning_plan({'vcpus': 'auto'}, 16, host_1s4c2t())
+
+
+def test_apply_pinning(tmp_path):
+    sock = tmp_path / 'qmp.sock'
+    cpus_fast = [ {'cpu-index': idx, 'thread-id': 1000 + idx, 'qom-path': f'/machine/unattached/device[{idx}]'} for idx in range(2) ]
+    affinity = {}
+    plan = make_pinning_plan({'vcpus': '2,3', 'emulator': '0-1'}, 2, host_1s4c2t())
+    with FakeQMPServer(sock, {'query-status': {'status': 'running', 'running': True}, 'query-cpus-fast': cpus_fast}):
+        pinned = apply_pinning(plan, str(sock), qemu_pid=999,
+                               setaffinity_fn=lambda tid, cpus: affinity.__setitem__(tid, cpus),
+                               listthreads_fn=lambda pid: [999, 1000, 1001, 1002])
+    assert pinned == {1000: 2, 1001: 3}
+    assert affinity == {1000: {2}, 1001: {3}, 999: {0, 1}, 1002: {0, 1}}
+
+
+def test_apply_pinning_no_qmp(tmp_path):
+    plan = make_pinning_plan({'vcpus': '2,3'}, 2, host_1s4c2t())
+    with pytest.raises(CpuPinningError):
+        apply_pinning(plan, str(tmp_path / 'missing.sock'), qemu_pid=1, timeout=0.3)
+
+
+def test_apply_pinning_iothreads(tmp_path):
+    sock = tmp_path / 'qmp.sock'
+    cpus_fast = [ {'cpu-index': 0, 'thread-id': 1000} ]
+    iothreads = [ {'id': 'iothread-db', 'thread-id': 2000}, {'id': 'iothread1', 'thread-id': 2001} ]
+    affinity = {}
+    plan = make_pinning_plan({'vcpus': '2', 'emulator': '0', 'iothreads': {'iothread-db': '1,5'}}, 1, host_1s4c2t())
+    with FakeQMPServer(sock, {'query-status': {}, 'query-cpus-fast': cpus_fast, 'query-iothreads': iothreads}):
+        apply_pinning(plan, str(sock), qemu_pid=999,
+                      setaffinity_fn=lambda tid, cpus: affinity.__setitem__(tid, cpus),
+                      listthreads_fn=lambda pid: [999, 1000, 2000, 2001])
+    # iothread1 is not listed so it is treated as an emulator thread
+    assert affinity == {1000: {2}, 2000: {1, 5}, 999: {0}, 2001: {0}}
+
+    plan = make_pinning_plan({'vcpus': '2', 'iothreads': '3'}, 1, host_1s4c2t())
+    assert plan.iothreads == {'*': [3]}
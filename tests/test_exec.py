@@ -0,0 +1,78 @@
+from vmvm.exec import exec_with_trace, RingBuffer, RotatingLogFile, OutputPump
+import logging
+import os
+import sys
+import threading
+import pytest
+
+
+def test_ring_buffer():
+    rb = RingBuffer(8)
+    rb.write(b'0123')
+    rb.write(b'456789ab')
+    assert rb.getvalue() == b'456789ab'
+
+
+def test_rotating_log_file(tmp_path):
+    path = str(tmp_path / 'qemu.log')
+    f = RotatingLogFile(path, max_bytes=10, backups=2)
+    for chunk in [b'aaaaaaaa\n', b'bbbbbbbb\n', b'cccccccc\n', b'dddddddd\n']:
+        f.write(chunk)
+    f.close()
+    assert open(path, 'rb').read() == b'dddddddd\n'
+    assert open(path + '.1', 'rb').read() == b'cccccccc\n'
+    assert open(path + '.2', 'rb').read() == b'bbbbbbbb\n'
+    assert not os.path.exists(path + '.3')
+
+
+def test_exec_undecodable_output_and_log_file(tmp_path, caplog):
+    log_path = str(tmp_path / 'out.log')
+    script = "import sys; sys.stdout.buffer.write(b'hello\\n\\xff\\xfe broken\\nno newline'); sys.exit(3)"
+    with caplog.at_level(logging.INFO):
+        exit_code = exec_with_trace(sys.executable, ['-c', script], log_file=dict(path=log_path, max_size=1 << 20, backups=1))
+    assert exit_code == 3
+    assert open(log_path, 'rb').read() == b'hello\n\xff\xfe broken\nno newline'
+    messages = [r.getMessage() for r in caplog.records]
+    assert 'hello' in messages
+    assert '�� broken' in messages
+    assert 'no newline' in messages
+    # tail is dumped on non-zero exit
+    assert any(m.startswith('last') and m.endswith('no newline') for m in messages)
+
+
+def test_exec_log_file_cannot_be_opened(tmp_path):
+    started = []
+    with pytest.raises(OSError):
+        exec_with_trace(sys.executable, ['-c', 'pass'], on_start=started.append,
+                        log_file=dict(path=str(tmp_path / 'missing' / 'out.log'), max_size=1 << 20, backups=1))
+    # nothing was spawned
+    assert started == []
+
+
+def test_pump_does_not_block_when_logging_stalls(caplog):
+    """ the writer must be able to finish even if the logging handler hangs """
+    release = threading.Event()
+    class StalledHandler(logging.Handler):
+        def emit(self, record):
+            release.wait()
+    handler = StalledHandler()
+    logging.getLogger().addHandler(handler)
+    caplog.set_level(logging.INFO)
+    try:
+        r, w = os.pipe()
+        pump = OutputPump(r, ring_buffer_size=1024)
+        pump.start()
+        line = b'x' * 99 + b'\n'
+        writer = threading.Thread(target=lambda: [os.write(w, line * 100) for _ in range(500)])
+        writer.start()
+        writer.join(timeout=10)
+        assert not writer.is_alive()
+        os.close(w)
+        release.set()
+        pump.join()
+        os.close(r)
+    finally:
+        logging.getLogger().removeHandler(handler)
+    assert pump.dropped_lines > 0
+    assert len(pump.ring_buffer.getvalue()) == 1024
+    assert pump.ring_buffer.getvalue().endswith(line)
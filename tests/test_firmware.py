@@ -0,0 +1,73 @@
+from vmvm.firmware import read_firmware_descriptors, read_firmware_index, firmware_index_valid, select_firmware
+import json
+import os
+
+
+def write_descriptor(d, name, fw_dir, code, vars_template, features, arch='x86_64', machines=('pc-q35-*',)):
+    for f in (code, vars_template):
+        (fw_dir / f).write_bytes(b'fw')
+    (d / name).write_text(json.dumps({
+        'interface-types': ['uefi'],
+        'mapping': {
+            'device': 'flash',
+            'executable': { 'filename': str(fw_dir / code), 'format': 'raw' },
+            'nvram-template': { 'filename': str(fw_dir / vars_template), 'format': 'raw' },
+        },
+        'targets': [ { 'architecture': arch, 'machines': list(machines) } ],
+        'features': features,
+    }))
+
+
+def make_dirs(tmp_path):
+    dirs = [ tmp_path / 'user', tmp_path / 'etc', tmp_path / 'share' ]
+    for d in dirs + [ tmp_path / 'fw' ]:
+        d.mkdir()
+    return dirs, tmp_path / 'fw'
+
+
+def test_read_descriptors_precedence(tmp_path):
+    (user, etc, share), fw = make_dirs(tmp_path)
+    write_descriptor(share, '50-ovmf-sb.json', fw, 'CODE.secboot.fd', 'VARS.ms.fd', ['requires-smm', 'secure-boot', 'enrolled-keys'])
+    write_descriptor(share, '60-ovmf.json', fw, 'CODE.fd', 'VARS.fd', [])
+    write_descriptor(share, '40-ovmf-sev.json', fw, 'CODE.sev.fd', 'VARS.fd', ['amd-sev'])
+    write_descriptor(share, '70-aavmf.json', fw, 'AAVMF_CODE.fd', 'AAVMF_VARS.fd', [], arch='aarch64', machines=['virt-*'])
+    # overridden by /etc, masked by an empty user file
+    write_descriptor(etc, '60-ovmf.json', fw, 'CODE.4m.fd', 'VARS.4m.fd', [])
+    (user / '70-aavmf.json').write_text('')
+    (share / '80-broken.json').write_text('{')
+    # BIOS descriptors are ignored
+    (share / '90-seabios.json').write_text(json.dumps({ 'interface-types': ['bios'], 'mapping': { 'device': 'memory', 'filename': 'bios.bin' } }))
+
+    firmware = read_firmware_descriptors([str(user), str(etc), str(share)])
+    assert [ f['name'] for f in firmware ] == ['40-ovmf-sev.json', '50-ovmf-sb.json', '60-ovmf.json']
+    assert firmware[2]['code'] == str(fw / 'CODE.4m.fd')
+
+
+def test_select_firmware(tmp_path):
+    (user, etc, share), fw = make_dirs(tmp_path)
+    write_descriptor(share, '40-ovmf-sev.json', fw, 'CODE.sev.fd', 'VARS.fd', ['amd-sev'])
+    write_descriptor(share, '50-ovmf-sb.json', fw, 'CODE.secboot.fd', 'VARS.fd', ['requires-smm', 'secure-boot'])
+    write_descriptor(share, '51-ovmf-sb-ms.json', fw, 'CODE.secboot.fd', 'VARS.ms.fd', ['requires-smm', 'secure-boot', 'enrolled-keys'])
+    write_descriptor(share, '60-ovmf.json', fw, 'CODE.fd', 'VARS.fd', ['verbose-dynamic'])
+    write_descriptor(share, '70-aavmf.json', fw, 'AAVMF_CODE.fd', 'AAVMF_VARS.fd', [], arch='aarch64', machines=['virt-*'])
+    firmware = read_firmware_descriptors([str(share)])
+
+    assert select_firmware(firmware, 'x86_64', 'q35', secure_boot=False)['name'] == '60-ovmf.json'
+    assert select_firmware(firmware, 'x86_64', 'q35', secure_boot=True)['name'] == '51-ovmf-sb-ms.json'
+    assert select_firmware(firmware, 'x86_64', 'q35', secure_boot=False, features=['amd-sev'])['name'] == '40-ovmf-sev.json'
+    assert select_firmware(firmware, 'x86_64', 'pc-q35-8.2', secure_boot=False)['name'] == '60-ovmf.json'
+    assert select_firmware(firmware, 'aarch64', 'virt', secure_boot=False)['name'] == '70-aavmf.json'
+    assert select_firmware(firmware, 'x86_64', 'pc', secure_boot=False) is None
+    assert select_firmware(firmware, 'x86_64', 'q35', secure_boot=False, features=['no-such-feature']) is None
+
+
+def test_firmware_index_stamp(tmp_path):
+    (user, etc, share), fw = make_dirs(tmp_path)
+    dirs = [str(etc), str(share)]
+    index = json.loads(json.dumps(read_firmware_index(dirs)))
+    assert index['firmware'] == []
+    assert firmware_index_valid(index, dirs)
+    write_descriptor(share, '60-ovmf.json', fw, 'CODE.fd', 'VARS.fd', [])
+    os.utime(share, ns=(0, 1))
+    assert not firmware_index_valid(index, dirs)
+
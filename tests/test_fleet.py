@@ -0,0 +1,135 @@
+from vmvm.fleet import expand_targets, run_fleet, qmp_fleet, fleet_main, FleetError
+from .fake_qmp import FakeQMPServer
+import os
+import sys
+import threading
+import pytest
+
+STUB_QEMU = '''#!{python}
+import os, sys
+# exit code is taken from the VM directory, which must be the working directory
+sys.exit(int(open('exit_code').read()) if os.path.exists('exit_code') else 0)
+'''
+
+
+def make_vm(root, name, exit_code=None):
+    d = root / name
+    d.mkdir()
+    (d / 'vmconfig.yml').write_text(f'name: {name}\narch: x86_64\ncpus: 1\ndisk: system.qcow2\nspice: none\n')
+    if exit_code is not None:
+        (d / 'exit_code').write_text(str(exit_code))
+    return str(d)
+
+
+def test_expand_targets(tmp_path):
+    a = make_vm(tmp_path, 'lab-a')
+    b = make_vm(tmp_path, 'lab-b')
+    (tmp_path / 'not-a-vm').mkdir()
+    assert expand_targets([str(tmp_path / 'lab-*'), a]) == [a, b]
+    with pytest.raises(FleetError):
+        expand_targets([str(tmp_path / 'not-a-vm')])
+    with pytest.raises(FleetError):
+        expand_targets([str(tmp_path / 'nothing-*')])
+
+
+def test_run_fleet_throttles_boots():
+    running = []
+    lock = threading.Lock()
+    release = threading.Event()
+    max_seen = [0]
+
+    class FakeApp:
+        def __init__(self, vm_dir, use_cache=True):
+            self.vm_dir = vm_dir
+            self.on_started = None
+
+        def act_run(self):
+            with lock:
+                running.append(self.vm_dir)
+                max_seen[0] = max(max_seen[0], len(running))
+            self.on_started(None)
+            release.wait(10)
+            with lock:
+                running.remove(self.vm_dir)
+            return 0 if self.vm_dir != 'vm3' else 5
+
+    dirs = [ f'vm{i}' for i in range(6) ]
+    result = {}
+    t = threading.Thread(target=lambda: result.update(run_fleet(dirs, max_boots=2, boot_window=60, app_factory=FakeApp)))
+    t.start()
+    # boot window never expires here, so only the first two VMs may be launched until they exit
+    threading.Event().wait(0.3)
+    assert len(running) == 2
+    release.set()
+    t.join(10)
+    assert max_seen[0] == 2
+    assert result == { d: (5 if d == 'vm3' else 0) for d in dirs }
+
+
+def test_run_fleet_boot_window_expires():
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    class FakeApp:
+        def __init__(self, vm_dir, use_cache=True):
+            self.on_started = None
+
+        def act_run(self):
+            self.on_started(None)
+            started.release()
+            release.wait(10)
+            return 0
+
+    t = threading.Thread(target=run_fleet, args=([ 'a', 'b', 'c' ],), kwargs=dict(max_boots=1, boot_window=0.01, app_factory=FakeApp))
+    t.start()
+    # all VMs run concurrently once each boot window has passed
+    for _ in range(3):
+        assert started.acquire(timeout=5)
+    release.set()
+    t.join(10)
+
+
+def test_run_fleet_isolates_failures():
+    class FakeApp:
+        def __init__(self, vm_dir, use_cache=True):
+            if vm_dir == 'bad':
+                raise SystemExit(1)
+            self.on_started = None
+
+        def act_run(self):
+            return 0
+
+    assert run_fleet(['good', 'bad'], app_factory=FakeApp) == { 'good': 0, 'bad': 1 }
+
+
+def test_fleet_run_resolves_paths_per_vm(tmp_path, monkeypatch, capsys):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    stub = bin_dir / 'qemu-system-x86_64'
+    stub.write_text(STUB_QEMU.format(python=sys.executable))
+    stub.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}:{os.environ["PATH"]}')
+    vms = tmp_path / 'vms'
+    vms.mkdir()
+    make_vm(vms, 'ok1')
+    make_vm(vms, 'ok2', exit_code=0)
+    make_vm(vms, 'broken', exit_code=3)
+    cwd = os.getcwd()
+
+    exit_code = fleet_main(['run', str(vms / '*'), '--max-boots', '2', '--boot-window', '0', '--no-cache'])
+
+    assert exit_code == 1
+    assert os.getcwd() == cwd
+    out = capsys.readouterr().out
+    assert 'broken                   exit code 3' in out
+    assert 'ok1                      exit code 0' in out
+    assert 'ok2                      exit code 0' in out
+
+
+def test_qmp_fleet(tmp_path):
+    sock = tmp_path / 'a.sock'
+    with FakeQMPServer(sock, { 'query-status': { 'status': 'running', 'running': True } }):
+        socks = { 'a': str(sock), 'b': str(tmp_path / 'b.sock') }
+        results = qmp_fleet(['a', 'b'], 'query-status', sock_fn=lambda d, _: socks[d])
+    assert results['a'] == (True, { 'status': 'running', 'running': True })
+    assert results['b'] == (False, 'not running')
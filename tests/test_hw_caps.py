@@ -0,0 +1,97 @@
+from vmvm.hw_caps import read_host_topology, read_hugepage_pools, check_hugepages, find_hugetlbfs_mount, check_qemu_io_uring
+from vmvm.utils import parse_cpu_list
+import os
+
+
+def make_fake_sysfs(root, cpus: list[tuple[int, int, int]], online: str | None = None):
+    """ cpus: list of (cpu, package, core) """
+    cpu_dir = root / 'devices' / 'system' / 'cpu'
+    for cpu, package, core in cpus:
+        topo = cpu_dir / f'cpu{cpu}' / 'topology'
+        topo.mkdir(parents=True)
+        (topo / 'physical_package_id').write_text(f'{package}\n')
+        (topo / 'core_id').write_text(f'{core}\n')
+    if online is not None:
+        (cpu_dir / 'online').write_text(online + '\n')
+    return str(root)
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list('0-3,8,10-11') == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpu_list(5) == [5]
+    assert parse_cpu_list([1, '4-5']) == [1, 4, 5]
+
+
+def test_topology_smt(tmp_path):
+    # 1 socket, 4 cores, 2 threads; siblings are N and N+4 like on most x86 hosts
+    sysfs = make_fake_sysfs(tmp_path, [(cpu, 0, cpu % 4) for cpu in range(8)], online='0-7')
+    t = read_host_topology(sysfs)
+    assert (t.sockets, t.cores, t.threads) == (1, 4, 2)
+    assert t.sibling_ordered() == [0, 4, 1, 5, 2, 6, 3, 7]
+
+
+def test_topology_two_sockets_no_online_file(tmp_path):
+    sysfs = make_fake_sysfs(tmp_path, [(0, 0, 0), (1, 0, 1), (2, 1, 0), (3, 1, 1)])
+    t = read_host_topology(sysfs)
+    assert (t.sockets, t.cores, t.threads) == (2, 2, 1)
+
+
+def test_topology_offline_cpus_skipped(tmp_path):
+    sysfs = make_fake_sysfs(tmp_path, [(cpu, 0, cpu // 2) for cpu in range(4)], online='0-1')
+    t = read_host_topology(sysfs)
+    assert [c.cpu for c in t.cpus] == [0, 1]
+    assert (t.sockets, t.cores, t.threads) == (1, 1, 2)
+
+
+def make_fake_hugepages(root, pools: dict[int, tuple[int, int, int]]):
+    """ pools: page size in kB -> (nr, free, resv) """
+    for size_kb, (nr, free, resv) in pools.items():
+        d = root / 'kernel' / 'mm' / 'hugepages' / f'hugepages-{size_kb}kB'
+        d.mkdir(parents=True)
+        (d / 'nr_hugepages').write_text(f'{nr}\n')
+        (d / 'free_hugepages').write_text(f'{free}\n')
+        (d / 'resv_hugepages').write_text(f'{resv}\n')
+    return str(root)
+
+
+def test_hugepage_pools(tmp_path):
+    sysfs = make_fake_hugepages(tmp_path, {2048: (4096, 4000, 100), 1048576: (0, 0, 0)})
+    pools = read_hugepage_pools(sysfs)
+    assert pools[2 << 20].available == 3900
+    assert pools[1 << 30].total == 0
+
+    assert check_hugepages('4G', '2M', sysfs) is None
+    assert 'need 4096' in check_hugepages('8G', '2M', sysfs)
+    assert check_hugepages('1G', '1G', sysfs) is not None
+    assert read_hugepage_pools(str(tmp_path / 'nonexistent')) == {}
+
+
+def test_hugetlbfs_mount(tmp_path):
+    mounts = tmp_path / 'mounts'
+    mounts.write_text(
+        'proc /proc proc rw,nosuid,nodev,noexec,relatime 0 0\n'
+        'hugetlbfs /dev/hugepages1G hugetlbfs rw,relatime,pagesize=1024M 0 0\n'
+        'hugetlbfs /dev/hugepages hugetlbfs rw,relatime,pagesize=2M 0 0\n'
+    )
+    assert find_hugetlbfs_mount('2M', str(mounts)) == '/dev/hugepages'
+    assert find_hugetlbfs_mount('1G', str(mounts)) == '/dev/hugepages1G'
+
+
+def test_qemu_io_uring_missing_binary():
+    assert check_qemu_io_uring('/nonexistent/qemu-img') == False
+
+
+def test_qemu_io_uring_probe():
+    import subprocess
+    calls = []
+    def run(args, returncode, stderr):
+        opts = dict(kv.split('=', 1) for kv in args[-1].split(','))
+        calls.append(opts)
+        # modern QEMU refuses character devices with the file driver, the probe must open a regular file
+        assert os.path.isfile(opts['filename'])
+        return subprocess.CompletedProcess(args, returncode, stderr=stderr)
+
+    assert check_qemu_io_uring(run_fn=lambda args, **kw: run(args, 0, ''))
+    assert not check_qemu_io_uring(run_fn=lambda args, **kw: run(args, 1, "qemu-img: Could not open 'driver=file': Unknown aio mode 'io_uring'\n"))
+    assert [ c['aio'] for c in calls ] == ['io_uring', 'io_uring']
+    assert not os.path.exists(calls[0]['filename'])
@@ -0,0 +1,149 @@
+from vmvm.image import (detect_image_format, convert_args, convert_image, compact_image, run_qemu_img, add_disk_to_config,
+                        image_main, ImageError)
+import os
+import sys
+import pytest
+
+# prints qemu-img style progress, fails if asked to convert "bad"
+STUB_QEMU_IMG = '''#!{python}
+import sys
+if 'bad' in sys.argv:
+    print('qemu-img: Could not open bad: No such file or directory', file=sys.stderr)
+    sys.exit(1)
+for p in ('0.00', '33.33', '66.67', '100.00'):
+    sys.stdout.write(f'    ({{p}}/100%)\\r')
+    sys.stdout.flush()
+print()
+'''
+
+
+def test_detect_image_format(tmp_path):
+    headers = {
+        'a.qcow2': b'QFI\xfb\0\0\0\x03',
+        'a.img': b'QFI\xfb\0\0\0\x03',              # qcow2 whatever the name
+        'a.vmdk': b'KDMV\x01\0\0\0',
+        'desc.vmdk': b'# Disk DescriptorFile\nversion=1\n',
+        'a.vhdx': b'vhdxfile',
+        'a.vhd': b'conectix',
+        'a.vdi': b'<<< Oracle VM VirtualBox Disk Image >>>\n'.ljust(0x40, b'\0') + b'\x7f\x10\xda\xbe',
+        'a.qed': b'QED\0',
+        'disk.raw': b'\xeb\x63\x90' + b'\0' * 509,
+        'empty.qcow2': b'',
+    }
+    for name, header in headers.items():
+        (tmp_path / name).write_bytes(header)
+    assert { name: detect_image_format(str(tmp_path / name)) for name in headers } == {
+        'a.qcow2': 'qcow2', 'a.img': 'qcow2', 'a.vmdk': 'vmdk', 'desc.vmdk': 'vmdk', 'a.vhdx': 'vhdx', 'a.vhd': 'vpc',
+        'a.vdi': 'vdi', 'a.qed': 'qed', 'disk.raw': 'raw', 'empty.qcow2': 'raw',
+    }
+    with pytest.raises(OSError):
+        detect_image_format(str(tmp_path / 'missing.qcow2'))
+
+
+def test_convert_args():
+    assert convert_args('in.vmdk', 'vmdk', 'out.qcow2') == [
+        'convert', '-p', '-f', 'vmdk', '-O', 'qcow2', '-m', '8', '-W', 'in.vmdk', 'out.qcow2' ]
+    assert convert_args('in.vdi', 'vdi', 'out.qcow2', coroutines=16, compress=True, cluster_size=2 << 20) == [
+        'convert', '-p', '-f', 'vdi', '-O', 'qcow2', '-m', '16', '-c', '-o', 'cluster_size=2097152,compression_type=zstd', 'in.vdi', 'out.qcow2' ]
+    assert convert_args('a.qcow2', 'qcow2', 'a.qcow2.compact', 'qcow2', backing='/golden.qcow2', backing_format='qcow2', bitmaps=True) == [
+        'convert', '-p', '-f', 'qcow2', '-O', 'qcow2', '-m', '8', '-W', '-B', '/golden.qcow2', '-F', 'qcow2', '--bitmaps', 'a.qcow2', 'a.qcow2.compact' ]
+
+
+def test_convert_image(tmp_path):
+    src = tmp_path / 'disk.vmdk'
+    src.write_bytes(b'KDMV')
+    dst = tmp_path / 'disk.qcow2'
+    calls = []
+    def run(args, on_progress):
+        calls.append(args)
+        on_progress(50.0)
+        with open(args[-1], 'wb') as f:
+            f.write(b'QFI\xfb')
+        return 0
+
+    convert_image(str(src), str(dst), run_fn=run, coroutines=4, preallocation='metadata')
+    assert calls == [ [ 'convert', '-p', '-f', 'vmdk', '-O', 'qcow2', '-m', '4', '-W', '-o', 'preallocation=metadata', str(src), f'{dst}.part' ] ]
+    assert dst.read_bytes() == b'QFI\xfb'
+    with pytest.raises(ImageError, match='already exists'):
+        convert_image(str(src), str(dst), run_fn=run)
+    with pytest.raises(ImageError, match='preallocated'):
+        convert_image(str(src), str(tmp_path / 'c.qcow2'), run_fn=run, compress=True, preallocation='falloc')
+
+    def fail(args, on_progress):
+        open(args[-1], 'wb').close()
+        return 1
+    with pytest.raises(ImageError):
+        convert_image(str(src), str(tmp_path / 'failed.qcow2'), run_fn=fail)
+    assert sorted(os.listdir(tmp_path)) == [ 'disk.qcow2', 'disk.vmdk' ]
+
+
+def test_compact_image(tmp_path):
+    image = tmp_path / 'system.qcow2'
+    image.write_bytes(b'QFI\xfb' + b'x' * 100000)
+    image.chmod(0o640)
+    calls = []
+    def run(args, on_progress):
+        calls.append(args)
+        with open(args[-1], 'wb') as f:
+            f.write(b'QFI\xfb')
+        return 0
+    info = { 'format': 'qcow2', 'cluster-size': 65536, 'backing-filename': '/golden/system.qcow2', 'backing-filename-format': 'qcow2' }
+
+    opened = []
+    def info_fn(path, fmt):
+        opened.append(fmt)
+        return info
+
+    before, after = compact_image(str(image), 'qcow2', compress=True, run_fn=run, info_fn=info_fn)
+    assert opened == [ 'qcow2' ]
+    assert calls == [ [ 'convert', '-p', '-f', 'qcow2', '-O', 'qcow2', '-m', '8', '-c', '-o', 'cluster_size=65536,compression_type=zstd',
+                        '-B', '/golden/system.qcow2', '-F', 'qcow2', '--bitmaps', str(image), f'{image}.compact' ] ]
+    assert image.read_bytes() == b'QFI\xfb'
+    assert image.stat().st_mode & 0o777 == 0o640
+    assert after <= before
+    assert sorted(os.listdir(tmp_path)) == [ 'system.qcow2' ]
+
+
+def test_compact_standalone_image(tmp_path, monkeypatch):
+    image = tmp_path / 'exported.vmdk'
+    image.write_bytes(b'KDMV\x01\0\0\0')
+    compacted = []
+    monkeypatch.setattr('vmvm.image.compact_image', lambda path, fmt, *args: compacted.append((path, fmt)) or (0, 0))
+    assert image_main([ 'compact', str(image) ]) == 0
+    # an image named on the command line is detected from its header, not taken as raw by its name
+    assert compacted == [ (str(image), 'vmdk') ]
+    assert image_main([ 'compact', str(tmp_path / 'missing.img') ]) == 1
+
+
+def test_add_disk_to_config(tmp_path):
+    conf = tmp_path / 'vmconfig.yml'
+    entry = '{file: imported.qcow2, format: qcow2}'
+    cases = [
+        ('name: a  # comment\n', f'name: a  # comment\ndisks:\n    - {entry}\n'),
+        ('disk: system.qcow2  # boot\nram: 4G\n', f'disk: [ system.qcow2, {entry} ]  # boot\nram: 4G\n'),
+        ('disks: [ a.qcow2 ]\n', f'disks: [ a.qcow2, {entry} ]\n'),
+        ('disks:\n  - a.qcow2  # boot\n  - file: b.img\n    cache: none\n\n# tail\nram: 4G\n',
+         f'disks:\n  - a.qcow2  # boot\n  - file: b.img\n    cache: none\n  - {entry}\n\n# tail\nram: 4G\n'),
+    ]
+    for before, after in cases:
+        conf.write_text(before)
+        assert add_disk_to_config(str(conf), 'imported.qcow2', 'qcow2')
+        assert conf.read_text() == after
+    conf.write_text('disk:\n  file: a.img\n')
+    assert not add_disk_to_config(str(conf), 'imported.qcow2', 'qcow2')
+    assert conf.read_text() == 'disk:\n  file: a.img\n'
+    assert not add_disk_to_config(str(tmp_path / 'missing.yml'), 'imported.qcow2', 'qcow2')
+
+
+def test_run_qemu_img_progress(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    stub = bin_dir / 'qemu-img'
+    stub.write_text(STUB_QEMU_IMG.format(python=sys.executable))
+    stub.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}:{os.environ["PATH"]}')
+
+    progress = []
+    assert run_qemu_img([ 'convert', 'in', 'out' ], progress.append) == 0
+    assert progress == [ 0.0, 33.33, 66.67, 100.0 ]
+    assert run_qemu_img([ 'convert', 'bad', 'out' ]) == 1
@@ -0,0 +1,99 @@
+from vmvm.metrics import MetricsCollector, MetricSet, read_proc_stats
+from vmvm.qmp import qmp_execute
+from .fake_qmp import FakeQMPServer
+import asyncio
+import os
+
+TICKS = os.sysconf('SC_CLK_TCK')
+PAGE = os.sysconf('SC_PAGE_SIZE')
+
+
+def make_proc(root, pid, comm='qemu-system-x86', utime=3 * TICKS, stime=TICKS, start=12345):
+    d = root / str(pid)
+    d.mkdir(parents=True)
+    # fields 3..22: state ppid pgrp session tty tpgid flags minflt cminflt majflt cmajflt utime stime cutime cstime priority nice threads itreal starttime
+    fields = ['S'] + ['0'] * 10 + [str(utime), str(stime), '0', '0', '20', '0', '7', '0', str(start)] + ['0'] * 30
+    (d / 'stat').write_text(f'{pid} ({comm}) ' + ' '.join(fields) + '\n')
+    (d / 'statm').write_text('1000 256 10 1 0 100 0\n')
+    (d / 'io').write_text('rchar: 1\nwchar: 2\nsyscr: 3\nsyscw: 4\nread_bytes: 4096\nwrite_bytes: 8192\ncancelled_write_bytes: 0\n')
+
+
+def test_read_proc_stats(tmp_path):
+    make_proc(tmp_path, 100)
+    make_proc(tmp_path, 200, comm='bash')
+    stats = read_proc_stats(100, str(tmp_path))
+    assert stats.cpu_seconds == 4.0
+    assert stats.rss_bytes == 256 * PAGE
+    assert stats.threads == 7
+    assert stats.start_ticks == 12345
+    assert (stats.read_bytes, stats.write_bytes) == (4096, 8192)
+    # pid reused by another program, or gone
+    assert read_proc_stats(200, str(tmp_path)) is None
+    assert read_proc_stats(300, str(tmp_path)) is None
+
+
+def test_render():
+    m = MetricSet()
+    m.add('vmvm_x_total', 'counter', 'X', {'vm': 'a"b'}, 1.5)
+    m.add('vmvm_x_total', 'counter', 'X', {'vm': 'c'}, 2)
+    m.add('vmvm_vms', 'gauge', 'VMs', {}, 2)
+    assert m.render() == (
+        '# HELP vmvm_x_total X\n'
+        '# TYPE vmvm_x_total counter\n'
+        'vmvm_x_total{vm="a\\"b"} 1.5\n'
+        'vmvm_x_total{vm="c"} 2\n'
+        '# HELP vmvm_vms VMs\n'
+        '# TYPE vmvm_vms gauge\n'
+        'vmvm_vms 2\n')
+
+
+def test_collect(tmp_path):
+    proc = tmp_path / 'proc'
+    runtime = tmp_path / 'run'
+    make_proc(proc, 100)
+    (runtime / 'vm1').mkdir(parents=True)
+    (runtime / 'vm1' / 'qemu.pid').write_text('100\n')
+    (runtime / 'stopped').mkdir()
+    handlers = {
+        'query-status': {'status': 'running', 'running': True},
+        'query-stats-schemas': [
+            {'provider': 'kvm', 'target': 'vm', 'stats': [{'name': 'remote_tlb_flush', 'type': 'cumulative', 'unit': 'boolean'},
+                                                         {'name': 'max_mmu_page_hash_collisions', 'type': 'peak'}]},
+            {'provider': 'kvm', 'target': 'vcpu', 'stats': [{'name': 'exits', 'type': 'cumulative'},
+                                                           {'name': 'halt_poll_fail_hist', 'type': 'log2-histogram'}]},
+        ],
+        'query-cpus-fast': [{'cpu-index': 0, 'qom-path': '/machine/unattached/device[0]', 'thread-id': 101}],
+        'query-blockstats': [{'device': '', 'node-name': 'hd0', 'qdev': '/machine/peripheral-anon/device[3]/virtio-backend',
+                              'stats': {'rd_bytes': 1024, 'wr_bytes': 2048, 'rd_operations': 2, 'wr_operations': 4, 'flush_operations': 1,
+                                        'rd_total_time_ns': 500000000, 'wr_total_time_ns': 0, 'flush_total_time_ns': 0}}],
+        'query-stats': lambda args: [{'provider': 'kvm', 'stats': [{'name': 'remote_tlb_flush', 'value': 5},
+                                                                    {'name': 'max_mmu_page_hash_collisions', 'value': 2}]}] if args['target'] == 'vm' else
+                                    [{'provider': 'kvm', 'qom-path': '/machine/unattached/device[0]',
+                                      'stats': [{'name': 'exits', 'value': 777}, {'name': 'halt_poll_fail_hist', 'value': [1, 2]}]}],
+        # no 'query-balloon': the VM has no balloon device
+    }
+    with FakeQMPServer(runtime / 'vm1' / 'qmp.sock', handlers) as server:
+        collector = MetricsCollector(runtime_dir=str(runtime), proc_root=str(proc))
+        first = asyncio.run(collector.collect()).render()
+        # the monitor serves one client at a time: the connection is not held between scrapes
+        assert qmp_execute(server.path, 'query-status', timeout=2) == handlers['query-status']
+        second = asyncio.run(collector.collect()).render()
+        # static data and unsupported commands are asked for only once
+        assert len(server.executed('query-stats-schemas')) == 1
+        assert len(server.executed('query-balloon')) == 1
+        assert len(server.executed('query-blockstats')) == 2
+        assert server.connections == 3
+    assert first == second
+    lines = first.splitlines()
+    assert 'vmvm_cpu_seconds_total{vm="vm1"} 4' in lines
+    assert f'vmvm_memory_rss_bytes{{vm="vm1"}} {256 * PAGE}' in lines
+    assert 'vmvm_process_written_bytes_total{vm="vm1"} 8192' in lines
+    assert 'vmvm_qmp_up{vm="vm1"} 1' in lines
+    assert 'vmvm_block_read_bytes_total{vm="vm1",device="hd0"} 1024' in lines
+    assert 'vmvm_block_read_time_seconds_total{vm="vm1",device="hd0"} 0.5' in lines
+    assert 'vmvm_kvm_vm_remote_tlb_flush_total{vm="vm1"} 5' in lines
+    assert '# TYPE vmvm_kvm_vm_max_mmu_page_hash_collisions gauge' in lines
+    assert 'vmvm_kvm_vcpu_exits_total{vm="vm1",vcpu="0"} 777' in lines
+    assert not any('halt_poll_fail_hist' in line for line in lines)
+    assert not any('balloon' in line for line in lines)
+    assert 'vmvm_vms 1' in lines
@@ -0,0 +1,34 @@
+from vmvm.passt_manager import PasstManager, PasstError, passt_args
+import pytest
+import os
+
+
+def fake_passt(tmp_path, body):
+    exe = tmp_path / 'passt'
+    exe.write_text(f'#!/bin/sh\nwhile [ $# -gt 0 ]; do [ "$1" = --socket ] && sock="$2"; shift; done\n{body}\n')
+    exe.chmod(0o755)
+    return lambda: str(exe)
+
+
+def test_passt_args():
+    net = dict(type='passt', forward_ports=[ dict(host=2222, guest=22), dict(host=8080, guest=80, proto='tcp'), dict(host=5353, guest=53, proto='udp') ])
+    assert passt_args(net, '/run/p.sock') == [ '--foreground', '--socket', '/run/p.sock', '-t', '2222:22,8080:80', '-u', '5353:53' ]
+    assert passt_args(dict(type='passt', forward_ports=[]), '/run/p.sock') == [ '--foreground', '--socket', '/run/p.sock' ]
+
+
+def test_passt_manager(tmp_path, monkeypatch):
+    monkeypatch.setattr('vmvm.passt_manager.get_passt_sock_path', lambda vm, idx: str(tmp_path / f'passt-{idx}.sock'))
+    nets = [ dict(type='user', forward_ports=[]), dict(type='passt', forward_ports=[]) ]
+    m = PasstManager('vm', nets, exe_fn=fake_passt(tmp_path, 'touch "$sock"; exec sleep 30'))
+    assert m.socks == [ str(tmp_path / 'passt-1.sock') ]
+    m.run()
+    assert os.path.exists(m.socks[0])
+    m.shutdown()
+    assert not os.path.exists(str(tmp_path / 'passt-1.sock'))
+
+    with pytest.raises(PasstError, match='not found'):
+        PasstManager('vm', nets, exe_fn=lambda: None).run()
+    m = PasstManager('vm', nets, exe_fn=fake_passt(tmp_path, 'exit 1'))
+    with pytest.raises(PasstError, match='exited with code 1'):
+        m.run()
+    m.shutdown()
@@ -0,0 +1,53 @@
+from vmvm.port_registry import PortRegistry, PortRegistryError
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import pytest
+
+
+def make_registry(tmp_path, **kwargs) -> PortRegistry:
+    kwargs.setdefault('port_free_fn', lambda port: True)
+    return PortRegistry(5900, state_dir=str(tmp_path), **kwargs)
+
+
+def test_acquire_release(tmp_path):
+    r = make_registry(tmp_path)
+    assert r.acquire('a', pid=1) == 5900
+    assert r.acquire('b', pid=1) == 5901
+    assert r.acquire('a', pid=1) == 5900    # same holder gets its lease back
+    r.release('a')
+    assert r.acquire('c', pid=1) == 5900    # released port is reused
+    assert set(r.leases().keys()) == {'b', 'c'}
+
+
+def test_stale_lease_reclaimed(tmp_path):
+    alive = {10: True, 11: True}
+    r = make_registry(tmp_path, pid_alive_fn=lambda pid: alive.get(pid, False))
+    assert r.acquire('a', pid=10) == 5900
+    with pytest.raises(PortRegistryError):
+        r.acquire('a', pid=11)
+    alive[10] = False
+    assert r.acquire('b', pid=11) == 5900   # holder of 'a' is gone
+    assert r.acquire('a', pid=11) == 5901
+
+
+def test_busy_port_skipped(tmp_path):
+    r = make_registry(tmp_path, port_free_fn=lambda port: port != 5900)
+    assert r.acquire('a', pid=1) == 5901
+
+
+def _acquire_many(args) -> list[int]:
+    state_dir, worker, count = args
+    r = PortRegistry(5900, state_dir=state_dir, port_free_fn=lambda port: True)
+    return [ r.acquire(f'vm-{worker}-{i}', pid=1) for i in range(count) ]
+
+
+def test_parallel_stress(tmp_path):
+    workers, per_worker = 8, 25
+    ctx = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        results = list(pool.map(_acquire_many, [ (str(tmp_path), w, per_worker) for w in range(workers) ]))
+    ports = [ port for ports in results for port in ports ]
+    assert len(ports) == workers * per_worker
+    assert len(set(ports)) == len(ports)
+    assert sorted(ports) == list(range(5900, 5900 + len(ports)))
+    assert len(make_registry(tmp_path).leases()) == len(ports)
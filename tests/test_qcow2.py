@@ -0,0 +1,49 @@
+from vmvm.qcow2 import read_qcow2_info, l2_cache_size, l2_cache_sizes, create_args, Qcow2Info
+import struct
+
+
+def write_qcow2_header(path, size, cluster_bits=16, version=3, incompatible=0):
+    header = struct.pack('>IIQIIQ', 0x514649fb, version, 0, 0, cluster_bits, size)
+    header += b'\0' * (72 - len(header)) + struct.pack('>Q', incompatible) + b'\0' * 32
+    path.write_bytes(header)
+
+
+def test_read_qcow2_info(tmp_path):
+    write_qcow2_header(tmp_path / 'a.qcow2', 500 << 30)
+    write_qcow2_header(tmp_path / 'b.qcow2', 1 << 30, cluster_bits=17, incompatible=1 << 4)
+    write_qcow2_header(tmp_path / 'v2.qcow2', 1 << 30, version=2, incompatible=1 << 4)
+    (tmp_path / 'raw.img').write_bytes(b'\0' * 512)
+    assert read_qcow2_info(str(tmp_path / 'a.qcow2')) == Qcow2Info(virtual_size=500 << 30, cluster_size=64 << 10)
+    assert read_qcow2_info(str(tmp_path / 'b.qcow2')) == Qcow2Info(virtual_size=1 << 30, cluster_size=128 << 10, extended_l2=True)
+    assert read_qcow2_info(str(tmp_path / 'v2.qcow2')).extended_l2 == False
+    assert read_qcow2_info(str(tmp_path / 'raw.img')) is None
+    assert read_qcow2_info(str(tmp_path / 'missing.qcow2')) is None
+
+
+def test_l2_cache_size():
+    # 8 bytes per 64K cluster: 1M of cache per 8G of disk
+    assert l2_cache_size(Qcow2Info(virtual_size=8 << 30, cluster_size=64 << 10)) == 1 << 20
+    assert l2_cache_size(Qcow2Info(virtual_size=500 << 30, cluster_size=64 << 10)) == 64000 << 10
+    assert l2_cache_size(Qcow2Info(virtual_size=8 << 30, cluster_size=64 << 10, extended_l2=True)) == 2 << 20
+    # rounded up to whole L2 tables
+    assert l2_cache_size(Qcow2Info(virtual_size=1 << 20, cluster_size=64 << 10)) == 64 << 10
+
+
+def test_l2_cache_sizes(tmp_path):
+    write_qcow2_header(tmp_path / 'system.qcow2', 16 << 30)
+    write_qcow2_header(tmp_path / 'data.qcow2', 16 << 30)
+    disks = [ 'system.qcow2', { 'file': 'data.qcow2', 'l2_cache': None }, { 'file': 'big.qcow2', 'l2_cache': 4 << 20 },
+              'raw.img', 'not-created-yet.qcow2', '/dev/sdb' ]
+    assert l2_cache_sizes(disks, str(tmp_path)) == [ 2 << 20, None, 4 << 20, None, None, None ]
+
+
+def test_create_args():
+    assert create_args({ 'file': 'system.qcow2' }) == (['-f', 'qcow2'], ['100G'])
+    spec = { 'file': 'db.qcow2', 'size': 500 << 30, 'cluster_size': 128 << 10, 'preallocation': 'metadata',
+             'lazy_refcounts': True, 'extended_l2': True }
+    assert create_args(spec) == (['-f', 'qcow2', '-o', 'cluster_size=131072,preallocation=metadata,lazy_refcounts=on,extended_l2=on'], [str(500 << 30)])
+    assert create_args({ 'file': 'data.raw', 'preallocation': 'falloc', 'size': 1 << 30 }) == (['-f', 'raw', '-o', 'preallocation=falloc'], [str(1 << 30)])
+    # overlays take the size of the base
+    # the configured format wins over the file name
+    assert create_args({ 'file': 'data.img', 'format': 'qcow2', 'cluster_size': 65536 }) == (['-f', 'qcow2', '-o', 'cluster_size=65536'], ['100G'])
+    assert create_args({ 'file': 'clone.qcow2', 'cluster_size': 65536 }, with_size=False) == (['-f', 'qcow2', '-o', 'cluster_size=65536'], [])
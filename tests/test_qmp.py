@@ -0,0 +1,63 @@
+from vmvm.qmp import QMPPool, discover_qmp_sockets, qmp_execute_all, query_main
+from .fake_qmp import FakeQMPServer
+import asyncio
+import json
+import time
+
+
+def make_runtime_dir(tmp_path, names):
+    for name in names:
+        (tmp_path / name).mkdir()
+    return str(tmp_path) + '/'
+
+
+def test_discover_qmp_sockets(tmp_path):
+    runtime_dir = make_runtime_dir(tmp_path, ['a', 'b', 'spice-only'])
+    (tmp_path / 'a' / 'qmp.sock').touch()
+    (tmp_path / 'b' / 'qmp.sock').touch()
+    (tmp_path / 'spice-only' / 'spice.sock').touch()
+    assert discover_qmp_sockets(runtime_dir) == { 'a': str(tmp_path / 'a' / 'qmp.sock'), 'b': str(tmp_path / 'b' / 'qmp.sock') }
+
+
+def test_pool_reuses_connections(tmp_path):
+    sock = tmp_path / 'qmp.sock'
+    with FakeQMPServer(sock, {'query-status': {'status': 'running', 'running': True}}) as server:
+        async def run():
+            async with QMPPool({'vm': str(sock)}) as pool:
+                for _ in range(3):
+                    assert (await pool.execute('vm', 'query-status'))['status'] == 'running'
+                server.disconnect_clients()
+                # broken connection is reopened transparently
+                assert (await pool.execute('vm', 'query-status'))['running']
+        asyncio.run(run())
+        assert len(server.executed('query-status')) == 4
+        assert server.connections == 2
+
+
+def test_execute_all_fan_out_and_timeouts(tmp_path):
+    def slow(args):
+        time.sleep(1)
+        return {'status': 'running', 'running': True}
+    handlers = {'query-status': {'status': 'paused', 'running': False}}
+    with FakeQMPServer(tmp_path / 'a.sock', handlers), FakeQMPServer(tmp_path / 'b.sock', {'query-status': slow}):
+        sockets = { 'a': str(tmp_path / 'a.sock'), 'b': str(tmp_path / 'b.sock'), 'gone': str(tmp_path / 'gone.sock') }
+        t = time.monotonic()
+        results = qmp_execute_all(sockets, 'query-status', timeout=0.3)
+        assert time.monotonic() - t < 0.9
+    assert results['a'] == {'return': {'status': 'paused', 'running': False}}
+    assert results['b'] == {'error': 'timed out after 0.3s'}
+    assert 'error' in results['gone']
+
+
+def test_execute_all_reports_qmp_errors(tmp_path):
+    with FakeQMPServer(tmp_path / 'a.sock', {}):
+        results = qmp_execute_all({'a': str(tmp_path / 'a.sock')}, 'query-balloon')
+    assert 'query-balloon' in results['a']['error']
+
+
+def test_query_main(tmp_path, monkeypatch, capsys):
+    runtime_dir = make_runtime_dir(tmp_path, ['vm1'])
+    monkeypatch.setattr('vmvm.qmp.get_runtime_dir', lambda: runtime_dir)
+    with FakeQMPServer(tmp_path / 'vm1' / 'qmp.sock', {'query-status': {'status': 'running', 'running': True}}):
+        assert query_main(['query-status']) == 0
+    assert json.loads(capsys.readouterr().out) == {'vm1': {'return': {'status': 'running', 'running': True}}}
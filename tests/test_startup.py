@@ -0,0 +1,75 @@
+from vmvm.startup import StartupPipeline, StartupError
+import os
+import pytest
+import threading
+import time
+
+
+def test_pipeline_runs_independent_steps_concurrently():
+    p = StartupPipeline()
+    barrier = threading.Barrier(2, timeout=5)
+    order = []
+    # both steps must be running at the same time to pass the barrier
+    p.add('tpm', lambda: (barrier.wait(), 'sock')[1])
+    p.add('probe', lambda: (barrier.wait(), 42)[1])
+    p.add('args', lambda: order.append('args') or [ p.results['tpm'], p.results['probe'] ], deps=['tpm', 'probe'])
+    p.add('copy', lambda: order.append('copy'), deps=['args'])
+    results = p.run()
+    assert results['args'] == [ 'sock', 42 ]
+    assert order == [ 'args', 'copy' ]
+    assert p.timings['args'][0] >= max(p.timings['tpm'][1], p.timings['probe'][1])
+    assert 'copy' in p.format_timings()
+
+
+def test_pipeline_failure():
+    p = StartupPipeline()
+    started = []
+    def slow():
+        time.sleep(0.05)
+        started.append('slow')
+    def fail():
+        raise StartupError('no huge pages')
+    p.add('slow', slow)
+    p.add('fail', fail)
+    p.add('args', lambda: started.append('args'), deps=['fail'])
+    with pytest.raises(StartupError, match='no huge pages'):
+        p.run()
+    # running steps are waited for, dependent ones never start
+    assert started == [ 'slow' ]
+
+    with pytest.raises(ValueError):
+        p.add('x', lambda: None, deps=['missing'])
+
+
+def make_app(tmp_path, monkeypatch, conf: str):
+    import vmvm.main
+    (tmp_path / 'vmconfig.yml').write_text(conf)
+    app = vmvm.main.App(str(tmp_path), use_cache=False)
+    stopped = []
+    monkeypatch.setattr(app, '_stop_daemons', lambda: stopped.append(1))
+    return app, stopped
+
+
+def test_launch_stops_daemons_when_qemu_cannot_start(tmp_path, monkeypatch):
+    import vmvm.main
+    app, stopped = make_app(tmp_path, monkeypatch, f'name: launch-{os.getpid()}\nefi: false\nspice: none\n')
+    def no_qemu(*args, **kwargs):
+        raise FileNotFoundError('qemu-system-x86_64')
+    monkeypatch.setattr(vmvm.main, 'exec_with_trace', no_qemu)
+    assert app.act_run() == 1
+    assert stopped == [1]
+
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(vmvm.main, 'exec_with_trace', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        app.act_run()
+    assert stopped == [1, 1]
+
+
+def test_launch_reports_step_errors(tmp_path, monkeypatch, caplog):
+    # pinning 8 vCPUs to 2 host CPUs fails in the cpu_caps step
+    app, stopped = make_app(tmp_path, monkeypatch, f'name: launch-{os.getpid()}\nefi: false\nspice: none\ncpus: 8\ncpu_pinning: {{vcpus: "0-1"}}\n')
+    assert app.act_run() == 1
+    assert stopped == [1]
+    assert any('cannot pin vCPUs' in r.getMessage() for r in caplog.records)
@@ -0,0 +1,93 @@
+from vmvm.suspend import (normalize_argv, argv_fingerprint, validate_state, disk_stats, save_state, load_state,
+                          save_metadata, load_metadata, read_process_argv, SavedState, SuspendError)
+from .fake_qmp import FakeQMPServer
+import pytest
+
+ARGV = ['-name', 'vm', '-spice', 'port=5901,addr=127.0.0.1,disable-ticketing=on', '-boot', 'order=c', '-m', '4096']
+
+
+def test_normalize_argv():
+    assert normalize_argv(ARGV) == ['-name', 'vm', '-spice', 'port=*,addr=127.0.0.1,disable-ticketing=on', '-m', '4096']
+    other_port = [ a.replace('5901', '5907') for a in ARGV ]
+    assert argv_fingerprint(other_port) == argv_fingerprint(ARGV)
+    assert argv_fingerprint(ARGV[:-1] + ['8192']) != argv_fingerprint(ARGV)
+
+
+def test_suspend_resumed_vm(tmp_path):
+    """ suspend -> resume -> suspend -> resume: the second suspend sees the argv of the resumed VM """
+    disk = tmp_path / 'system.qcow2'
+    disk.write_bytes(b'x' * 10)
+    qemu = ['/usr/bin/qemu-system-x86_64', 1, 2]
+    proc = tmp_path / 'proc'
+    (proc / '42').mkdir(parents=True)
+    (proc / '42' / 'cmdline').write_bytes(b'\0'.join([b'qemu-system-x86_64'] + [ a.encode() for a in ARGV ]) + b'\0')
+    for cycle in range(2):
+        state = SavedState(argv_sha256=argv_fingerprint(read_process_argv(42, str(proc))), qemu=qemu, disks=disk_stats([str(disk)]))
+        # resume validates against the freshly built argv, then launches it with -incoming defer
+        validate_state(state, ARGV, qemu)
+        (proc / '42' / 'cmdline').write_bytes(b'\0'.join([b'qemu-system-x86_64'] + [ a.encode() for a in ARGV + ['-incoming', 'defer'] ]) + b'\0')
+    assert normalize_argv(ARGV + ['-incoming', 'defer']) == normalize_argv(ARGV)
+
+
+def test_read_process_argv(tmp_path):
+    (tmp_path / '42').mkdir()
+    (tmp_path / '42' / 'cmdline').write_bytes(b'qemu-system-x86_64\0-name\0vm\0')
+    assert read_process_argv(42, str(tmp_path)) == ['-name', 'vm']
+
+
+def test_validate_state(tmp_path):
+    disk = tmp_path / 'system.qcow2'
+    disk.write_bytes(b'x' * 10)
+    state = SavedState(argv_sha256=argv_fingerprint(ARGV), qemu=['/usr/bin/qemu-system-x86_64', 1, 2], disks=disk_stats([str(disk)]))
+    save_metadata(str(tmp_path / 'state'), state)
+    state = load_metadata(str(tmp_path / 'state'))
+    validate_state(state, ARGV, ['/usr/bin/qemu-system-x86_64', 1, 2])
+    with pytest.raises(SuspendError, match='configuration changed'):
+        validate_state(state, ARGV + ['-smp', '8'], ['/usr/bin/qemu-system-x86_64', 1, 2])
+    with pytest.raises(SuspendError, match='QEMU binary changed'):
+        validate_state(state, ARGV, ['/usr/bin/qemu-system-x86_64', 1, 3])
+    disk.write_bytes(b'y' * 20)
+    with pytest.raises(SuspendError, match='disk images were modified'):
+        validate_state(state, ARGV, ['/usr/bin/qemu-system-x86_64', 1, 2])
+    with pytest.raises(SuspendError, match='no saved state'):
+        load_metadata(str(tmp_path / 'missing'))
+
+
+def migration_handlers(status='completed'):
+    return {
+        'stop': {}, 'cont': {}, 'quit': {},
+        'migrate': {}, 'migrate-incoming': {},
+        'migrate-set-capabilities': {}, 'migrate-set-parameters': {},
+        'query-migrate': {'status': status, 'ram': {'transferred': 1 << 30, 'total': 1 << 30}, 'error-desc': 'disk full'},
+    }
+
+
+def test_save_state_multifd(tmp_path):
+    sock = tmp_path / 'qmp.sock'
+    with FakeQMPServer(sock, migration_handlers()) as server:
+        save_state(str(sock), '/vms/a/suspended.vmstate', streams=4)
+    assert [ cmd for cmd, _ in server.commands ] == ['migrate-set-capabilities', 'migrate-set-parameters', 'stop', 'migrate', 'query-migrate', 'quit']
+    caps = { c['capability']: c['state'] for c in server.executed('migrate-set-capabilities')[0]['capabilities'] }
+    assert caps == {'multifd': True, 'mapped-ram': True}
+    assert server.executed('migrate-set-parameters') == [{'multifd-channels': 4}]
+    assert server.executed('migrate') == [{'uri': 'file:/vms/a/suspended.vmstate'}]
+
+
+def test_save_state_failure_resumes_vm(tmp_path):
+    sock = tmp_path / 'qmp.sock'
+    with FakeQMPServer(sock, migration_handlers(status='failed')) as server:
+        with pytest.raises(SuspendError, match='disk full'):
+            save_state(str(sock), '/vms/a/suspended.vmstate', compress='zstd')
+    assert server.executed('migrate') == [{'uri': 'exec:zstd -q -T0 -o /vms/a/suspended.vmstate'}]
+    assert server.executed('cont') == [{}]
+    assert server.executed('quit') == []
+
+
+def test_load_state(tmp_path):
+    sock = tmp_path / 'qmp.sock'
+    with FakeQMPServer(sock, migration_handlers()) as server:
+        load_state(str(sock), '/vms/my vm/suspended.vmstate', compress='gzip')
+    # the state was saved paused
+    assert [ cmd for cmd, _ in server.commands ][-3:] == ['migrate-incoming', 'query-migrate', 'cont']
+    assert server.executed('migrate-incoming') == [{'uri': "exec:gzip -d -c '/vms/my vm/suspended.vmstate'"}]
+    assert server.executed('migrate-set-capabilities') == []
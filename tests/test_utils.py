@@ -0,0 +1,63 @@
+from vmvm.utils import copy_file
+import os
+import errno
+import fcntl
+
+
+def test_copy_file(tmp_path):
+    src = tmp_path / 'OVMF_VARS.fd'
+    src.write_bytes(os.urandom(300000))
+    assert copy_file(str(src), str(tmp_path / 'copy.fd')) in ('reflink', 'copy_file_range', 'copy')
+    assert (tmp_path / 'copy.fd').read_bytes() == src.read_bytes()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['OVMF_VARS.fd', 'copy.fd']
+
+
+def test_copy_file_sparse(tmp_path, monkeypatch):
+    src = tmp_path / 'template.img'
+    data = os.urandom(1 << 20)
+    with open(src, 'wb') as f:
+        f.write(data)
+        f.seek(8 << 20)
+        f.write(data)
+        f.truncate(16 << 20)
+    def no_reflink(*args):
+        raise OSError(95, 'Operation not supported')
+    monkeypatch.setattr(fcntl, 'ioctl', no_reflink)
+
+    assert copy_file(str(src), str(tmp_path / 'a.img')) == 'copy_file_range'
+    def no_copy_file_range(*args):
+        raise OSError(18, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'copy_file_range', no_copy_file_range)
+    assert copy_file(str(src), str(tmp_path / 'b.img')) == 'copy'
+    for name in ('a.img', 'b.img'):
+        copy = tmp_path / name
+        assert copy.read_bytes() == src.read_bytes()
+        # holes are not written out
+        assert copy.stat().st_blocks <= src.stat().st_blocks
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['a.img', 'b.img', 'template.img']
+
+
+def test_copy_file_reflink_fallback_keeps_holes(tmp_path, monkeypatch):
+    src = tmp_path / 'template.img'
+    data = os.urandom(1 << 20)
+    with open(src, 'wb') as f:
+        f.write(data)
+        f.seek(8 << 20)
+        f.write(data)
+        f.truncate(16 << 20)
+    clones = []
+    def failing_reflink(fd, request, src_fd):
+        clones.append(request)
+        raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+    monkeypatch.setattr(fcntl, 'ioctl', failing_reflink)
+
+    assert copy_file(str(src), str(tmp_path / 'copy.img')) in ('copy_file_range', 'copy')
+    assert len(clones) == 1
+    copy = tmp_path / 'copy.img'
+    assert copy.read_bytes() == src.read_bytes()
+    with open(copy, 'rb') as f:
+        # data at 0 and 8M, holes at 1M-8M and from 9M to the end
+        assert os.lseek(f.fileno(), 0, os.SEEK_HOLE) == 1 << 20
+        assert os.lseek(f.fileno(), 1 << 20, os.SEEK_DATA) == 8 << 20
+        assert os.lseek(f.fileno(), 8 << 20, os.SEEK_HOLE) == 9 << 20
+    assert copy.stat().st_blocks * 512 < 4 << 20
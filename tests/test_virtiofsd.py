@@ -0,0 +1,45 @@
+from vmvm.virtiofsd_manager import VirtiofsdManager, VirtiofsdError, virtiofsd_args
+import pytest
+import os
+
+
+def make_share(path, tag='hostshare', **kwargs):
+    return dict({ 'path': path, 'tag': tag, 'transport': 'virtiofs', 'cache': 'auto', 'thread_pool_size': None }, **kwargs)
+
+
+def fake_virtiofsd(tmp_path, body):
+    exe = tmp_path / 'virtiofsd'
+    exe.write_text(f'#!/bin/sh\nfor a in "$@"; do case "$a" in --socket-path=*) sock="${{a#--socket-path=}}";; esac; done\n{body}\n')
+    exe.chmod(0o755)
+    return lambda: str(exe)
+
+
+def test_virtiofsd_args():
+    args = virtiofsd_args(make_share('src', cache='never', thread_pool_size=16), '/run/x.sock', '/home/u/src')
+    assert args[:4] == ['--socket-path=/run/x.sock', '--shared-dir=/home/u/src', '--cache=never', '--thread-pool-size=16']
+
+
+def test_virtiofsd_manager(tmp_path, monkeypatch):
+    monkeypatch.setattr('vmvm.virtiofsd_manager.get_virtiofs_sock_path', lambda vm, tag: str(tmp_path / f'{tag}.sock'))
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    shares = [ make_share('a'), make_share('b', tag='data'), make_share('c', tag='p9', transport='9p') ]
+    m = VirtiofsdManager('vm', shares, base_dir=str(tmp_path), exe_fn=fake_virtiofsd(tmp_path, 'touch "$sock"; exec sleep 30'))
+    assert m.socks == [ str(tmp_path / 'hostshare.sock'), str(tmp_path / 'data.sock') ]
+    m.run()
+    assert all(os.path.exists(s) for s in m.socks)
+    m.shutdown()
+    assert not any(os.path.exists(s) for s in m.socks)
+
+
+def test_virtiofsd_manager_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr('vmvm.virtiofsd_manager.get_virtiofs_sock_path', lambda vm, tag: str(tmp_path / f'{tag}.sock'))
+    (tmp_path / 'a').mkdir()
+    with pytest.raises(VirtiofsdError, match='not found'):
+        VirtiofsdManager('vm', [ make_share('a') ], base_dir=str(tmp_path), exe_fn=lambda: None).run()
+    with pytest.raises(VirtiofsdError, match='does not exist'):
+        VirtiofsdManager('vm', [ make_share('missing') ], base_dir=str(tmp_path), exe_fn=fake_virtiofsd(tmp_path, 'exit 0')).run()
+    m = VirtiofsdManager('vm', [ make_share('a') ], base_dir=str(tmp_path), exe_fn=fake_virtiofsd(tmp_path, 'exit 3'))
+    with pytest.raises(VirtiofsdError, match='exited with code 3'):
+        m.run()
+    m.shutdown()
@@ -0,0 +1,366 @@
+#
+# Incremental backups: a persistent dirty bitmap on every disk records the clusters written since the last backup,
+# and `blockdev-backup` with sync=incremental copies only those into a new qcow2 image backed by the previous backup.
+# Per disk the backup directory holds a chain full <- incremental <- incremental ..., listed in backups.json;
+# restoring a backup flattens its chain with `qemu-img convert`.
+# A running VM is backed up through its QMP socket. For a stopped VM the disks are opened by qemu-storage-daemon,
+# which takes the same QMP commands (qemu-img cannot copy by dirty bitmap).
+# https://www.qemu.org/docs/master/interop/bitmaps.html
+#
+
+import os
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+from dataclasses import dataclass
+from logging import info, error
+
+from .exec import exec_with_trace
+from .qmp import QMPPool
+from .qcow2 import read_qcow2_info
+from .utils import disk_spec, disk_image_format_by_name, get_unix_sock_path, read_running_pid, wait_for_socket, SockType
+
+BITMAP_NAME = 'vmvm-backup'
+MANIFEST_NAME = 'backups.json'
+DEFAULT_DEST = 'backups'            # relative to the VM directory
+JOB_POLL_INTERVAL = 0.5
+DAEMON_SOCKET_TIMEOUT = 10.0
+GUEST_AGENT_TIMEOUT = 10.0
+
+
+class BackupError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+@dataclass
+class BackupDisk:
+    node: str       # block node name given by CmdBuilder: hd<idx>
+    path: str       # absolute image path
+    size: int       # virtual size in bytes
+
+
+def backup_disks(disks: list, base_dir: str) -> list[BackupDisk]:
+    """ dirty bitmaps are stored in the image, so every disk must be a qcow2 image """
+    result = []
+    for idx, spec in enumerate(map(disk_spec, disks)):
+        if spec['file'].startswith('/dev/') or (spec.get('format') or disk_image_format_by_name(spec['file'])) != 'qcow2':
+            raise BackupError(f'disk {spec["file"]} is not a qcow2 image, it cannot keep a dirty bitmap')
+        path = os.path.abspath(os.path.join(base_dir, spec['file']))
+        image = read_qcow2_info(path)
+        if image is None:
+            raise BackupError(f'{path} does not exist or is not a qcow2 image')
+        result.append(BackupDisk(f'hd{idx}', path, image.virtual_size))
+    return result
+
+
+def read_manifest(dest: str) -> list[dict]:
+    """ backups in the order they were taken: id, type (full|incremental), time, frozen, disks (node -> image path relative to `dest`) """
+    try:
+        with open(os.path.join(dest, MANIFEST_NAME), 'r') as f:
+            return json.load(f)['backups']
+    except FileNotFoundError:
+        return []
+
+
+def write_manifest(dest: str, backups: list[dict]) -> None:
+    path = os.path.join(dest, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({ 'backups': backups }, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def new_backup_id(backups: list[dict], now: float | None = None) -> str:
+    backup_id = base_id = time.strftime('%Y%m%dT%H%M%S', time.localtime(now))
+    ids = { b['id'] for b in backups }
+    n = 1
+    while backup_id in ids:
+        backup_id, n = f'{base_id}-{n}', n + 1
+    return backup_id
+
+
+def create_targets(disks: list[BackupDisk], dest: str, backup_id: str, kind: str, previous: dict | None) -> dict[str, str]:
+    """
+        empty target images, incremental ones backed by the previous backup of the disk (relative backing path,
+        so the backup directory can be moved). Returns node -> image path relative to `dest`.
+    """
+    targets = {}
+    for d in disks:
+        rel = os.path.join(d.node, f'{backup_id}-{kind}.qcow2')
+        os.makedirs(os.path.join(dest, d.node), exist_ok=True)
+        args = [ 'create', '-f', 'qcow2' ]
+        if previous is not None:
+            args += [ '-b', os.path.basename(previous['disks'][d.node]), '-F', 'qcow2' ]
+        if exec_with_trace('qemu-img', args + [ os.path.join(dest, rel), str(d.size) ]) != 0:
+            raise BackupError(f'failed to create {os.path.join(dest, rel)}')
+        targets[d.node] = rel
+    return targets
+
+
+def guest_agent_execute(sock_path: str, command: str, timeout: float = GUEST_AGENT_TIMEOUT):
+    """
+        runs one qemu-guest-agent command. guest-sync first skips replies an earlier client left in the channel.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(sock_path)
+        f = s.makefile('rwb')
+        sync_id = random.randrange(1, 1 << 31)
+        f.write(json.dumps({ 'execute': 'guest-sync', 'arguments': { 'id': sync_id } }).encode() + b'\n')
+        f.flush()
+        while True:
+            line = f.readline()
+            if not line:
+                raise BackupError('guest agent closed the connection')
+            try:
+                if json.loads(line).get('return') == sync_id:
+                    break
+            except ValueError:
+                continue
+        f.write(json.dumps({ 'execute': command }).encode() + b'\n')
+        f.flush()
+        reply = json.loads(f.readline())
+        if 'error' in reply:
+            raise BackupError(f'guest agent {command}: {reply["error"].get("desc", reply["error"])}')
+        return reply.get('return')
+
+
+def freeze_guest(qga_sock: str, frozen: bool) -> None:
+    try:
+        if frozen:
+            count = guest_agent_execute(qga_sock, 'guest-fsfreeze-freeze')
+            info('froze %s guest filesystems', count)
+        else:
+            guest_agent_execute(qga_sock, 'guest-fsfreeze-thaw')
+            info('thawed guest filesystems')
+    except OSError as e:
+        raise BackupError(f'guest agent on {qga_sock}: {e}')
+
+
+async def _wait_jobs(pool: QMPPool, job_ids: list[str]) -> list[str]:
+    """ waits until the jobs conclude and dismisses them, returns their errors """
+    pending = set(job_ids)
+    errors = []
+    while pending:
+        for job in await pool.execute('vm', 'query-jobs'):
+            if job['id'] not in pending:
+                continue
+            if job['status'] == 'concluded':
+                pending.discard(job['id'])
+                if 'error' in job:
+                    errors.append(f'{job["id"]}: {job["error"]}')
+                await pool.execute('vm', 'job-dismiss', { 'id': job['id'] })
+            elif job.get('total-progress'):
+                logging.debug('%s: %d%%', job['id'], 100 * job['current-progress'] // job['total-progress'])
+        if pending:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+    return errors
+
+
+async def run_backup_async(qmp_sock: str, disks: list[BackupDisk], targets: dict[str, str], incremental: bool,
+                           freeze_fn=None) -> None:
+    """
+        copies the disks into the target images (node -> absolute path). All jobs start in one transaction, so the
+        disks are backed up at the same point in time; `freeze_fn(frozen)` brackets only the job start.
+    """
+    async with QMPPool({ 'vm': qmp_sock }) as pool:
+        nodes = { n['node-name']: n for n in await pool.execute('vm', 'query-named-block-nodes') }
+        actions = []
+        for d in disks:
+            if d.node not in nodes:
+                raise BackupError(f'block node {d.node} not found')
+            has_bitmap = any(b.get('name') == BITMAP_NAME for b in nodes[d.node].get('dirty-bitmaps', []))
+            backup = { 'job-id': f'backup-{d.node}', 'device': d.node, 'target': f'backup-{d.node}', 'auto-dismiss': False }
+            if incremental:
+                if not has_bitmap:
+                    raise BackupError(f'{d.node} has no dirty bitmap "{BITMAP_NAME}" (disk replaced or restored?), take a full backup')
+                backup.update(sync='incremental', bitmap=BITMAP_NAME)
+            else:
+                # the bitmap starts tracking at the same instant the full copy is taken
+                bitmap = { 'node': d.node, 'name': BITMAP_NAME }
+                actions.append({ 'type': 'block-dirty-bitmap-clear', 'data': bitmap } if has_bitmap else
+                               { 'type': 'block-dirty-bitmap-add', 'data': dict(bitmap, persistent=True) })
+                backup.update(sync='full')
+            actions.append({ 'type': 'blockdev-backup', 'data': backup })
+
+        added = []
+        try:
+            for d in disks:
+                # the backing chain of an incremental target is never read by the job
+                await pool.execute('vm', 'blockdev-add', { 'driver': 'qcow2', 'node-name': f'backup-{d.node}',
+                                                            'file': { 'driver': 'file', 'filename': targets[d.node] },
+                                                            'backing': None })
+                added.append(f'backup-{d.node}')
+            if freeze_fn is not None:
+                await asyncio.to_thread(freeze_fn, True)
+            try:
+                await pool.execute('vm', 'transaction', { 'actions': actions, 'properties': { 'completion-mode': 'grouped' } })
+            finally:
+                if freeze_fn is not None:
+                    await asyncio.to_thread(freeze_fn, False)
+            errors = await _wait_jobs(pool, [ f'backup-{d.node}' for d in disks ])
+            if errors:
+                if not incremental:
+                    # the bitmaps were reset for a backup that does not exist; incrementals on top would miss data
+                    for d in disks:
+                        await pool.execute('vm', 'block-dirty-bitmap-remove', { 'node': d.node, 'name': BITMAP_NAME })
+                raise BackupError('; '.join(errors))
+        finally:
+            for node in added:
+                await pool.execute('vm', 'blockdev-del', { 'node-name': node })
+
+
+def run_backup(*args, **kwargs) -> None:
+    asyncio.run(run_backup_async(*args, **kwargs))
+
+
+def storage_daemon_args(disks: list[BackupDisk], qmp_sock: str) -> list[str]:
+    args = []
+    for d in disks:
+        args += [ '--blockdev', f'driver=qcow2,node-name={d.node},file.driver=file,file.filename={d.path}' ]
+    return args + [ '--chardev', f'socket,id=qmp0,path={qmp_sock},server=on,wait=off', '--monitor', 'chardev=qmp0' ]
+
+
+def with_storage_daemon(disks: list[BackupDisk], fn) -> None:
+    """ calls `fn(qmp_sock)` with the disks of the stopped VM opened by qemu-storage-daemon """
+    exe = shutil.which('qemu-storage-daemon')
+    if exe is None:
+        raise BackupError('qemu-storage-daemon not found, it is needed to back up a stopped VM')
+    with tempfile.TemporaryDirectory(prefix='vmvm-backup-') as tmp_dir:
+        qmp_sock = os.path.join(tmp_dir, 'qmp.sock')
+        proc = subprocess.Popen([ exe ] + storage_daemon_args(disks, qmp_sock))
+        try:
+            problem = wait_for_socket(proc, qmp_sock, DAEMON_SOCKET_TIMEOUT, connect=True)
+            if problem is not None:
+                raise BackupError(f'qemu-storage-daemon {problem}')
+            fn(qmp_sock)
+        finally:
+            # persistent bitmaps are written to the images when the daemon exits
+            if proc.poll() is None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+
+
+def backup_vm(options, vm_dir: str, dest: str, incremental: bool, freeze: bool = False,
+              storage_daemon=with_storage_daemon) -> dict:
+    """
+        takes a full or incremental backup of every disk into `dest`, returns the new manifest entry
+    """
+    disks = backup_disks(options.disks, vm_dir)
+    if not disks:
+        raise BackupError('no disks configured')
+    backups = read_manifest(dest)
+    previous = backups[-1] if backups else None
+    if incremental:
+        if previous is None:
+            raise BackupError(f'no backup in {dest} yet, take a full backup first')
+        missing = [ d.node for d in disks if d.node not in previous['disks'] ]
+        if missing:
+            raise BackupError(f'{", ".join(missing)} not in the last backup, take a full backup')
+    running = read_running_pid(options.name) is not None
+    if running and not options.qmp_enabled:
+        raise BackupError('VM is running, backing it up live requires the control_socket option')
+    freeze_fn = None
+    if freeze and not running:
+        info('VM is not running, nothing to freeze')
+    elif freeze:
+        if not options.guest_agent:
+            raise BackupError('--freeze requires the guest_agent option')
+        qga_sock = get_unix_sock_path(SockType.QGA, options.name)
+        freeze_fn = lambda frozen: freeze_guest(qga_sock, frozen)
+
+    kind = 'incremental' if incremental else 'full'
+    backup_id = new_backup_id(backups)
+    os.makedirs(dest, exist_ok=True)
+    targets = create_targets(disks, dest, backup_id, kind, previous if incremental else None)
+    abs_targets = { node: os.path.join(dest, rel) for node, rel in targets.items() }
+    info('%s backup %s of %s to %s', kind, backup_id, options.name, dest)
+    try:
+        if running:
+            run_backup(get_unix_sock_path(SockType.QMP, options.name), disks, abs_targets, incremental, freeze_fn)
+        else:
+            storage_daemon(disks, lambda qmp_sock: run_backup(qmp_sock, disks, abs_targets, incremental))
+    except BaseException:
+        for path in abs_targets.values():
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    entry = { 'id': backup_id, 'type': kind, 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'frozen': freeze_fn is not None,
+              'disks': targets }
+    write_manifest(dest, backups + [ entry ])
+    return entry
+
+
+def restore_vm(options, vm_dir: str, dest: str, backup_id: str | None = None, output_dir: str | None = None) -> list[str]:
+    """
+        writes the disks as of backup `backup_id` (default: the latest) over the VM disks, or into `output_dir`.
+        Returns the restored image paths.
+    """
+    backups = read_manifest(dest)
+    if not backups:
+        raise BackupError(f'no backups in {dest}')
+    entry = backups[-1] if backup_id is None else next((b for b in backups if b['id'] == backup_id), None)
+    if entry is None:
+        raise BackupError(f'backup {backup_id} not found in {dest}')
+    disk_paths = { f'hd{idx}': os.path.abspath(os.path.join(vm_dir, spec['file'])) for idx, spec in enumerate(map(disk_spec, options.disks)) }
+    if output_dir is None:
+        pid = read_running_pid(options.name)
+        if pid is not None:
+            raise BackupError(f'VM is running (pid {pid}), stop it before restoring over its disks')
+        unknown = [ node for node in entry['disks'] if node not in disk_paths ]
+        if unknown:
+            raise BackupError(f'{", ".join(unknown)} of backup {entry["id"]} are not configured disks, restore with --output')
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+    restored = []
+    for node, rel in entry['disks'].items():
+        out = disk_paths[node] if output_dir is None else os.path.join(output_dir, os.path.basename(disk_paths.get(node, f'{node}.qcow2')))
+        # reads through the backing chain down to the full backup
+        if exec_with_trace('qemu-img', [ 'convert', '-O', 'qcow2', os.path.join(dest, rel), out + '.restoring' ]) != 0:
+            raise BackupError(f'failed to restore {node} from {os.path.join(dest, rel)}')
+        os.replace(out + '.restoring', out)
+        restored.append(out)
+    if output_dir is None:
+        info('restored images carry no dirty bitmap, the next backup has to be a full one')
+    return restored
+
+
+def backup_main(argv: list[str]) -> int:
+    from .main import App
+
+    parser = argparse.ArgumentParser(prog='vmvm backup', description='Full and incremental disk backups of a VM')
+    parser.add_argument('cmd', choices=['full', 'incremental', 'restore', 'list'])
+    parser.add_argument('dir_name', nargs='?', default=os.getcwd())
+    parser.add_argument('--dest', help=f'backup directory (default: CONF_DIR/{DEFAULT_DEST})')
+    parser.add_argument('--freeze', action='store_true', help='full/incremental: freeze guest filesystems with qemu-guest-agent while the backup starts')
+    parser.add_argument('--id', help='restore: backup to restore (default: the latest)')
+    parser.add_argument('--output', help='restore: write the images to this directory instead of over the VM disks')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s  %(levelname)s  %(message)s', level=logging.INFO)
+    app = App(args.dir_name)
+    dest = os.path.abspath(args.dest or os.path.join(args.dir_name, DEFAULT_DEST))
+    try:
+        if args.cmd == 'list':
+            for b in read_manifest(dest):
+                print(f'{b["id"]}  {b["type"]:<12} {b["time"]}{"  frozen" if b["frozen"] else ""}')
+        elif args.cmd == 'restore':
+            for path in restore_vm(app.options, os.path.abspath(args.dir_name), dest, args.id, args.output):
+                info('restored %s', path)
+        else:
+            backup_vm(app.options, os.path.abspath(args.dir_name), dest, args.cmd == 'incremental', args.freeze)
+    except BackupError as e:
+        error('%s', e)
+        return 1
+    return 0
@@ -0,0 +1,106 @@
+#
+# Memory ballooning: virtio-balloon with free page reporting hands pages the guest frees back to the host,
+# the balloon itself caps how much RAM the guest may use. The auto-balloon controller resizes the balloon of
+# one VM from the guest memory statistics and the host MemAvailable: the guest keeps what it uses plus headroom,
+# and grows only as far as the host can afford.
+# https://www.qemu.org/docs/master/interop/qemu-qmp-ref.html#command-QMP-machine.balloon
+#
+
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass
+
+from .qmp import QMPPool
+
+BALLOON_QOM_PATH = '/machine/peripheral/balloon0'
+STATS_POLLING_INTERVAL = 5      # seconds between guest statistics updates
+CONTROL_INTERVAL = 10           # seconds between balloon adjustments
+
+
+@dataclass
+class BalloonPolicy:
+    min_bytes: int
+    max_bytes: int                  # the VM `ram`
+    guest_headroom: float = 0.2     # fraction of max_bytes kept available inside the guest
+    host_reserve: float = 0.1       # fraction of host RAM never handed to guests
+    min_step: int = 64 << 20        # smaller adjustments are skipped, so the balloon does not flap
+
+
+def read_host_memory(meminfo_path: str = '/proc/meminfo') -> tuple[int, int]:
+    """ MemTotal and MemAvailable in bytes """
+    values = {}
+    with open(meminfo_path, 'r') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            if key in ('MemTotal', 'MemAvailable'):
+                values[key] = int(value.split()[0]) * 1024
+    return values['MemTotal'], values['MemAvailable']
+
+
+def guest_available_memory(guest_stats: dict) -> int | None:
+    """
+        memory the guest could use without swapping, from the balloon `guest-stats`; None until the guest driver reports
+    """
+    if not guest_stats.get('last-update'):
+        return None
+    stats = guest_stats.get('stats', {})
+    if stats.get('stat-available-memory', -1) >= 0:
+        return stats['stat-available-memory']
+    # older guest kernels: free plus page cache
+    if stats.get('stat-free-memory', -1) >= 0:
+        return stats['stat-free-memory'] + max(stats.get('stat-disk-caches', 0), 0)
+    return None
+
+
+def balloon_target(policy: BalloonPolicy, actual: int, guest_available: int, host_total: int, host_available: int) -> int | None:
+    """
+        new guest memory size in bytes, None to leave the balloon as is
+    """
+    host_reserve = int(policy.host_reserve * host_total)
+    headroom = int(policy.guest_headroom * policy.max_bytes)
+    if host_available < host_reserve:
+        # host under pressure: squeeze idle guests harder
+        headroom //= 2
+    target = actual - guest_available + headroom
+    if target > actual:
+        target = actual + max(0, min(target - actual, host_available - host_reserve))
+    target = max(policy.min_bytes, min(policy.max_bytes, target))
+    if abs(target - actual) < policy.min_step:
+        return None
+    return target
+
+
+async def control_step(pool: QMPPool, name: str, policy: BalloonPolicy, meminfo_path: str = '/proc/meminfo') -> int | None:
+    """ one adjustment of the balloon of VM `name`, returns the new size if it was changed """
+    balloon = await pool.execute(name, 'query-balloon')
+    guest_stats = await pool.execute(name, 'qom-get', { 'path': BALLOON_QOM_PATH, 'property': 'guest-stats' })
+    guest_available = guest_available_memory(guest_stats)
+    if guest_available is None:
+        return None
+    host_total, host_available = read_host_memory(meminfo_path)
+    target = balloon_target(policy, balloon['actual'], guest_available, host_total, host_available)
+    if target is not None:
+        logging.info('balloon: %s %d MiB -> %d MiB (guest available %d MiB, host available %d MiB)', name,
+                     balloon['actual'] >> 20, target >> 20, guest_available >> 20, host_available >> 20)
+        await pool.execute(name, 'balloon', { 'value': target })
+    return target
+
+
+async def run_controller_async(qmp_sock: str, policy: BalloonPolicy, interval: float = CONTROL_INTERVAL,
+                               stop: threading.Event | None = None, meminfo_path: str = '/proc/meminfo') -> None:
+    """
+        adjusts the balloon every `interval` seconds until `stop` is set or QEMU goes away.
+        The QMP monitor serves one client at a time, so the connection is held only for each step.
+    """
+    async with QMPPool({ 'vm': qmp_sock }) as pool:
+        await pool.execute('vm', 'qom-set', { 'path': BALLOON_QOM_PATH, 'property': 'guest-stats-polling-interval',
+                                              'value': STATS_POLLING_INTERVAL })
+    while stop is None or not stop.is_set():
+        async with QMPPool({ 'vm': qmp_sock }) as pool:
+            await control_step(pool, 'vm', policy, meminfo_path)
+        await asyncio.sleep(interval)
+
+
+def run_controller(*args, **kwargs) -> None:
+    asyncio.run(run_controller_async(*args, **kwargs))
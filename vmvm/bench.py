@@ -0,0 +1,315 @@
+#
+# Boot time benchmark: the VM is launched N times on throwaway qcow2 overlays of its disks and with -snapshot, so
+# neither the disks nor the EFI variables are written. Every boot is timestamped from launch: QEMU spawn, firmware
+# handoff to the guest kernel, QMP availability and guest readiness.
+# Handoff and readiness are recognized on the first serial port, which is redirected to a file. Readiness can
+# instead be a `guest-ping` answered by qemu-guest-agent, on the channel of a VM with `guest_agent` or on a
+# virtio-serial channel added for the benchmark.
+# https://www.qemu.org/docs/master/interop/qemu-ga-ref.html
+#
+
+import os
+import re
+import json
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from dataclasses import dataclass
+from logging import info, error
+
+from .main import App
+from .clone import create_overlay, CloneError
+from .utils import disk_image_format_by_name, disk_spec, get_unix_sock_path, read_running_pid, SockType
+
+PHASES = [ 'spawn', 'handoff', 'qmp', 'ready' ]
+PERCENTILES = [ 50, 90, 99 ]
+# EFI stub banner, or the kernel banner with console=ttyS0
+DEFAULT_HANDOFF_REGEX = r'EFI stub: |Linux version '
+DEFAULT_READY_REGEX = r'login: '
+GUEST_AGENT_CHANNEL = 'org.qemu.guest_agent.0'
+POLL_INTERVAL = 0.01
+PING_INTERVAL = 0.5
+SERIAL_TAIL = 4096          # chars kept between reads, so that a match split across reads is found
+SHUTDOWN_TIMEOUT = 10.0
+
+
+class BenchError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+@dataclass
+class ReadyProbe:
+    handoff_regex: str = DEFAULT_HANDOFF_REGEX
+    ready_regex: str | None = DEFAULT_READY_REGEX   # ignored with guest_agent
+    guest_agent: bool = False
+    timeout: float = 120.0                          # seconds from launch the guest has to become ready
+
+
+class BootTimeline:
+    """
+        seconds since launch at which every phase was first seen
+    """
+    def __init__(self):
+        self._t0 = time.monotonic()
+        self.marks: dict[str, float] = {}
+        self.ready = threading.Event()
+        self.stopped = threading.Event()    # QEMU exited, watchers give up
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._t0
+
+    def mark(self, phase: str) -> None:
+        self.marks.setdefault(phase, self.elapsed())
+        if phase == 'ready':
+            self.ready.set()
+
+
+def bench_args(serial_path: str, qga_sock: str | None) -> list[str]:
+    """ extra QEMU arguments: -snapshot, serial port to a file and optionally the guest agent channel """
+    args = [
+        # the EFI variable store and every other -drive are not written either
+        '-snapshot',
+        '-chardev', f'file,id=benchserial,path={serial_path}',
+        '-serial', 'chardev:benchserial',
+    ]
+    if qga_sock is not None:
+        args += [
+            '-chardev', f'socket,id=benchqga,path={qga_sock},server=on,wait=off',
+            '-device', 'virtio-serial-pci,id=benchvirtio0',
+            '-device', f'virtserialport,bus=benchvirtio0.0,chardev=benchqga,name={GUEST_AGENT_CHANNEL}',
+        ]
+    return args
+
+
+def ephemeral_disks(disks: list, vm_dir: str, tmp_dir: str, overlay_fn=create_overlay) -> list[dict]:
+    """
+        qcow2 overlays in `tmp_dir` on top of the VM disks, per-disk settings are kept
+    """
+    result = []
+    for idx, disk in enumerate(disks):
+        spec = disk_spec(disk)
+        base_format = spec.get('format') or disk_image_format_by_name(spec['file'])
+        spec = { k: v for k, v in spec.items() if k not in ('base', 'base_format', 'from', 'format') }
+        path = os.path.join(tmp_dir, f'disk{idx}.qcow2')
+        if overlay_fn(path, spec['file'], cwd=vm_dir, spec={ 'file': path }, base_format=base_format) != 0:
+            raise BenchError(f'failed to create an overlay of {spec["file"]}')
+        result.append(dict(spec, file=path, format='qcow2'))
+    return result
+
+
+def watch_serial(path: str, timeline: BootTimeline, handoff_re: re.Pattern, ready_re: re.Pattern | None) -> None:
+    """ tails the serial log, QEMU creates it on startup """
+    f = None
+    tail = ''
+    try:
+        while not timeline.stopped.is_set():
+            if f is None and os.path.exists(path):
+                f = open(path, 'rb')
+            data = f.read() if f is not None else b''
+            if not data:
+                time.sleep(POLL_INTERVAL)
+                continue
+            text = tail + data.decode('utf-8', errors='replace')
+            if handoff_re.search(text):
+                timeline.mark('handoff')
+            if ready_re is not None and ready_re.search(text):
+                timeline.mark('ready')
+                return
+            tail = text[-SERIAL_TAIL:]
+    finally:
+        if f is not None:
+            f.close()
+
+
+def watch_qmp(qmp_sock: str, timeline: BootTimeline) -> None:
+    from .qmp import qmp_execute
+
+    while not timeline.stopped.is_set():
+        try:
+            qmp_execute(qmp_sock, 'query-status', timeout=1.0)
+            timeline.mark('qmp')
+            return
+        except Exception:
+            time.sleep(POLL_INTERVAL)
+
+
+def watch_guest_agent(qga_sock: str, timeline: BootTimeline) -> None:
+    """
+        pings the guest agent until it answers. QEMU accepts the connection long before the agent runs inside
+        the guest, unanswered pings are simply repeated.
+    """
+    while not timeline.stopped.is_set():
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(qga_sock)
+                s.settimeout(PING_INTERVAL)
+                buf = b''
+                while not timeline.stopped.is_set():
+                    s.sendall(b'{"execute": "guest-ping"}\n')
+                    try:
+                        data = s.recv(4096)
+                    except socket.timeout:
+                        continue
+                    if not data:
+                        break
+                    *lines, buf = (buf + data).split(b'\n')
+                    for line in lines:
+                        try:
+                            reply = json.loads(line)
+                        except ValueError:
+                            continue
+                        if 'return' in reply:
+                            timeline.mark('ready')
+                            return
+        except OSError:
+            pass
+        time.sleep(POLL_INTERVAL)
+
+
+def stop_when_ready(proc: subprocess.Popen, qmp_sock: str, timeline: BootTimeline, timeout: float) -> None:
+    """ quits QEMU once the guest is ready (and QMP up, to have its timestamp too) or `timeout` passed """
+    from .qmp import qmp_execute
+
+    while not (timeline.ready.wait(0.1) and 'qmp' in timeline.marks):
+        if proc.poll() is not None:
+            return
+        if timeline.elapsed() > timeout:
+            error('guest did not become ready within %.0fs', timeout)
+            break
+    try:
+        qmp_execute(qmp_sock, 'quit')
+    except Exception as e:
+        # QEMU closing the connection while quitting is fine, anything else: terminate it
+        logging.debug('QMP quit: %s', e)
+        if proc.poll() is None and 'qmp' not in timeline.marks:
+            proc.terminate()
+    try:
+        proc.wait(timeout=SHUTDOWN_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def boot_once(vm_dir: str, probe: ReadyProbe, app_factory=App, overlay_fn=create_overlay) -> dict[str, float]:
+    """
+        boots the VM on ephemeral disk overlays, returns seconds since launch by phase (phases not reached are missing)
+    """
+    handoff_re = re.compile(probe.handoff_regex)
+    ready_re = re.compile(probe.ready_regex) if probe.ready_regex and not probe.guest_agent else None
+    with tempfile.TemporaryDirectory(prefix='vmvm-bench-') as tmp_dir:
+        # the argv cache must not remember the overlay paths
+        app = app_factory(vm_dir, use_cache=False)
+        o = app.options
+        pid = read_running_pid(o.name)
+        if pid is not None:
+            raise BenchError(f'VM {o.name} is running (pid {pid}), stop it first')
+        o.disks = ephemeral_disks(o.disks, vm_dir, tmp_dir, overlay_fn)
+        o.control_socket = True
+        serial_path = os.path.join(tmp_dir, 'serial.log')
+        qga_sock = None
+        bench_qga_sock = None
+        if probe.guest_agent and o.guest_agent:
+            # the VM has its own agent channel, QEMU refuses a second port with the same name
+            qga_sock = get_unix_sock_path(SockType.QGA, o.name)
+        elif probe.guest_agent:
+            qga_sock = bench_qga_sock = os.path.join(tmp_dir, 'qga.sock')
+        app.extra_args = bench_args(serial_path, bench_qga_sock)
+        qmp_sock = get_unix_sock_path(SockType.QMP, o.name)
+
+        timeline = BootTimeline()
+        def on_started(proc):
+            timeline.mark('spawn')
+            watchers = [ (watch_serial, (serial_path, timeline, handoff_re, ready_re)), (watch_qmp, (qmp_sock, timeline)),
+                         (stop_when_ready, (proc, qmp_sock, timeline, probe.timeout)) ]
+            if qga_sock is not None:
+                watchers.append((watch_guest_agent, (qga_sock, timeline)))
+            for fn, args in watchers:
+                threading.Thread(target=fn, args=args, name=f'bench-{fn.__name__}', daemon=True).start()
+        app.on_started = on_started
+        exit_code = app.act_run()
+        timeline.stopped.set()
+        if exit_code != 0 and 'ready' not in timeline.marks:
+            raise BenchError(f'QEMU exited with code {exit_code}')
+        return dict(timeline.marks)
+
+
+def run_bench(vm_dir: str, probe: ReadyProbe, runs: int, app_factory=App, overlay_fn=create_overlay) -> list[dict[str, float]]:
+    results = []
+    for i in range(runs):
+        info('boot %d/%d', i + 1, runs)
+        results.append(boot_once(vm_dir, probe, app_factory, overlay_fn))
+    return results
+
+
+def percentile(values: list[float], p: float) -> float:
+    """ linear interpolation between the closest ranks """
+    s = sorted(values)
+    k = (len(s) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+def summarize(results: list[dict[str, float]]) -> dict[str, dict]:
+    """ percentiles, min and max of every phase over the runs that reached it """
+    summary = {}
+    for phase in PHASES:
+        values = [ r[phase] for r in results if phase in r ]
+        if not values:
+            continue
+        summary[phase] = dict({ f'p{p}': percentile(values, p) for p in PERCENTILES },
+                              count=len(values), min=min(values), max=max(values))
+    return summary
+
+
+def format_summary(summary: dict[str, dict], runs: int) -> str:
+    columns = [ f'p{p}' for p in PERCENTILES ] + [ 'min', 'max' ]
+    lines = [ f'boot timings over {runs} runs (ms since launch):  runs' + ''.join(f'{c:>9}' for c in columns) ]
+    for phase in PHASES:
+        if phase not in summary:
+            lines.append(f'  {phase:<12} {0:>36}')
+            continue
+        s = summary[phase]
+        lines.append(f'  {phase:<12} {s["count"]:>36}' + ''.join(f'{s[c] * 1000:9.1f}' for c in columns))
+    return '\n'.join(lines)
+
+
+def bench_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog='vmvm bench', description='Measure VM boot time on ephemeral disk overlays')
+    parser.add_argument('what', choices=['boot'])
+    parser.add_argument('dir_name', nargs='?', default=os.getcwd())
+    parser.add_argument('-n', '--runs', type=int, default=5, help='number of boots')
+    parser.add_argument('--ready-regex', default=None, help=f'guest is ready once the serial console matches (default "{DEFAULT_READY_REGEX}")')
+    parser.add_argument('--guest-agent', action='store_true', help='guest is ready once qemu-guest-agent answers guest-ping')
+    parser.add_argument('--handoff-regex', default=DEFAULT_HANDOFF_REGEX, help='serial console output of the guest kernel taking over from the firmware')
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds a boot may take until the guest is ready')
+    parser.add_argument('--json', action='store_true', help='print every run and the summary as JSON')
+    args = parser.parse_args(argv)
+    if args.guest_agent and args.ready_regex is not None:
+        parser.error('--guest-agent and --ready-regex cannot be combined')
+    if args.runs < 1:
+        parser.error('--runs must be at least 1')
+    for regex in (args.ready_regex, args.handoff_regex):
+        try:
+            re.compile(regex or '')
+        except re.error as e:
+            parser.error(f'invalid regex "{regex}": {e}')
+
+    logging.basicConfig(format='%(asctime)s  %(levelname)s  %(message)s', level=logging.INFO)
+    probe = ReadyProbe(handoff_regex=args.handoff_regex, ready_regex=args.ready_regex or DEFAULT_READY_REGEX,
+                       guest_agent=args.guest_agent, timeout=args.timeout)
+    try:
+        results = run_bench(args.dir_name, probe, args.runs)
+    except (BenchError, CloneError) as e:
+        error('%s', e)
+        return 1
+    summary = summarize(results)
+    if args.json:
+        print(json.dumps({ 'runs': results, 'summary': summary }, indent=2))
+    else:
+        print(format_summary(summary, len(results)))
+    return 0 if all('ready' in r for r in results) else 1
@@ -3,9 +3,10 @@ import os.path
 from pathlib import Path
 import logging
 import json
-from .utils import disk_image_format_by_name, get_unix_sock_path, SockType
+from .utils import disk_image_format_by_name, disk_spec, get_unix_sock_path, get_virtiofs_sock_path, get_passt_sock_path, SockType
+from .hw_caps import HostTopology
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 @dataclass
 class VMOptions:
@@ -20,14 +21,14 @@ class VMOptions:
     enable_boot_menu: bool
     enable_secureboot: bool
     enable_tpm: bool
-    disks: list[str]
+    disks: list[str | dict]
     disk_virtio_mode: str
     isoimages: list[str]
     need_cd: bool
     usbdevices: list
     share_dir_as_fat: str
     share_dir_as_floppy: str
-    share_dir_as_fsd: str
+    share_dir_as_fsd: list[dict] | None     # shares: path, tag, transport (virtiofs|9p), cache, thread_pool_size
     floppy: str
     nic_model: str
     nic_forward_ports: list
@@ -36,6 +37,18 @@ class VMOptions:
     display: str
     spice: str
     control_socket: bool
+    topology: str | dict | None = None
+    cpu_pinning: dict | None = None
+    hugepages: dict | None = None
+    disk_iothreads: bool = False
+    disk_cache: str | None = None   # None = pick per disk type
+    disk_aio: str | None = None     # None = pick per disk type and host io_uring support
+    log_file: dict | None = None    # QEMU output log: path, max_size (bytes), backups
+    efi_features: list = field(default_factory=list)   # firmware descriptor features the EFI firmware must have
+    net: list[dict] | None = None   # NICs: type (user|passt|tap|bridge), model, ifname, bridge, queues, vhost, mac, forward_ports;
+                                    # None = single NIC from nic_model/nic_forward_ports
+    balloon: dict | None = None     # virtio-balloon: free_page_reporting, deflate_on_oom, auto, min (bytes)
+    guest_agent: bool = False       # virtio-serial channel for qemu-guest-agent
 
     def __repr__(self) -> str:
         return json.dumps(dict(self.__dict__.items()),indent=4)
@@ -56,27 +69,183 @@ class VMOptions:
         'aarch64': 'aarch64',
         }[self.arch]
 
+    @property
+    def qmp_enabled(self) -> bool:
+        """ QMP socket is needed either by the user or by vmvm itself (e.g. to pin vCPU threads) """
+        return self.control_socket or self.cpu_pinning is not None or (self.balloon is not None and self.balloon['auto'])
+
 
 @dataclass
 class RuntimeOptions:
     spice_port: int
     tpm_socket: str
     has_cpu_topoext: bool
+    host_topology: HostTopology | None = None
+    use_hugepages: bool = True          # False if host lacks free huge pages and fallback is allowed
+    hugetlbfs_path: str | None = None   # mount point for hugepages backend=file
+    has_io_uring: bool = False
+    disk_l2_cache_sizes: list = field(default_factory=list)    # qcow2 l2-cache-size by disk index, None for QEMU default
+    firmware: dict | None = None        # EFI firmware selected from the descriptors, None = scan the edk2 dir
+    has_vhost_net: bool = True          # /dev/vhost-net is accessible
+    bridge_helper: str | None = None    # qemu-bridge-helper path, None = `-netdev bridge` with the QEMU built-in default
 
 @dataclass
 class ExecCommand:
     exe: str
     args: list[str]
 
+@dataclass
+class CopyFileCommand:
+    """ file copy done in-process by the launcher (no `cp` fork) """
+    src: str
+    dst: str
+
 @dataclass
 class CommonArgsBuildResult:
     args: list[str]
-    pre_commands: list[ExecCommand]
+    pre_commands: list[ExecCommand | CopyFileCommand]
+    messages: list[list] = field(default_factory=list)     # [logging level, text] logged at launch, also for a cached argv
 
 class CmdBuilder:
-    def __init__(self, listdir_fn=os.listdir, pathexists_fn=os.path.exists):
+    def __init__(self, listdir_fn=os.listdir, pathexists_fn=os.path.exists, base_dir: str = '.'):
         self._listdir = listdir_fn
         self._path_exists = pathexists_fn
+        self._base_dir = base_dir   # VM directory, relative paths in the options are relative to it
+        self._messages = []
+
+    def _note(self, level: int, msg: str) -> None:
+        """ the builder does not log itself: the argv may come from the cache, the launcher logs the messages """
+        self._messages.append([level, msg])
+
+    def smp_args(self, o: VMOptions, uo: RuntimeOptions) -> str:
+        if o.topology is None:
+            return str(o.cpus)
+        if o.topology == 'host':
+            # one socket, SMT width of the host (if it divides the vCPU count)
+            threads = uo.host_topology.threads if uo.host_topology else 1
+            while o.cpus % threads:
+                threads -= 1
+            sockets = 1
+            cores = o.cpus // threads
+        else:
+            sockets = o.topology.get('sockets', 1)
+            threads = o.topology.get('threads', 1)
+            cores = o.topology.get('cores', o.cpus // (sockets * threads))
+        return f'{o.cpus},sockets={sockets},cores={cores},threads={threads}'
+
+    def memory_backend_args(self, o: VMOptions, uo: RuntimeOptions) -> list[str]:
+        # vhost-user daemons (virtiofsd) map the guest RAM, it must be backed by a shareable file descriptor
+        shared = any(share['transport'] == 'virtiofs' for share in o.share_dir_as_fsd or [])
+        if o.hugepages is None or not uo.use_hugepages:
+            if shared:
+                return [ '-object', f'memory-backend-memfd,id=mem0,size={o.ram},share=on', '-machine', 'memory-backend=mem0' ]
+            return []
+        hp = o.hugepages
+        if hp['backend'] == 'file':
+            if uo.hugetlbfs_path is None:
+                raise FileNotFoundError(f"no hugetlbfs mount with pagesize={hp['size']} found")
+            backend = f"memory-backend-file,id=mem0,size={o.ram},mem-path={uo.hugetlbfs_path}"
+        else:
+            backend = f"memory-backend-memfd,id=mem0,size={o.ram},hugetlb=on,hugetlbsize={hp['size']}"
+        if hp['prealloc']:
+            backend += ',prealloc=on'
+        if hp['share'] or shared:
+            backend += ',share=on'
+        return [ '-object', backend, '-machine', 'memory-backend=mem0' ]
+
+    def efi_args(self, o: VMOptions, uo: RuntimeOptions, pre_commands: list) -> list[str]:
+        """
+            pflash drives of the EFI firmware; a missing local copy of the variables store is scheduled in `pre_commands`
+        """
+        if uo.firmware is not None:
+            fw = uo.firmware
+            code_fd, code_format = fw['code'], fw['code_format']
+            vars_fd_src, vars_format = fw['vars_template'], fw['vars_format']
+        else:
+            code_fd, vars_fd_src = self.scan_edk2_dir(o)
+            code_format = vars_format = 'raw'
+
+        if code_fd is None or vars_fd_src is None or not (self._path_exists(code_fd) and self._path_exists(vars_fd_src)):
+            package_name_suffix = {
+                'x86_64':  'ovmf',
+                'aarch64': 'aarch64',
+            }[o.arch]
+            raise FileNotFoundError(f'edk2 files not found. Please install edk2-{package_name_suffix} package.')
+
+        vars_fd_local = f'./{os.path.basename(vars_fd_src)}'
+        if not self._path_exists(vars_fd_local):
+            self._note(logging.INFO, f'{vars_fd_local} file does not exist in VM directory, copying from system')
+            pre_commands.append(CopyFileCommand(src=vars_fd_src, dst=vars_fd_local))
+
+        args = [
+            '-drive', f'if=pflash,format={code_format},readonly=on,file={code_fd}',
+            '-drive', f'if=pflash,format={vars_format},file={vars_fd_local}',
+        ]
+        if uo.firmware is not None and 'requires-smm' in uo.firmware['features']:
+            # secure boot builds keep the variable store writable only from System Management Mode
+            args += [ '-machine', 'smm=on', '-global', 'driver=cfi.pflash01,property=secure,value=on' ]
+        return args
+
+    def scan_edk2_dir(self, o: VMOptions) -> tuple[str | None, str | None]:
+        """ legacy lookup by file name in /usr/share/edk2/<arch> for hosts without firmware descriptors """
+        edk2_dir = f'/usr/share/edk2/{o.edk2_subdir}'
+        code_fd = None
+        vars_fd_src = None
+        for filename in self._listdir(edk2_dir):
+            if code_fd is None:
+                if 'CODE' in filename:
+                    if o.enable_secureboot:
+                        if 'secboot' in filename:
+                            code_fd = edk2_dir + '/' + filename
+                    else:
+                        if 'secboot' not in filename:
+                            code_fd = edk2_dir + '/' + filename
+            if vars_fd_src is None:
+                if 'VARS' in filename:
+                    vars_fd_src = edk2_dir + '/' + filename
+        return code_fd, vars_fd_src
+
+    def net_args(self, o: VMOptions, uo: RuntimeOptions) -> list[str]:
+        """
+            https://wiki.qemu.org/Documentation/Networking
+        """
+        nets = o.net
+        if nets is None:
+            nets = [] if o.nic_model == 'none' else [ { 'type': 'user', 'model': o.nic_model, 'forward_ports': o.nic_forward_ports, 'mac': None } ]
+        if not nets:
+            return [ '-nic', 'none' ]
+        args = []
+        for idx, net in enumerate(nets):
+            nic_model = 'virtio-net-pci' if net['model'] == 'virtio' else net['model']
+            device = f'{nic_model},netdev=net{idx}'
+            if net['type'] == 'user':
+                hostfwd = ''.join(f",hostfwd={bind_spec.get('proto', 'tcp')}::{bind_spec['host']}-:{bind_spec['guest']}" for bind_spec in net['forward_ports'])
+                netdev = f'user,id=net{idx}{hostfwd}'
+            elif net['type'] == 'passt':
+                # port forwarding is done by passt itself
+                netdev = f'stream,id=net{idx},server=off,addr.type=unix,addr.path={get_passt_sock_path(o.name, idx)}'
+            else:
+                if net['type'] == 'tap':
+                    # pre-created device (`ip tuntap add ... multi_queue user $USER`) or created by QEMU if privileged
+                    netdev = f'tap,id=net{idx},ifname={net["ifname"]},script=no,downscript=no'
+                elif uo.bridge_helper is not None:
+                    netdev = f'tap,id=net{idx},helper={uo.bridge_helper} --br={net["bridge"]}'
+                else:
+                    netdev = f'bridge,id=net{idx},br={net["bridge"]}'
+                if net['queues'] > 1:
+                    netdev += f',queues={net["queues"]}'
+                    if nic_model == 'virtio-net-pci':
+                        # one TX/RX vector pair per queue, plus config and control
+                        device += f',mq=on,vectors={2 * net["queues"] + 2}'
+                if net['vhost'] and not netdev.startswith('bridge,'):
+                    if uo.has_vhost_net:
+                        netdev += ',vhost=on'
+                    else:
+                        self._note(logging.WARNING, f'/dev/vhost-net is not accessible, net{idx} falls back to the QEMU userspace virtio-net backend')
+            if net['mac'] is not None:
+                device += f',mac={net["mac"]}'
+            args += [ '-netdev', netdev, '-device', device ]
+        return args
 
     def common_args(self, o: VMOptions, uo: RuntimeOptions) -> CommonArgsBuildResult:
 
@@ -84,17 +253,17 @@ class CmdBuilder:
         args = [
             '-name', o.name,
             '-machine', o.machine,
-            '-smp', str(o.cpus),
+            '-smp', self.smp_args(o, uo),
             '-m', o.ram,
-            #'-balloon', 'virtio',
             #'-localtime',
         ]
+        args += self.memory_backend_args(o, uo)
         cpu_model = o.cpu_model
         if cpu_model == 'host' and uo.has_cpu_topoext:
             cpu_model += ',+topoext'
         args += [ '-cpu', cpu_model ]
 
-        pre_commands: list[ExecCommand] = []
+        pre_commands: list[ExecCommand | CopyFileCommand] = []
 
         if o.enable_kvm:
             args += [ '-enable-kvm' ]
@@ -109,7 +278,7 @@ class CmdBuilder:
         if o.spice != 'none':
             if o.spice == 'unix':
                 spice_unix_sock_path = get_unix_sock_path(sock_type=SockType.SPICE, vm_name=o.name)
-                logging.info('SPICE server running on unix://%s', spice_unix_sock_path)
+                self._note(logging.INFO, f'SPICE server running on unix://{spice_unix_sock_path}')
 
                 args += [
                     '-spice', f'unix=on,addr={spice_unix_sock_path},disable-ticketing=on',
@@ -118,7 +287,7 @@ class CmdBuilder:
                 spice_port = o.spice
                 if spice_port == 'auto':
                     spice_port = uo.spice_port
-                logging.info('SPICE server running on tcp://localhost:%s', spice_port)
+                self._note(logging.INFO, f'SPICE server running on tcp://localhost:{spice_port}')
 
                 args += [
                     '-spice', f'port={spice_port},addr=127.0.0.1,disable-ticketing=on',
@@ -131,53 +300,32 @@ class CmdBuilder:
             ]
 
         # QMP
-        if o.control_socket:
+        if o.qmp_enabled:
             qmp_unix_sock_path = get_unix_sock_path(sock_type=SockType.QMP,vm_name=o.name)
             args += [ '-qmp', f'unix:{qmp_unix_sock_path},server,nowait', ]
-            logging.info('control socket available on unix://%s', qmp_unix_sock_path)
+            self._note(logging.INFO, f'control socket available on unix://{qmp_unix_sock_path}')
+
+        # qemu-guest-agent channel, used to freeze guest filesystems during backups
+        if o.guest_agent:
+            qga_unix_sock_path = get_unix_sock_path(sock_type=SockType.QGA,vm_name=o.name)
+            args += [
+                '-chardev', f'socket,id=qga0,path={qga_unix_sock_path},server=on,wait=off',
+                '-device', 'virtio-serial-pci,id=qgaserial0',
+                '-device', 'virtserialport,bus=qgaserial0.0,chardev=qga0,name=org.qemu.guest_agent.0',
+            ]
 
         # EFI
         if o.enable_efi:
-            edk2_dir = f'/usr/share/edk2/{o.edk2_subdir}'
-
-            # logic to locate edk2 files
-            edk2_dir_files = self._listdir(edk2_dir)
-            code_fd = None
-            vars_fd_src = None
-            for filename in edk2_dir_files:
-                if code_fd is None:
-                    if 'CODE' in filename:
-                        if o.enable_secureboot:
-                            if 'secboot' in filename:
-                                code_fd = edk2_dir + '/' + filename
-                        else:
-                            if 'secboot' not in filename:
-                                code_fd = edk2_dir + '/' + filename
-                if vars_fd_src is None:
-                    if 'VARS' in filename:
-                        vars_fd_src = edk2_dir + '/' + filename
-
-            vars_fd_local =  f'./{os.path.basename(vars_fd_src)}' if vars_fd_src else None
-
-            if self._path_exists(code_fd) and self._path_exists(vars_fd_src):
-
-                if not self._path_exists(vars_fd_local):
-                    logging.info(f'{vars_fd_local} file does not exist in VM directory, copying from system')
-                    pre_commands.append(ExecCommand(exe='cp',args=[vars_fd_src, '.']))
-
-                args += [
-                    '-drive', f'if=pflash,format=raw,readonly=on,file={code_fd}',
-                    '-drive', f'if=pflash,format=raw,file={vars_fd_local}',
-                ]
-
-            else:
-                #error('edk2 files not found. Please install edk2-ovmf package.')
-                package_name_suffix = {
-                    'x86_64':  'ovmf',
-                    'aarch64': 'aarch64',
-                }[o.arch]
-                raise FileNotFoundError(f'edk2 files not found. Please install edk2-{package_name_suffix} package.')
+            args += self.efi_args(o, uo, pre_commands)
 
+        # memory balloon, id is fixed: the auto-balloon controller reads guest stats from /machine/peripheral/balloon0
+        if o.balloon is not None:
+            device = 'virtio-balloon-pci,id=balloon0'
+            if o.balloon['free_page_reporting']:
+                device += ',free-page-reporting=on'
+            if o.balloon['deflate_on_oom']:
+                device += ',deflate-on-oom=on'
+            args += [ '-device', device ]
 
         # TPM
         if o.enable_tpm:
@@ -186,37 +334,89 @@ class CmdBuilder:
             ]
 
 
-        def generate_blockdev_desc(idx: int, filename: str,disk_virtio_mode: str) -> list[str]:
+        def iothread_id(idx: int, spec: dict) -> str | None:
+            iothread = spec.get('iothread', o.disk_iothreads)
+            if iothread is True:
+                return f'iothread{idx}'
+            if iothread:
+                return f'iothread-{iothread}'   # named group shared by several disks
+            return None
+
+        def io_options(spec: dict, is_host_device: bool) -> str:
+            # host block devices default to cache=none,aio=native; images to io_uring if both kernel and QEMU support it
+            cache = spec.get('cache', o.disk_cache) or ('none' if is_host_device else None)
+            aio = spec.get('aio', o.disk_aio) or ('native' if is_host_device else ('io_uring' if uo.has_io_uring else None))
+            if aio == 'native' and cache is None:
+                cache = 'none'  # aio=native requires O_DIRECT
+            opts = ''
+            if aio is not None:
+                opts += f',file.aio={aio}'
+            opts += {
+                None:        '',
+                'none':      ',cache.direct=on',
+                'writeback': ',cache.direct=off',
+                'unsafe':    ',cache.direct=off,cache.no-flush=on',
+            }[cache]
+            return opts
+
+        def qcow2_options(idx: int, spec: dict) -> str:
+            # metadata cache large enough to map the whole image, so random I/O does not re-read L2 tables
+            l2_cache = uo.disk_l2_cache_sizes[idx] if idx < len(uo.disk_l2_cache_sizes) else None
+            opts = f',l2-cache-size={l2_cache}' if l2_cache else ''
+            if 'cache_clean_interval' in spec:
+                opts += f',cache-clean-interval={spec["cache_clean_interval"]}'
+            return opts
+
+        def generate_blockdev_desc(idx: int, spec: dict, disk_virtio_mode: str) -> list[str]:
+            filename = spec['file']
             trim_options = 'discard=unmap,detect-zeroes=unmap'
             if '/dev' in filename:
+                node_name = f'hosthd{idx}'
                 d = [
-                    '-blockdev', f'driver=raw,node-name=hosthd{idx},file.driver=host_device,file.filename={filename},{trim_options}',
+                    '-blockdev', f'driver=raw,node-name={node_name},file.driver=host_device,file.filename={filename}{io_options(spec, True)},{trim_options}',
                 ]
             else:
-                img_format_driver = disk_image_format_by_name(filename)
+                node_name = f'hd{idx}'
+                img_format_driver = spec.get('format') or disk_image_format_by_name(filename)
                 d = [
-                   '-blockdev', f'driver={img_format_driver},node-name=hd{idx},file.driver=file,file.filename={filename},{trim_options}',
+                   '-blockdev', f'driver={img_format_driver},node-name={node_name},file.driver=file,file.filename={filename}{io_options(spec, False)}{qcow2_options(idx, spec) if img_format_driver == "qcow2" else ""},{trim_options}',
                 ]
 
-                if disk_virtio_mode == 'scsi':
-                    d += [
-                        '-device', f'scsi-hd,drive=hd{idx},bootindex={idx+1}',
-                    ]
-                elif disk_virtio_mode == 'blk':
-                    d += [
-                        '-device', f'virtio-blk-pci,id=virtblk{idx},num-queues=4,drive=hd{idx},bootindex={idx+1}',
-                        ]
-                else:
-                    d += [
-                        '-device', f'ide-hd,drive=hd{idx},bootindex={idx+1}',
+            if disk_virtio_mode == 'scsi':
+                d += [
+                    '-device', f'scsi-hd,drive={node_name},bootindex={idx+1}',
+                ]
+            elif disk_virtio_mode == 'blk':
+                iothread = iothread_id(idx, spec)
+                iothread_opt = f',iothread={iothread}' if iothread else ''
+                d += [
+                    '-device', f"virtio-blk-pci,id=virtblk{idx},num-queues={spec.get('queues', o.cpus)}{iothread_opt},drive={node_name},bootindex={idx+1}",
                     ]
+            else:
+                d += [
+                    '-device', f'ide-hd,drive={node_name},bootindex={idx+1}',
+                ]
             return d
 
         # disk images
+        disk_specs = [ disk_spec(disk) for disk in o.disks ]
+        iothreads = []
+        if o.disk_virtio_mode == 'scsi':
+            # all scsi-hd disks share one controller, so iothread and queues are set on the controller
+            if o.disk_iothreads:
+                iothreads.append('iothread-scsi0')
+        elif o.disk_virtio_mode == 'blk':
+            for idx, spec in enumerate(disk_specs):
+                iothread = iothread_id(idx, spec)
+                if iothread and iothread not in iothreads:
+                    iothreads.append(iothread)
+        for iothread in iothreads:
+            args += [ '-object', f'iothread,id={iothread}' ]
         if o.disk_virtio_mode == 'scsi':
-            args += [ '-device', 'virtio-scsi-pci,id=scsi0,num_queues=4' ]
-        for idx,disk in enumerate(o.disks):
-            args += generate_blockdev_desc(idx, disk, o.disk_virtio_mode)
+            iothread_opt = ',iothread=iothread-scsi0' if o.disk_iothreads else ''
+            args += [ '-device', f'virtio-scsi-pci,id=scsi0,num_queues={o.cpus}{iothread_opt}' ]
+        for idx,spec in enumerate(disk_specs):
+            args += generate_blockdev_desc(idx, spec, o.disk_virtio_mode)
 
         # floppy image
         if o.floppy is not None:
@@ -243,13 +443,19 @@ class CmdBuilder:
                 '-device', 'floppy,drive=fs_floppy',
             ]
 
-        # virtiofsd share
-        if o.share_dir_as_fsd is not None:
-            dir_abs = os.path.abspath(o.share_dir_as_fsd)
-            args += [
-                '-fsdev', f'local,security_model=passthrough,id=fsdev0,path={dir_abs}',
-                '-device', 'virtio-9p-pci,fsdev=fsdev0,mount_tag=hostshare',
-            ]
+        # shared directories: virtiofsd (vhost-user) or the QEMU built-in 9p server as a fallback
+        for idx, share in enumerate(o.share_dir_as_fsd or []):
+            if share['transport'] == 'virtiofs':
+                args += [
+                    '-chardev', f'socket,id=fsd{idx},path={get_virtiofs_sock_path(o.name, share["tag"])}',
+                    '-device', f'vhost-user-fs-pci,queue-size=1024,chardev=fsd{idx},tag={share["tag"]}',
+                ]
+            else:
+                dir_abs = os.path.abspath(os.path.join(self._base_dir, share['path']))
+                args += [
+                    '-fsdev', f'local,security_model=passthrough,id=fsdev{idx},path={dir_abs}',
+                    '-device', f'virtio-9p-pci,fsdev=fsdev{idx},mount_tag={share["tag"]}',
+                ]
 
         # emulated USB devices
         if o.machine == 'pc':
@@ -272,19 +478,7 @@ class CmdBuilder:
             args += [ '-device', f'usb-host,vendorid=0x{vendor_id},productid=0x{product_id}' ]
 
         # net
-        # https://wiki.qemu.org/Documentation/Networking
-
-        if o.nic_model != 'none':
-            if len(o.nic_forward_ports) > 0:
-                hostfwd_list = list(map(lambda bind_spec: f"hostfwd=tcp::{bind_spec['host']}-:{bind_spec['guest']}" , o.nic_forward_ports))
-                hostfwd = ','+','.join(hostfwd_list)
-            else:
-                hostfwd = ''
-            nic_model = o.nic_model
-            nic_model = 'virtio-net-pci' if nic_model == 'virtio' else nic_model
-            args += ['-netdev', f'user,id=net0{hostfwd}', '-device', f'{nic_model},netdev=net0' ]
-        else:
-            args += [ '-nic', 'none' ]
+        args += self.net_args(o, uo)
 
         # Sound Card (and PC speaker)
         match o.soundcard_model:
@@ -299,9 +493,9 @@ class CmdBuilder:
 
 
         if o.display == 'none':
-            logging.info(f"No GUI is configured, use SPICE{' or QMP socket' if o.control_socket else ''} to control")
+            self._note(logging.INFO, f"No GUI is configured, use SPICE{' or QMP socket' if o.control_socket else ''} to control")
 
-        return CommonArgsBuildResult(args=args, pre_commands=pre_commands)
+        return CommonArgsBuildResult(args=args, pre_commands=pre_commands, messages=self._messages)
 
     def boot_args(self, o: VMOptions, mode: str) -> list[str]:
         args = []
@@ -0,0 +1,273 @@
+#
+# CI mode: the VM is a throwaway runner. Disks are qcow2 overlays in a temporary directory and every other -drive
+# (the EFI variable store) is opened with -snapshot, so the VM disks and EFI variables are never modified. There is
+# no display, the first serial port is captured to a file. Several instances of one VM directory can run at the same
+# time, each with its own name (and so its own sockets, pid file and TPM state), MAC addresses and host forwarded
+# ports. The forwarded ports are leased from a PortRegistry, so concurrent `vmvm ci` runs never get the same one.
+# The job command and timeout are passed to the guest with fw_cfg; a runner in the guest reads them from
+# /sys/firmware/qemu_fw_cfg/by_name/opt/vmvm/ci/<key>/raw (qemu_fw_cfg kernel module).
+# https://www.qemu.org/docs/master/specs/fw_cfg.html
+#
+
+import os
+import re
+import time
+import random
+import shutil
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from logging import info, error
+
+from .main import App
+from .clone import create_overlay, CloneError
+from .bench import ephemeral_disks, BenchError
+from .builder import VMOptions
+from .port_registry import PortRegistry, PortRegistryError
+from .utils import get_runtime_dir, get_unix_sock_path, read_running_pid, SockType
+
+FW_CFG_PREFIX = 'opt/vmvm/ci'
+TIMEOUT_EXIT_CODE = 124     # as timeout(1)
+SHUTDOWN_TIMEOUT = 10.0
+# forwarded host ports are leased from here, below the ephemeral range (32768+) of outgoing connections
+CI_PORT_BASE = 20000
+
+
+class CIError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+@dataclass
+class CIJob:
+    command: str | None = None          # passed to the guest, vmvm does not run it
+    timeout: float | None = None        # seconds the instance may run, then QEMU is stopped
+    pass_regex: str | None = None       # the run passes only if the serial console matches
+    log_dir: str = '.'                  # serial console logs
+    overlay_dir: str | None = None      # parent of the temporary overlay directories, e.g. /dev/shm; default: $TMPDIR
+
+
+@dataclass
+class InstanceResult:
+    name: str
+    exit_code: int
+    duration: float
+    serial_log: str
+    timed_out: bool = False
+    ports: list[tuple[str, int, int]] = field(default_factory=list)    # (proto, configured host port, actual host port)
+
+
+def instance_name(name: str, index: int) -> str:
+    """ unique among concurrent `vmvm ci` runs: includes the pid """
+    return f'{name}-ci{os.getpid()}-{index}'
+
+
+def is_forward_port_free(port: int) -> bool:
+    """ QEMU binds forwarded ports on all addresses, for TCP or UDP; one lease serves both """
+    for kind in ( socket.SOCK_STREAM, socket.SOCK_DGRAM ):
+        with socket.socket(socket.AF_INET, kind) as s:
+            try:
+                s.bind(('', port))
+            except OSError:
+                return False
+    return True
+
+
+def random_mac() -> str:
+    """ in the QEMU OUI like the QEMU default, which is the same for every VM """
+    return '52:54:00:' + ':'.join(f'{random.randrange(256):02x}' for _ in range(3))
+
+
+def remap_forward_ports(ports: list[dict], port_fn) -> tuple[list[dict], list[tuple[str, int, int]]]:
+    """ forwarded ports with every host port replaced by `port_fn(proto)`, and the (proto, old, new) mapping """
+    remapped = []
+    mapping = []
+    for port in ports:
+        proto = port.get('proto', 'tcp')
+        host = port_fn(proto)
+        remapped.append(dict(port, host=host))
+        mapping.append((proto, port['host'], host))
+    return remapped, mapping
+
+
+def make_headless(o: VMOptions, name: str, instances: int, port_fn) -> list[tuple[str, int, int]]:
+    """
+        turns the VM options into a CI instance: own name, no display, SPICE or sound, QMP on, unique MACs and
+        host ports from `port_fn(proto)`. Returns the host port mapping.
+    """
+    o.name = name
+    o.display = 'none'
+    o.spice = 'none'
+    o.soundcard_model = 'none'
+    if o.gpu_model.endswith('-gl'):
+        # 3D acceleration needs a display
+        o.gpu_model = o.gpu_model[:-len('-gl')]
+    o.control_socket = True
+    mapping = []
+    if o.net is None and o.nic_model != 'none':
+        o.nic_forward_ports, mapping = remap_forward_ports(o.nic_forward_ports, port_fn)
+    elif o.net is not None:
+        nets = []
+        for idx, net in enumerate(o.net):
+            if net['type'] == 'tap' and instances > 1:
+                raise CIError(f'net{idx} uses tap device {net["ifname"]}, which only one instance can use')
+            forward_ports, net_mapping = remap_forward_ports(net['forward_ports'], port_fn)
+            mapping += net_mapping
+            nets.append(dict(net, forward_ports=forward_ports, mac=random_mac() if net['type'] in ('tap', 'bridge') else net['mac']))
+        o.net = nets
+    if o.cpu_pinning is not None and instances > 1:
+        logging.warning('all %d instances are pinned to the same host CPUs', instances)
+    return mapping
+
+
+def ci_args(serial_path: str, job: CIJob, index: int) -> list[str]:
+    """ extra QEMU arguments: -snapshot, serial port to a file and the job parameters for the guest """
+    fw_cfg = lambda key, value: [ '-fw_cfg', f'name={FW_CFG_PREFIX}/{key},string={value.replace(",", ",,")}' ]
+    args = [
+        '-snapshot',
+        '-chardev', f'file,id=ciserial,path={serial_path}',
+        '-serial', 'chardev:ciserial',
+    ] + fw_cfg('instance', str(index))
+    if job.command is not None:
+        args += fw_cfg('command', job.command)
+    if job.timeout is not None:
+        args += fw_cfg('timeout', str(int(job.timeout)))
+    return args
+
+
+def stop_after(proc: subprocess.Popen, qmp_sock: str, timeout: float, exited: threading.Event, timed_out: threading.Event) -> None:
+    """ quits QEMU if it is still running after `timeout` seconds """
+    from .qmp import qmp_execute
+
+    if exited.wait(timeout) or proc.poll() is not None:
+        return
+    timed_out.set()
+    error('timed out after %.0fs, stopping the VM', timeout)
+    try:
+        qmp_execute(qmp_sock, 'quit')
+    except Exception as e:
+        # QEMU closing the connection while quitting is fine
+        logging.debug('QMP quit: %s', e)
+    try:
+        proc.wait(timeout=SHUTDOWN_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def serial_matches(path: str, regex: str) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            return re.search(regex, f.read().decode('utf-8', errors='replace')) is not None
+    except OSError:
+        return False
+
+
+def run_instance(vm_dir: str, index: int, instances: int, job: CIJob, app_factory=App, overlay_fn=create_overlay) -> InstanceResult:
+    """
+        boots instance `index` of the VM on ephemeral disk overlays and waits until QEMU exits or the job times out.
+        The forwarded port leases and the runtime directory of the instance are released however it ends.
+    """
+    # the argv cache must not remember the overlay paths and the instance name
+    app = app_factory(vm_dir, use_cache=False)
+    o = app.options
+    vm_name = o.name
+    pid = read_running_pid(vm_name)
+    if pid is not None:
+        raise CIError(f'VM {vm_name} is running (pid {pid}) and holds its disks, stop it first')
+    serial_log = os.path.abspath(os.path.join(job.log_dir, f'{vm_name}-{index}.serial.log'))
+    name = instance_name(vm_name, index)
+    registry = PortRegistry(CI_PORT_BASE, name='ci-ports', port_free_fn=is_forward_port_free)
+    leases = []
+
+    def lease_port(proto: str) -> int:
+        lease = f'{name}/{len(leases)}'
+        port = registry.acquire(lease)
+        leases.append(lease)
+        return port
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='vmvm-ci-', dir=job.overlay_dir) as tmp_dir:
+            o.disks = ephemeral_disks(o.disks, vm_dir, tmp_dir, overlay_fn)
+            ports = make_headless(o, name, instances, lease_port)
+            for proto, configured, actual in ports:
+                info('%s: host port %s/%d forwarded as %d', o.name, proto, configured, actual)
+            if o.log_file is not None:
+                o.log_file = dict(o.log_file, path=os.path.abspath(os.path.join(job.log_dir, f'{vm_name}-{index}.qemu.log')))
+            app.extra_args = ci_args(serial_log, job, index)
+
+            exited = threading.Event()
+            timed_out = threading.Event()
+            if job.timeout is not None:
+                qmp_sock = get_unix_sock_path(SockType.QMP, o.name)
+                app.on_started = lambda proc: threading.Thread(target=stop_after, args=(proc, qmp_sock, job.timeout, exited, timed_out),
+                                                               name=f'ci-{index}-timeout', daemon=True).start()
+            start = time.monotonic()
+            try:
+                exit_code = app.act_run()
+            finally:
+                exited.set()
+            duration = time.monotonic() - start
+    finally:
+        for lease in leases:
+            registry.release(lease)
+        shutil.rmtree(os.path.join(get_runtime_dir(), name), ignore_errors=True)
+    if timed_out.is_set():
+        exit_code = TIMEOUT_EXIT_CODE
+    elif exit_code == 0 and job.pass_regex is not None and not serial_matches(serial_log, job.pass_regex):
+        error('%s: serial console does not match "%s"', o.name, job.pass_regex)
+        exit_code = 1
+    return InstanceResult(name=o.name, exit_code=exit_code, duration=duration, serial_log=serial_log,
+                          timed_out=timed_out.is_set(), ports=ports)
+
+
+def run_ci(vm_dir: str, instances: int, job: CIJob, app_factory=App, overlay_fn=create_overlay) -> list[InstanceResult]:
+    """ runs the instances concurrently, results are in instance order """
+    os.makedirs(job.log_dir, exist_ok=True)
+
+    def supervise(index: int) -> InstanceResult:
+        thread = threading.current_thread()
+        pool_name, thread.name = thread.name, f'ci-{index}'
+        try:
+            return run_instance(vm_dir, index, instances, job, app_factory, overlay_fn)
+        except (CIError, BenchError, CloneError, PortRegistryError) as e:
+            error('%s', e)
+            return InstanceResult(name=f'ci-{index}', exit_code=1, duration=0.0, serial_log='')
+        finally:
+            thread.name = pool_name
+
+    with ThreadPoolExecutor(max_workers=instances) as pool:
+        return list(pool.map(supervise, range(instances)))
+
+
+def ci_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog='vmvm ci', description='Run the VM as throwaway headless CI runners')
+    parser.add_argument('dir_name', nargs='?', default=os.getcwd())
+    parser.add_argument('-j', '--instances', type=int, default=1, help='instances of the VM running in parallel')
+    parser.add_argument('--command', help=f'job command for the guest, in fw_cfg {FW_CFG_PREFIX}/command')
+    parser.add_argument('--timeout', type=float, default=None, help=f'seconds an instance may run (exit code {TIMEOUT_EXIT_CODE} if exceeded), also in fw_cfg {FW_CFG_PREFIX}/timeout')
+    parser.add_argument('--pass-regex', default=None, help='an instance passes only if its serial console matches')
+    parser.add_argument('--log-dir', default='.', help='directory of the serial console logs')
+    parser.add_argument('--overlay-dir', default=None, help='where the temporary disk overlays go, e.g. /dev/shm (default: $TMPDIR)')
+    args = parser.parse_args(argv)
+    if args.instances < 1:
+        parser.error('--instances must be at least 1')
+    if args.timeout is not None and args.timeout <= 0:
+        parser.error('--timeout must be positive')
+    try:
+        re.compile(args.pass_regex or '')
+    except re.error as e:
+        parser.error(f'invalid regex "{args.pass_regex}": {e}')
+
+    logging.basicConfig(format='%(asctime)s  %(levelname)s  [%(threadName)s]  %(message)s', level=logging.INFO)
+    job = CIJob(command=args.command, timeout=args.timeout, pass_regex=args.pass_regex,
+                log_dir=args.log_dir, overlay_dir=args.overlay_dir)
+    results = run_ci(args.dir_name, args.instances, job)
+    for r in results:
+        status = 'timed out' if r.timed_out else f'exit code {r.exit_code}'
+        print(f'{r.name:<32} {status:<14} {r.duration:8.1f}s  {r.serial_log}')
+    return 0 if all(r.exit_code == 0 for r in results) else 1
@@ -0,0 +1,183 @@
+#
+# Linked clones: disks of a clone are qcow2 overlays whose backing file is the (read-only) disk of a golden
+# template VM. Only clusters written by the clone take space, so provisioning is a metadata-only operation.
+# `flatten` copies the backing data into the overlay (block-stream while the VM runs, qemu-img rebase otherwise)
+# and detaches the clone from its base.
+#
+
+import os
+import stat
+import glob
+import asyncio
+import argparse
+import logging
+import yaml
+from logging import info, error
+
+from .exec import exec_with_trace
+from .qmp import QMPPool
+from .config_parser import load_config
+from .qcow2 import create_args
+from .utils import disk_image_format_by_name, disk_spec, read_running_pid, copy_file
+
+CONFIG_NAME = 'vmconfig.yml'
+# EFI variables (boot entries) of the template are copied, not shared
+COPIED_FILES = [ '*VARS*' ]
+JOB_POLL_INTERVAL = 0.5
+
+
+class CloneError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+def create_overlay(path: str, base: str, cwd: str | None = None, spec: dict | None = None, base_format: str | None = None) -> int:
+    """
+        creates qcow2 image `path` backed by `base`; `base` is stored as an absolute path so the overlay can be used from anywhere.
+        Creation options (cluster_size etc.) are taken from the disk `spec`. The base is opened as `base_format`,
+        by default the format its file name implies; its header is not probed.
+    """
+    base = os.path.abspath(os.path.join(cwd or '.', base))
+    if not os.path.exists(base):
+        raise CloneError(f'base image {base} does not exist')
+    format_args, size_args = create_args(spec or { 'file': path }, with_size=False)
+    return exec_with_trace('qemu-img', ['create'] + format_args + ['-b', base, '-F', base_format or disk_image_format_by_name(base), path] + size_args, cwd=cwd)
+
+
+def protect_base(path: str) -> None:
+    """ writing to a base image silently corrupts every overlay on top of it """
+    mode = os.stat(path).st_mode
+    if mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+        info('making base image %s read-only', path)
+        os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def _is_host_device(path: str) -> bool:
+    return path.startswith('/dev/')
+
+
+def clone_config(conf: dict, template_dir: str, name: str) -> dict:
+    """
+        config of a linked clone of the template: every disk becomes a local qcow2 overlay of the template disk,
+        relative host paths (installation media, shared directories, log file) are made absolute
+    """
+    template_dir = os.path.abspath(template_dir)
+    absolute = lambda p: os.path.join(template_dir, os.path.expanduser(p))
+    conf = dict(conf, name=name)
+    disks = conf.pop('disk', conf.pop('disks', []))
+    new_disks = []
+    for idx, disk in enumerate(disks if type(disks) == list else [disks]):
+        spec = disk_spec(disk)
+        if _is_host_device(spec['file']):
+            raise CloneError(f'cannot clone host device {spec["file"]}')
+        stem = os.path.splitext(os.path.basename(spec['file']))[0]
+        if any(d['file'] == f'{stem}.qcow2' for d in new_disks):
+            # e.g. a/disk.img and b/disk.qcow2
+            stem = f'hd{idx}-{stem}'
+        # the overlay is always qcow2, and is created from the template disk rather than from its source image;
+        # the template disk keeps the format it is configured with
+        base_format = spec.get('format') or disk_image_format_by_name(spec['file'])
+        spec = { k: v for k, v in spec.items() if k not in ('format', 'from', 'base_format') }
+        new_disks.append(dict(spec, file=f'{stem}.qcow2', format='qcow2', base=absolute(spec['file']), base_format=base_format))
+    conf['disks'] = new_disks
+    if 'os_install' in conf:
+        isos = conf['os_install']
+        conf['os_install'] = [ absolute(p) for p in isos ] if type(isos) == list else absolute(isos)
+    for key in ( 'floppy', 'share_dir_as_fat', 'share_dir_as_floppy' ):
+        if conf.get(key):
+            conf[key] = absolute(conf[key])
+    if conf.get('share_dir_as_fsd'):
+        shares = conf['share_dir_as_fsd']
+        absolute_share = lambda share: dict(share, path=absolute(share['path'])) if type(share) == dict else absolute(share)
+        conf['share_dir_as_fsd'] = [ absolute_share(share) for share in shares ] if type(shares) == list else absolute_share(shares)
+    if conf.get('log_file'):
+        log_file = conf['log_file']
+        conf['log_file'] = dict(log_file, path=absolute(log_file['path'])) if type(log_file) == dict else absolute(log_file)
+    return conf
+
+
+def clone_vm(template_dir: str, new_dir: str, name: str | None = None) -> int:
+    """
+        creates VM directory `new_dir` with a linked clone of the template VM
+    """
+    from .main import App
+
+    with open(os.path.join(template_dir, CONFIG_NAME), 'rb') as f:
+        template_conf = load_config(f)
+    if os.path.exists(os.path.join(new_dir, CONFIG_NAME)):
+        raise CloneError(f'{os.path.join(new_dir, CONFIG_NAME)} already exists')
+    pid = read_running_pid(template_conf['name'])
+    if pid is not None:
+        raise CloneError(f'template VM "{template_conf["name"]}" is running (pid {pid}), shut it down first')
+
+    name = name or os.path.basename(os.path.abspath(new_dir))
+    conf = clone_config(template_conf, template_dir, name)
+    for disk in conf['disks']:
+        protect_base(disk['base'])
+    os.makedirs(new_dir, exist_ok=True)
+    with open(os.path.join(new_dir, CONFIG_NAME), 'w') as f:
+        f.write(f'# linked clone of {os.path.abspath(template_dir)}\n')
+        yaml.safe_dump(conf, f, sort_keys=False)
+    for pattern in COPIED_FILES:
+        for path in glob.glob(os.path.join(glob.escape(template_dir), pattern)):
+            copy_file(path, os.path.join(new_dir, os.path.basename(path)))
+    info('cloned %s to %s as "%s"', template_dir, new_dir, name)
+    return App(new_dir).act_init()
+
+
+async def flatten_async(qmp_sock: str, node_names: list[str], timeout: float | None = None) -> None:
+    """
+        streams the backing data into the given overlay nodes of a running VM in parallel and drops their backing files
+    """
+    async with QMPPool({ 'vm': qmp_sock }) as pool:
+        pending = {}
+        for node in node_names:
+            job_id = f'flatten-{node}'
+            # not auto-dismissed, so that the job outcome can be read after it ends
+            await pool.execute('vm', 'block-stream', { 'job-id': job_id, 'device': node, 'auto-dismiss': False })
+            pending[job_id] = node
+        errors = []
+        deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+        while pending:
+            for job in await pool.execute('vm', 'query-jobs'):
+                if job['id'] not in pending:
+                    continue
+                if job['status'] == 'concluded':
+                    node = pending.pop(job['id'])
+                    if 'error' in job:
+                        errors.append(f'{node}: {job["error"]}')
+                    else:
+                        info('%s is detached from its base', node)
+                    await pool.execute('vm', 'job-dismiss', { 'id': job['id'] })
+                elif job.get('total-progress'):
+                    logging.debug('%s: %d%%', job['id'], 100 * job['current-progress'] // job['total-progress'])
+            if pending and deadline is not None and asyncio.get_running_loop().time() > deadline:
+                raise CloneError(f'block-stream did not finish in time: {", ".join(pending.values())}')
+            if pending:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+        if errors:
+            raise CloneError('; '.join(errors))
+
+
+def flatten(qmp_sock: str, node_names: list[str], timeout: float | None = None) -> None:
+    asyncio.run(flatten_async(qmp_sock, node_names, timeout))
+
+
+def flatten_offline(path: str, cwd: str | None = None) -> int:
+    """ copies all data of the backing chain into the image and removes the backing file reference """
+    return exec_with_trace('qemu-img', ['rebase', '-f', 'qcow2', '-b', '', path], cwd=cwd)
+
+
+def clone_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog='vmvm clone', description='Create a linked clone of a template VM')
+    parser.add_argument('template_dir', help='directory of the template VM (its disks become read-only base images)')
+    parser.add_argument('new_dir', help='directory of the new VM')
+    parser.add_argument('--name', help='name of the new VM (default: new directory name)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s  %(levelname)s  %(message)s', level=logging.INFO)
+    try:
+        return clone_vm(args.template_dir, args.new_dir, args.name)
+    except CloneError as e:
+        error('%s', e)
+        return 1
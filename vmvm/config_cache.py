@@ -0,0 +1,171 @@
+#
+# Compiled config cache: `.vmvm-cache.json` next to vmconfig.yml stores the resolved VMOptions,
+# probed host capabilities and generated QEMU argv so that repeated invocations skip YAML parsing,
+# host probing (uname, /proc/cpuinfo, qemu-img) and firmware descriptor scans.
+#
+
+import os
+import json
+import glob
+import shutil
+import hashlib
+import threading
+import logging
+from dataclasses import asdict
+from .builder import VMOptions, RuntimeOptions, CommonArgsBuildResult
+from .hw_caps import HostTopology, HostCpu
+
+CACHE_FILE_NAME = '.vmvm-cache.json'
+CACHE_FORMAT = 2
+
+
+def _code_fingerprint() -> list:
+    """ vmvm sources take part in the key so that an upgrade invalidates generated argv """
+    pkg_dir = os.path.dirname(os.path.abspath(__file__))
+    return sorted((os.path.basename(p), os.stat(p).st_mtime_ns) for p in glob.glob(f'{pkg_dir}/*.py'))
+
+
+def host_fingerprint() -> dict:
+    """
+        cheap identification of the host state that probed capabilities depend on (changes on reboot or kernel update)
+    """
+    try:
+        with open('/proc/sys/kernel/random/boot_id', 'r') as f:
+            boot_id = f.read().strip()
+    except FileNotFoundError:
+        boot_id = None
+    return {
+        'boot_id': boot_id,
+        'kernel': os.uname().release,
+        'uid': os.getuid(),
+        'home': os.environ.get('HOME'),
+    }
+
+
+def binary_fingerprint(name: str) -> list | None:
+    """ identifies installed binary version by its path, size and mtime (no need to fork `--version`) """
+    path = shutil.which(name)
+    if path is None:
+        return None
+    st = os.stat(path)
+    return [path, st.st_size, st.st_mtime_ns]
+
+
+def host_topology_from_dict(d: dict | None) -> HostTopology | None:
+    if d is None:
+        return None
+    return HostTopology(cpus=[HostCpu(**c) for c in d['cpus']], sockets=d['sockets'], cores=d['cores'], threads=d['threads'])
+
+
+class ConfigCache:
+    def __init__(self, conf_path: str, enabled: bool = True):
+        self._dir = os.path.dirname(conf_path)
+        self._cache_path = os.path.join(self._dir, CACHE_FILE_NAME)
+        self._enabled = enabled
+        self._dirty = False
+        self._lock = threading.RLock()
+        with open(conf_path, 'rb') as f:
+            self._conf_bytes = f.read()
+        self._config_key = {
+            'format': CACHE_FORMAT,
+            'config_sha256': hashlib.sha256(self._conf_bytes).hexdigest(),
+            'vmvm': _code_fingerprint(),
+            # parse_config expands ~ and picks the prototype by host architecture
+            'home': os.environ.get('HOME'),
+            'arch': os.uname().machine,
+        }
+        self._data = self._read() if enabled else {}
+        if self._data.get('config_key') != json.loads(json.dumps(self._config_key)):
+            self._data = { 'config_key': self._config_key }
+            self._dirty = True
+
+    def _read(self) -> dict:
+        try:
+            with open(self._cache_path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._enabled or not self._dirty:
+                return
+            # unique per thread too, several App instances of one process (fleet, ci) may save at once
+            tmp_path = f'{self._cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(self._data, f)
+                os.replace(tmp_path, self._cache_path)
+                self._dirty = False
+            except OSError as e:
+                logging.debug('cannot write config cache %s: %s', self._cache_path, e)
+
+    def options(self, parse_fn) -> VMOptions:
+        """
+            returns cached options or calls `parse_fn(conf_bytes)` to build them
+        """
+        if 'options' in self._data:
+            logging.debug('config cache hit: %s', self._cache_path)
+            return VMOptions(**self._data['options'])
+        o = parse_fn(self._conf_bytes)
+        self._data['options'] = asdict(o)
+        self._dirty = True
+        return o
+
+    def _check_host_key(self, o: VMOptions) -> None:
+        host_key = json.loads(json.dumps({
+            'host': host_fingerprint(),
+            'qemu': binary_fingerprint(f'qemu-system-{o.qemu_binary}'),
+            'qemu-img': binary_fingerprint('qemu-img'),
+        }))
+        if self._data.get('host_key') != host_key:
+            self._data['host_key'] = host_key
+            self._data['host_caps'] = {}
+            self._data['argv'] = {}
+            self._dirty = True
+
+    def host_cap(self, o: VMOptions, name: str, probe_fn, valid_fn=None):
+        """
+            returns cached host capability `name` or probes it with `probe_fn()`;
+            `valid_fn(cached_value)` can reject a stale value (e.g. when it depends on files not covered by the host key).
+            Safe to call from concurrent startup steps, probes run unlocked.
+        """
+        with self._lock:
+            self._check_host_key(o)
+            caps = self._data['host_caps']
+            if name in caps and (valid_fn is None or valid_fn(caps[name])):
+                return host_topology_from_dict(caps[name]) if name == 'host_topology' else caps[name]
+        value = probe_fn()
+        with self._lock:
+            self._data['host_caps'][name] = asdict(value) if isinstance(value, HostTopology) else value
+            self._dirty = True
+        return value
+
+    def build_args(self, o: VMOptions, mode: str, runtime_options: RuntimeOptions, build_fn) -> CommonArgsBuildResult:
+        """
+            returns cached full argv for the mode and runtime options or calls `build_fn()` to build it.
+            Builds that need pre-commands (e.g. first-boot EFI vars copy) are not cached. Only data is cached:
+            the caller creates the runtime directory and logs the build messages whether the argv is cached or not.
+        """
+        with self._lock:
+            self._check_host_key(o)
+        argv_key = hashlib.sha256(json.dumps([mode, asdict(runtime_options)], sort_keys=True).encode()).hexdigest()
+        entry = self._data['argv'].get(argv_key)
+        if entry is not None and all(os.path.exists(os.path.join(self._dir, p)) for p in entry['paths']):
+            logging.debug('argv cache hit for mode "%s"', mode)
+            return CommonArgsBuildResult(args=entry['args'], pre_commands=[], messages=entry['messages'])
+        result = build_fn()
+        if not result.pre_commands:
+            with self._lock:
+                self._data['argv'][argv_key] = { 'args': result.args, 'paths': self._referenced_paths(result.args), 'messages': result.messages }
+                self._dirty = True
+        return result
+
+    @staticmethod
+    def _referenced_paths(args: list[str]) -> list[str]:
+        """ firmware files the argv points to; if one disappears the cached argv is rebuilt """
+        paths = []
+        for arg in args:
+            if arg.startswith('if=pflash,'):
+                paths += [ opt[len('file='):] for opt in arg.split(',') if opt.startswith('file=') ]
+        return paths
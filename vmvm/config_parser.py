@@ -1,18 +1,51 @@
 from .builder import VMOptions
 from .prototypes import prototype_config
+from .utils import parse_size, disk_image_format_by_name
+from .image import IMAGE_FORMATS
 import os
-import subprocess
+import re
+import yaml
+import hashlib
 from typing import Any
 import logging
 
+# libyaml-based loader is an order of magnitude faster, pure-Python one is the fallback
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# keys allowed in the dict form of a `disks` entry
+DISK_OPTIONS = { 'file', 'format', 'iothread', 'queues', 'cache', 'aio', 'base', 'base_format', 'from',
+                 'size', 'cluster_size', 'preallocation', 'lazy_refcounts', 'extended_l2', 'l2_cache', 'cache_clean_interval' }
+QCOW2_ONLY_DISK_OPTIONS = ( 'cluster_size', 'lazy_refcounts', 'extended_l2', 'l2_cache', 'cache_clean_interval' )
+DISK_PREALLOCATION_MODES = ( 'off', 'metadata', 'falloc', 'full' )
+DISK_CACHE_MODES = ( 'none', 'writeback', 'unsafe' )
+DISK_AIO_MODES = ( 'threads', 'native', 'io_uring' )
+# keys allowed in the dict form of a `share_dir_as_fsd` entry
+SHARE_OPTIONS = { 'path', 'tag', 'transport', 'cache', 'thread_pool_size' }
+SHARE_TRANSPORTS = ( 'virtiofs', '9p' )
+VIRTIOFS_CACHE_MODES = ( 'auto', 'always', 'metadata', 'never' )
+# keys allowed in a `net` entry
+NET_OPTIONS = { 'type', 'model', 'ifname', 'bridge', 'queues', 'vhost', 'mac', 'forward_ports' }
+NET_TYPES = ( 'user', 'passt', 'tap', 'bridge' )
+FORWARD_PROTOCOLS = ( 'tcp', 'udp' )
+MAX_TAP_QUEUES = 256
+
 class ConfigParserError(Exception):
     def __init__(self, msg: str):
         super().__init__(msg)
 
 
+def default_mac(vm_name: str, idx: int) -> str:
+    """ stable locally administered MAC, QEMU would give the same 52:54:00:12:34:56 to every VM on a bridge """
+    return '52:54:00:' + ':'.join(f'{b:02x}' for b in hashlib.sha256(f'{vm_name}/{idx}'.encode()).digest()[:3])
+
+
+def load_config(stream) -> dict:
+    return yaml.load(stream, Loader=YamlLoader)
+
+
 def parse_config(conf: dict) -> VMOptions:
 
-    running_hw_arch = subprocess.check_output(['uname', '-m']).decode().rstrip()
+    running_hw_arch = os.uname().machine
 
     consumed_opts = set()
     def consume(opt: str):
@@ -34,7 +67,123 @@ def parse_config(conf: dict) -> VMOptions:
         else:
             return _fs_expand_one(path)
 
-    o_disks = _fs_expand(_wrap_scalar_as_list(conf.get('disk', conf.get('disks', [])))); consume('disk'); consume('disks')
+    def _parse_disk(disk: str | dict) -> str | dict:
+        if type(disk) != dict:
+            return _fs_expand(disk)
+        if 'file' not in disk:
+            raise ConfigParserError(f'disk entry {disk} has no "file"')
+        unknown_keys = set(disk.keys()) - DISK_OPTIONS
+        if unknown_keys:
+            raise ConfigParserError(f'unrecognized disk options: {sorted(unknown_keys)}')
+        for key in ( 'format', 'base_format' ):
+            if key in disk and disk[key] not in IMAGE_FORMATS:
+                raise ConfigParserError(f'disk {key} must be one of {IMAGE_FORMATS}, got {disk[key]}')
+        is_qcow2 = (disk.get('format') or disk_image_format_by_name(disk.get('from', disk['file']))) == 'qcow2'
+        for key in QCOW2_ONLY_DISK_OPTIONS:
+            if key in disk and not is_qcow2:
+                raise ConfigParserError(f'disk option "{key}" applies to qcow2 images only ({disk["file"]})')
+        if 'cluster_size' in disk:
+            cluster_size = parse_size(disk['cluster_size'], default_suffix='B')
+            if cluster_size < 512 or cluster_size > (2 << 20) or cluster_size & (cluster_size - 1):
+                raise ConfigParserError(f'disk cluster_size must be a power of two between 512 and 2M, got {disk["cluster_size"]}')
+            if disk.get('extended_l2') and cluster_size < (16 << 10):
+                raise ConfigParserError('disk extended_l2 requires cluster_size of at least 16K')
+            disk = dict(disk, cluster_size=cluster_size)
+        if 'preallocation' in disk and disk['preallocation'] not in DISK_PREALLOCATION_MODES:
+            raise ConfigParserError(f'disk preallocation must be one of {DISK_PREALLOCATION_MODES}, got {disk["preallocation"]}')
+        if 'size' in disk:
+            disk = dict(disk, size=parse_size(disk['size'], default_suffix='B'))
+        if 'l2_cache' in disk:
+            # auto: cover the whole image, false: QEMU default, or explicit size
+            l2_cache = disk['l2_cache']
+            disk = dict(disk, l2_cache='auto' if l2_cache in ('auto', True) else (None if l2_cache is False else parse_size(l2_cache, default_suffix='B')))
+        if 'base' in disk:
+            if not is_qcow2:
+                raise ConfigParserError(f'disk {disk["file"]} has a base image, it must be a qcow2 overlay')
+            disk = dict(disk, base=_fs_expand(disk['base']))
+        elif 'base_format' in disk:
+            raise ConfigParserError(f'disk {disk["file"]} has "base_format" but no "base"')
+        if 'from' in disk:
+            if 'base' in disk:
+                raise ConfigParserError(f'disk {disk["file"]} has both "base" and "from", use one of them')
+            # a copy has the format of its template, whatever its own name says
+            disk = dict(disk, **{ 'from': _fs_expand(disk['from']), 'format': disk.get('format') or disk_image_format_by_name(disk['from']) })
+        return dict(disk, file=_fs_expand(disk['file']))
+
+    def _parse_forward_ports(ports: dict | list) -> list[dict]:
+        ports = _wrap_scalar_as_list(ports)
+        for port in ports:
+            if type(port) != dict or set(port.keys()) - { 'host', 'guest', 'proto' } or not { 'host', 'guest' } <= set(port.keys()):
+                raise ConfigParserError(f'port forwarding must be a dict with "host", "guest" and optional "proto", got {port}')
+            if port.get('proto', 'tcp') not in FORWARD_PROTOCOLS:
+                raise ConfigParserError(f'port forwarding proto must be one of {FORWARD_PROTOCOLS}, got {port["proto"]}')
+        return ports
+
+    def _parse_net(net: str | dict, idx: int) -> dict:
+        if type(net) != dict:
+            net = { 'type': net }
+        unknown_keys = set(net.keys()) - NET_OPTIONS
+        if unknown_keys:
+            raise ConfigParserError(f'unrecognized net options: {sorted(unknown_keys)}')
+        net_type = net.get('type', 'user')
+        if net_type not in NET_TYPES:
+            raise ConfigParserError(f'net type must be one of {NET_TYPES}, got {net_type}')
+        required = { 'user': None, 'passt': None, 'tap': 'ifname', 'bridge': 'bridge' }[net_type]
+        if required is not None and required not in net:
+            raise ConfigParserError(f'net type "{net_type}" requires "{required}"')
+        allowed = { 'user': { 'forward_ports' }, 'passt': { 'forward_ports' }, 'tap': { 'ifname', 'queues', 'vhost' }, 'bridge': { 'bridge', 'vhost' } }[net_type]
+        misplaced = set(net.keys()) - allowed - { 'type', 'model', 'mac' }
+        if misplaced:
+            raise ConfigParserError(f'net options {sorted(misplaced)} do not apply to type "{net_type}"')
+        queues = net.get('queues', 'auto' if net_type == 'tap' else 1)
+        if queues == 'auto':
+            queues = min(o_cpus, MAX_TAP_QUEUES)
+        if type(queues) != int or queues < 1:
+            raise ConfigParserError(f'net queues must be a positive integer or "auto", got {queues}')
+        mac = net.get('mac', None if net_type in ('user', 'passt') else default_mac(o_name, idx))
+        if mac is not None and not re.match(r'^([0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2}$', str(mac)):
+            raise ConfigParserError(f'invalid MAC address {mac}')
+        return {
+            'type': net_type,
+            'model': net.get('model', 'virtio'),
+            'ifname': net.get('ifname', None),
+            'bridge': net.get('bridge', None),
+            'queues': queues,
+            'vhost': net.get('vhost', net_type in ('tap', 'bridge')),
+            'mac': mac,
+            # the first NIC inherits nic_forward_ports, so `net: passt` is enough to switch an existing config
+            'forward_ports': _parse_forward_ports(net.get('forward_ports', o_nic_forward_ports if idx == 0 and net_type in ('user', 'passt') else [])),
+        }
+
+    def _parse_share(share: str | dict, idx: int) -> dict:
+        if type(share) != dict:
+            share = { 'path': share }
+        if 'path' not in share:
+            raise ConfigParserError(f'share_dir_as_fsd entry {share} has no "path"')
+        if 'dax' in share:
+            # upstream vhost-user-fs-pci has no DAX window (cache-size) and virtiofsd does not implement DAX
+            raise ConfigParserError('share option "dax" is not supported by upstream QEMU and virtiofsd, remove it')
+        unknown_keys = set(share.keys()) - SHARE_OPTIONS
+        if unknown_keys:
+            raise ConfigParserError(f'unrecognized share_dir_as_fsd options: {sorted(unknown_keys)}')
+        share = {
+            'path': _fs_expand(share['path']),
+            'tag': str(share.get('tag', 'hostshare' if idx == 0 else f'hostshare{idx}')),
+            'transport': share.get('transport', 'virtiofs'),
+            'cache': share.get('cache', 'auto'),
+            'thread_pool_size': share.get('thread_pool_size', None),
+        }
+        if share['transport'] not in SHARE_TRANSPORTS:
+            raise ConfigParserError(f'share transport must be one of {SHARE_TRANSPORTS}, got {share["transport"]}')
+        if share['cache'] not in VIRTIOFS_CACHE_MODES:
+            raise ConfigParserError(f'share cache must be one of {VIRTIOFS_CACHE_MODES}, got {share["cache"]}')
+        if share['thread_pool_size'] is not None and (type(share['thread_pool_size']) != int or share['thread_pool_size'] < 0):
+            raise ConfigParserError('share thread_pool_size must be a non-negative integer')
+        if share['transport'] == '9p' and share['thread_pool_size'] is not None:
+            raise ConfigParserError('share option "thread_pool_size" applies to virtiofs only')
+        return share
+
+    o_disks = list(map(_parse_disk, _wrap_scalar_as_list(conf.get('disk', conf.get('disks', []))))); consume('disk'); consume('disks')
 
     prototype_name = conf.get('prototype', f'default-{running_hw_arch}'); consume('prototype')
     if prototype_name == 'linux':
@@ -76,17 +225,48 @@ def parse_config(conf: dict) -> VMOptions:
 
     o_enable_boot_menu = conf.get('bootmenu',False); consume('bootmenu')
     o_enable_secureboot = conf.get('secureboot', False); consume('secureboot')
+    o_efi_features = conf.get('efi_features', []); consume('efi_features')
+    if type(o_efi_features) == str:
+        o_efi_features = [ o_efi_features ]
+    if type(o_efi_features) != list or not all(type(f) == str for f in o_efi_features):
+        raise ConfigParserError('efi_features must be a firmware feature name or a list of them')
     o_enable_tpm = conf.get('tpm', False); consume('tpm')
     o_disk_virtio_mode = conf.get('disk_virtio', 'blk'); consume('disk_virtio')
+    o_disk_iothreads = conf.get('disk_iothreads', False); consume('disk_iothreads')
+    o_disk_cache = conf.get('disk_cache', None); consume('disk_cache')
+    o_disk_aio = conf.get('disk_aio', None); consume('disk_aio')
+    for disk in [ dict() ] + o_disks:  # the empty dict validates the global defaults alone
+        if type(disk) != dict:
+            continue
+        cache = disk.get('cache', o_disk_cache)
+        aio = disk.get('aio', o_disk_aio)
+        if cache not in (None,) + DISK_CACHE_MODES:
+            raise ConfigParserError(f'disk cache must be one of {", ".join(DISK_CACHE_MODES)}')
+        if aio not in (None,) + DISK_AIO_MODES:
+            raise ConfigParserError(f'disk aio must be one of {", ".join(DISK_AIO_MODES)}')
+        if aio == 'native' and cache not in (None, 'none'):
+            raise ConfigParserError('disk aio "native" requires cache "none"')
+        misplaced = sorted(key for key in ('iothread', 'queues') if key in disk)
+        if misplaced and o_disk_virtio_mode != 'blk':
+            raise ConfigParserError(f'disk options {misplaced} apply to disk_virtio "blk" only ({disk["file"]}), '
+                                    'use disk_iothreads for the shared scsi controller')
     o_usbdevices =_wrap_scalar_as_list(conf.get('usb',[])); consume('usb')
     o_isoimages = _fs_expand(_wrap_scalar_as_list(conf.get('os_install',[]))); consume('os_install')
     o_need_cd = conf.get('need_cd', False); consume('need_cd')
     o_floppy = _fs_expand(conf.get('floppy', None)); consume('floppy')
     o_share_dir_as_fat = _fs_expand(conf.get('share_dir_as_fat', None)); consume('share_dir_as_fat')
     o_share_dir_as_floppy = _fs_expand(conf.get('share_dir_as_floppy', None)); consume('share_dir_as_floppy')
-    o_share_dir_as_fsd = _fs_expand(conf.get('share_dir_as_fsd', None)); consume('share_dir_as_fsd')
+    o_share_dir_as_fsd = conf.get('share_dir_as_fsd', None); consume('share_dir_as_fsd')
+    if o_share_dir_as_fsd is not None:
+        o_share_dir_as_fsd = [ _parse_share(share, i) for i, share in enumerate(_wrap_scalar_as_list(o_share_dir_as_fsd)) ]
+        tags = [ share['tag'] for share in o_share_dir_as_fsd ]
+        if len(set(tags)) != len(tags):
+            raise ConfigParserError(f'share_dir_as_fsd tags must be unique: {tags}')
     o_nic_model = conf.get('nic', 'none'); consume('nic')
-    o_nic_forward_ports = conf.get('nic_forward_ports', []); consume('nic_forward_ports')
+    o_nic_forward_ports = _parse_forward_ports(conf.get('nic_forward_ports', [])); consume('nic_forward_ports')
+    o_net = conf.get('net', None); consume('net')
+    if o_net is not None:
+        o_net = [ _parse_net(net, i) for i, net in enumerate(_wrap_scalar_as_list(o_net)) ]
     o_soundcard_model = conf.get('sound', 'none'); consume('sound')
 
     o_gpu_model = conf.get('gpu', 'qxl-vga'); consume('gpu')
@@ -99,6 +279,83 @@ def parse_config(conf: dict) -> VMOptions:
         raise ConfigParserError('cannot use SPICE if 3D acceleration is enabled')
 
     o_control_socket = conf.get('control_socket', False); consume('control_socket')
+    o_guest_agent = conf.get('guest_agent', False); consume('guest_agent')
+    if type(o_guest_agent) != bool:
+        raise ConfigParserError('guest_agent must be true or false')
+
+    o_balloon = conf.get('balloon', None); consume('balloon')
+    if o_balloon is False:
+        o_balloon = None
+    elif o_balloon is not None:
+        if o_balloon is True:
+            o_balloon = {}
+        if type(o_balloon) != dict:
+            raise ConfigParserError('balloon must be true/false or a dict')
+        unknown_keys = set(o_balloon.keys()) - {'free_page_reporting', 'deflate_on_oom', 'auto', 'min'}
+        if unknown_keys:
+            raise ConfigParserError(f'unrecognized balloon keys: {sorted(unknown_keys)}')
+        ram_bytes = parse_size(o_ram)
+        o_balloon = {
+            'free_page_reporting': o_balloon.get('free_page_reporting', True),
+            'deflate_on_oom': o_balloon.get('deflate_on_oom', True),
+            'auto': o_balloon.get('auto', False),
+            'min': parse_size(o_balloon['min']) if 'min' in o_balloon else ram_bytes // 2,
+        }
+        if not 0 < o_balloon['min'] <= ram_bytes:
+            raise ConfigParserError(f'balloon min must be between 0 and ram ({o_ram})')
+
+    o_topology = conf.get('topology', None); consume('topology')
+    if type(o_topology) == dict:
+        unknown_keys = set(o_topology.keys()) - {'sockets', 'cores', 'threads'}
+        if unknown_keys:
+            raise ConfigParserError(f'unrecognized topology keys: {sorted(unknown_keys)}')
+        sockets = o_topology.get('sockets', 1)
+        threads = o_topology.get('threads', 1)
+        cores = o_topology.get('cores', o_cpus // (sockets * threads))
+        if sockets * cores * threads != o_cpus:
+            raise ConfigParserError(f'topology {sockets} sockets x {cores} cores x {threads} threads does not match cpus={o_cpus}')
+    elif o_topology not in (None, 'host'):
+        raise ConfigParserError('topology must be "host" or a dict with sockets/cores/threads')
+
+    o_cpu_pinning = conf.get('cpu_pinning', None); consume('cpu_pinning')
+    if o_cpu_pinning is not None:
+        if o_cpu_pinning is True or o_cpu_pinning == 'auto':
+            o_cpu_pinning = { 'vcpus': 'auto' }
+        elif type(o_cpu_pinning) != dict or set(o_cpu_pinning.keys()) - {'vcpus', 'emulator', 'iothreads'}:
+            raise ConfigParserError('cpu_pinning must be "auto" or a dict with "vcpus", "emulator" and/or "iothreads"')
+
+    o_hugepages = conf.get('hugepages', None); consume('hugepages')
+    if o_hugepages is False:
+        o_hugepages = None
+    elif o_hugepages is not None:
+        if type(o_hugepages) != dict:
+            o_hugepages = { 'size': '2M' if o_hugepages is True else str(o_hugepages) }
+        unknown_keys = set(o_hugepages.keys()) - {'size', 'prealloc', 'share', 'backend', 'fallback'}
+        if unknown_keys:
+            raise ConfigParserError(f'unrecognized hugepages keys: {sorted(unknown_keys)}')
+        o_hugepages = {
+            'size': str(o_hugepages.get('size', '2M')).upper(),
+            'prealloc': o_hugepages.get('prealloc', False),
+            'share': o_hugepages.get('share', False),
+            'backend': o_hugepages.get('backend', 'memfd'),
+            'fallback': o_hugepages.get('fallback', False),
+        }
+        if o_hugepages['size'] not in ('2M', '1G'):
+            raise ConfigParserError('hugepages size must be 2M or 1G')
+        if o_hugepages['backend'] not in ('memfd', 'file'):
+            raise ConfigParserError('hugepages backend must be memfd or file')
+
+    o_log_file = conf.get('log_file', None); consume('log_file')
+    if o_log_file is not None:
+        if type(o_log_file) != dict:
+            o_log_file = { 'path': o_log_file }
+        if 'path' not in o_log_file or set(o_log_file.keys()) - {'path', 'max_size', 'backups'}:
+            raise ConfigParserError('log_file must be a path or a dict with "path", "max_size" and "backups"')
+        o_log_file = {
+            'path': _fs_expand(o_log_file['path']),
+            'max_size': parse_size(o_log_file.get('max_size', '10M')),
+            'backups': o_log_file.get('backups', 3),
+        }
 
     found_invalid_option = False
     for opt_name in conf.keys():
@@ -135,6 +392,17 @@ def parse_config(conf: dict) -> VMOptions:
         gpu_model=o_gpu_model,
         display=o_display,
         spice=o_spice,
-        control_socket=o_control_socket
+        control_socket=o_control_socket,
+        topology=o_topology,
+        cpu_pinning=o_cpu_pinning,
+        hugepages=o_hugepages,
+        disk_iothreads=o_disk_iothreads,
+        disk_cache=o_disk_cache,
+        disk_aio=o_disk_aio,
+        log_file=o_log_file,
+        efi_features=o_efi_features,
+        net=o_net,
+        balloon=o_balloon,
+        guest_agent=o_guest_agent,
     )
 
@@ -0,0 +1,88 @@
+import os
+import logging
+from dataclasses import dataclass, field
+from .hw_caps import HostTopology
+from .qmp import qmp_execute, wait_for_qmp
+from .utils import parse_cpu_list
+
+
+class CpuPinningError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+@dataclass
+class PinningPlan:
+    vcpus: list[int]        # host CPU for each vCPU index
+    emulator: list[int]     # host CPUs for all other QEMU threads (empty = leave as is)
+    iothreads: dict[str, list[int]] = field(default_factory=dict)  # iothread id (or '*' for any) -> host CPUs
+
+
+def make_pinning_plan(spec: dict, num_vcpus: int, host: HostTopology) -> PinningPlan:
+    """
+        resolves the `cpu_pinning` config section against the host topology.
+        `vcpus: auto` takes host CPUs in sibling order (so guest SMT threads land on host SMT siblings),
+        skipping those reserved for the emulator thread.
+    """
+    host_cpus = set(c.cpu for c in host.cpus)
+    emulator = parse_cpu_list(spec.get('emulator', []))
+    vcpus_spec = spec.get('vcpus', 'auto')
+    if vcpus_spec == 'auto':
+        vcpus = [cpu for cpu in host.sibling_ordered() if cpu not in emulator][:num_vcpus]
+    else:
+        vcpus = parse_cpu_list(vcpus_spec)
+
+    if len(vcpus) < num_vcpus:
+        raise CpuPinningError(f'need {num_vcpus} host CPUs to pin vCPUs, got {len(vcpus)}')
+    iothreads_spec = spec.get('iothreads', {})
+    if type(iothreads_spec) == dict:
+        iothreads = { iothread_id: parse_cpu_list(cpus) for iothread_id, cpus in iothreads_spec.items() }
+    else:
+        iothreads = { '*': parse_cpu_list(iothreads_spec) }
+
+    unknown = (set(vcpus) | set(emulator) | set(cpu for cpus in iothreads.values() for cpu in cpus)) - host_cpus
+    if unknown:
+        raise CpuPinningError(f'host CPUs not online: {sorted(unknown)}')
+    return PinningPlan(vcpus=vcpus[:num_vcpus], emulator=emulator, iothreads=iothreads)
+
+
+def list_process_threads(pid: int) -> list[int]:
+    return [ int(tid) for tid in os.listdir(f'/proc/{pid}/task') ]
+
+
+def apply_pinning(plan: PinningPlan, qmp_sock: str, qemu_pid: int,
+                  timeout: float = 30.0,
+                  setaffinity_fn=os.sched_setaffinity,
+                  listthreads_fn=list_process_threads) -> dict[int, int]:
+    """
+        pins vCPU threads (discovered via QMP query-cpus-fast), iothreads (query-iothreads) and the remaining QEMU threads.
+        Returns mapping vCPU thread id -> host CPU.
+    """
+    if not wait_for_qmp(qmp_sock, timeout):
+        raise CpuPinningError(f'QMP socket {qmp_sock} did not come up within {timeout}s')
+
+    vcpu_threads = {}
+    for cpu_info in qmp_execute(qmp_sock, 'query-cpus-fast'):
+        idx = cpu_info['cpu-index']
+        tid = cpu_info['thread-id']
+        host_cpu = plan.vcpus[idx]
+        setaffinity_fn(tid, {host_cpu})
+        vcpu_threads[tid] = host_cpu
+        logging.info('pinned vCPU %d (thread %d) to host CPU %d', idx, tid, host_cpu)
+
+    iothread_tids = set()
+    if plan.iothreads:
+        for iothread in qmp_execute(qmp_sock, 'query-iothreads'):
+            cpus = plan.iothreads.get(iothread['id'], plan.iothreads.get('*'))
+            if cpus:
+                setaffinity_fn(iothread['thread-id'], set(cpus))
+                iothread_tids.add(iothread['thread-id'])
+                logging.info('pinned %s (thread %d) to host CPUs %s', iothread['id'], iothread['thread-id'], cpus)
+
+    if plan.emulator:
+        for tid in listthreads_fn(qemu_pid):
+            if tid not in vcpu_threads and tid not in iothread_tids:
+                setaffinity_fn(tid, set(plan.emulator))
+        logging.info('pinned emulator threads to host CPUs %s', plan.emulator)
+
+    return vcpu_threads
@@ -1,16 +1,159 @@
 import subprocess
 import logging
-import io
+import os
 import re
+import queue
+import threading
 
-def exec_with_trace(executable_name: str, args: list[str]) -> int:
+RING_BUFFER_SIZE = 64 * 1024
+LOG_QUEUE_LINES = 10000
+READ_CHUNK = 64 * 1024
+
+
+class RingBuffer:
+    """
+        keeps the last `capacity` bytes written to it
+    """
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._buf = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self._buf += data
+        if len(self._buf) > self._capacity:
+            del self._buf[:len(self._buf) - self._capacity]
+
+    def getvalue(self) -> bytes:
+        return bytes(self._buf)
+
+
+class RotatingLogFile:
+    """
+        raw output log, rotated to <path>.1 ... <path>.<backups> when it grows over `max_bytes`
+    """
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._f = open(path, 'ab')
+        self._size = self._f.tell()
+
+    def write(self, data: bytes) -> None:
+        if self._size + len(data) > self._max_bytes and self._size > 0:
+            self._rotate()
+        self._f.write(data)
+        self._f.flush()
+        self._size += len(data)
+
+    def _rotate(self) -> None:
+        self._f.close()
+        for i in range(self._backups - 1, 0, -1):
+            if os.path.exists(f'{self._path}.{i}'):
+                os.replace(f'{self._path}.{i}', f'{self._path}.{i+1}')
+        if self._backups > 0:
+            os.replace(self._path, f'{self._path}.1')
+        self._f = open(self._path, 'wb')
+        self._size = 0
+
+    def close(self) -> None:
+        self._f.close()
+
+
+class OutputPump:
+    """
+        drains a process pipe on a background thread so the process never blocks on a full pipe.
+        Output goes to a ring buffer, an optional log file and (through a bounded queue, dropping lines
+        when the logging side falls behind) to `logging`.
+    """
+    def __init__(self, fd: int, ring_buffer_size: int = RING_BUFFER_SIZE, log_file: RotatingLogFile | None = None, echo: bool = True):
+        self._fd = fd
+        self.ring_buffer = RingBuffer(ring_buffer_size)
+        self._log_file = log_file
+        self._echo = echo
+        self._lines = queue.Queue(maxsize=LOG_QUEUE_LINES)
+        self.dropped_lines = 0
+        # named after the owner thread so that output of several VMs in one process can be told apart
+        owner = threading.current_thread().name
+        self._reader = threading.Thread(target=self._read_loop, name=f'{owner}-reader', daemon=True)
+        self._logger = threading.Thread(target=self._log_loop, name=owner, daemon=True)
+
+    def start(self) -> None:
+        self._reader.start()
+        if self._echo:
+            self._logger.start()
+
+    def join(self) -> None:
+        self._reader.join()
+        if self._echo:
+            self._logger.join()
+        if self.dropped_lines:
+            logging.warning('%d output lines were not logged because logging fell behind', self.dropped_lines)
+
+    def _emit_line(self, line: bytes) -> None:
+        if not self._echo:
+            return
+        try:
+            self._lines.put_nowait(line)
+        except queue.Full:
+            self.dropped_lines += 1
+
+    def _read_loop(self) -> None:
+        partial = b''
+        try:
+            while True:
+                data = os.read(self._fd, READ_CHUNK)
+                if not data:
+                    break
+                self.ring_buffer.write(data)
+                if self._log_file is not None:
+                    self._log_file.write(data)
+                lines = (partial + data).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    self._emit_line(line)
+        finally:
+            if partial:
+                self._emit_line(partial)
+            if self._log_file is not None:
+                self._log_file.close()
+            if self._echo:
+                self._lines.put(None)
+
+    def _log_loop(self) -> None:
+        while True:
+            line = self._lines.get()
+            if line is None:
+                return
+            logging.info(line.decode('utf-8', errors='replace').rstrip())
+
+
+def exec_with_trace(executable_name: str, args: list[str], on_start=None, log_file: dict | None = None, cwd: str | None = None) -> int:
+    """
+        runs the process, echoing its output to the log. `on_start(proc)` is invoked right after spawning.
+        `log_file` (dict with path/max_size/backups) additionally saves the raw output to a size-rotated file.
+        On non-zero exit the last output is dumped from the ring buffer. `cwd` is the working directory of the process.
+    """
     real_args = [executable_name] + args
     logging.info('running %s with args: %s', executable_name, ' '.join(map(lambda x: '\n'+x if re.match('^-+', x) else x, real_args)))
-    proc = subprocess.Popen(args=real_args,stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    # opened first: failing to open it must not leave a process behind whose output nobody reads
+    output_file = RotatingLogFile(log_file['path'], log_file['max_size'], log_file['backups']) if log_file else None
+    try:
+        proc = subprocess.Popen(args=real_args,stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
+    except BaseException:
+        if output_file is not None:
+            output_file.close()
+        raise
+    if on_start is not None:
+        on_start(proc)
+    pump = OutputPump(proc.stdout.fileno(), log_file=output_file)
     logging.info('-'*80)
-    for line in io.TextIOWrapper(proc.stdout, encoding='utf-8'):
-        logging.info(line.rstrip())
+    pump.start()
     exit_code = proc.wait()
+    pump.join()
+    proc.stdout.close()
     logging.info('-'*80)
     logging.info('%s exited with code %d', executable_name, exit_code)
-    return exit_code
\ No newline at end of file
+    if exit_code != 0:
+        tail = pump.ring_buffer.getvalue().decode('utf-8', errors='replace')
+        logging.error('last %d bytes of %s output:\n%s', len(tail), executable_name, tail)
+    return exit_code
@@ -0,0 +1,111 @@
+#
+# Firmware selection from QEMU firmware descriptors (the same files libvirt uses).
+# https://www.qemu.org/docs/master/interop/firmware.html
+#
+# Descriptors are searched in the user config dir, /etc and /usr/share; a file in an earlier dir overrides
+# (or, if empty, masks) the file with the same name in a later dir. Candidates are ordered by file name.
+#
+
+import os
+import json
+import fnmatch
+import logging
+
+DESCRIPTOR_DIRS = [
+    os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config')), 'qemu/firmware'),
+    '/etc/qemu/firmware',
+    '/usr/share/qemu/firmware',
+]
+# machine aliases resolve to the latest versioned machine type
+MACHINE_ALIASES = {
+    'q35': 'pc-q35-latest',
+    'pc':  'pc-i440fx-latest',
+    'virt': 'virt-latest',
+}
+# confidential computing builds are not usable by a regular VM
+EXCLUDED_FEATURES = { 'amd-sev', 'amd-sev-es', 'amd-sev-snp', 'intel-tdx' }
+
+
+def descriptor_dirs_stamp(dirs: list[str] = DESCRIPTOR_DIRS) -> list:
+    """ mtimes of the descriptor dirs: installing or removing a firmware package changes one of them """
+    stamp = []
+    for d in dirs:
+        try:
+            stamp.append([d, os.stat(d).st_mtime_ns])
+        except OSError:
+            stamp.append([d, None])
+    return stamp
+
+
+def _parse_descriptor(name: str, d: dict) -> dict | None:
+    """ a flash firmware with separate code and variables template, None for other kinds (BIOS, memory, kernel) """
+    mapping = d.get('mapping', {})
+    if 'uefi' not in d.get('interface-types', []) or mapping.get('device') != 'flash' or mapping.get('mode', 'split') != 'split':
+        return None
+    if 'nvram-template' not in mapping:
+        return None
+    return {
+        'name': name,
+        'code': mapping['executable']['filename'],
+        'code_format': mapping['executable'].get('format', 'raw'),
+        'vars_template': mapping['nvram-template']['filename'],
+        'vars_format': mapping['nvram-template'].get('format', 'raw'),
+        'targets': [ [t['architecture'], t.get('machines', [])] for t in d.get('targets', []) ],
+        'features': d.get('features', []),
+    }
+
+
+def read_firmware_descriptors(dirs: list[str] = DESCRIPTOR_DIRS) -> list[dict]:
+    """
+        usable EFI firmware from the descriptors in `dirs`, in priority order
+    """
+    files = {}
+    for d in reversed(dirs):
+        try:
+            names = os.listdir(d)
+        except OSError:
+            continue
+        for name in names:
+            if name.endswith('.json'):
+                files[name] = os.path.join(d, name)
+    firmware = []
+    for name in sorted(files):
+        path = files[name]
+        try:
+            if os.path.getsize(path) == 0:
+                continue
+            with open(path, 'r') as f:
+                fw = _parse_descriptor(name, json.load(f))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning('ignoring firmware descriptor %s: %s', path, e)
+            continue
+        if fw is not None and os.path.exists(fw['code']) and os.path.exists(fw['vars_template']):
+            firmware.append(fw)
+    return firmware
+
+
+def read_firmware_index(dirs: list[str] = DESCRIPTOR_DIRS) -> dict:
+    return { 'stamp': descriptor_dirs_stamp(dirs), 'firmware': read_firmware_descriptors(dirs) }
+
+
+def firmware_index_valid(index: dict, dirs: list[str] = DESCRIPTOR_DIRS) -> bool:
+    return index['stamp'] == json.loads(json.dumps(descriptor_dirs_stamp(dirs)))
+
+
+def _supports_target(fw: dict, arch: str, machine: str) -> bool:
+    machine = MACHINE_ALIASES.get(machine, machine)
+    return any(a == arch and any(fnmatch.fnmatch(machine, m) for m in machines) for a, machines in fw['targets'])
+
+
+def select_firmware(firmware: list[dict], arch: str, machine: str, secure_boot: bool, features: list[str] = []) -> dict | None:
+    """
+        first firmware for the target that has all required `features` (plus `secure-boot` if enabled).
+        Secure boot firmware with enrolled (Microsoft) keys is preferred, without secure boot it is excluded.
+    """
+    required = set(features) | ({ 'secure-boot' } if secure_boot else set())
+    excluded = (EXCLUDED_FEATURES | (set() if secure_boot else { 'secure-boot' })) - required
+    candidates = [ fw for fw in firmware
+                   if _supports_target(fw, arch, machine) and required <= set(fw['features']) and not excluded & set(fw['features']) ]
+    if secure_boot:
+        candidates.sort(key=lambda fw: 'enrolled-keys' not in fw['features'])
+    return candidates[0] if candidates else None
@@ -0,0 +1,191 @@
+#
+# Fleet mode: run, stop or query many VMs from one process.
+# Every VM is supervised on its own thread named after the VM directory; boots are throttled
+# with a semaphore so that dozens of guests do not hit the host disk at the same moment.
+#
+
+import os
+import glob
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import info, error
+
+from .main import App
+from .qmp import qmp_execute_all
+from .utils import get_unix_sock_path, SockType
+
+CONFIG_NAME = 'vmconfig.yml'
+DEFAULT_MAX_BOOTS = 4
+DEFAULT_BOOT_WINDOW = 30.0
+
+
+class FleetError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+def expand_targets(targets: list[str]) -> list[str]:
+    """
+        resolves VM directories and glob patterns to a list of absolute directories containing vmconfig.yml
+    """
+    dirs = []
+    for target in targets:
+        if glob.has_magic(target):
+            matches = [ d for d in sorted(glob.glob(target)) if os.path.isfile(os.path.join(d, CONFIG_NAME)) ]
+            if not matches:
+                raise FleetError(f'no VM directories match "{target}"')
+        elif os.path.isfile(os.path.join(target, CONFIG_NAME)):
+            matches = [target]
+        else:
+            raise FleetError(f'{CONFIG_NAME} not found in "{target}"')
+        for d in matches:
+            d = os.path.abspath(d)
+            if d not in dirs:
+                dirs.append(d)
+    return dirs
+
+
+def vm_label(vm_dir: str) -> str:
+    return os.path.basename(vm_dir.rstrip('/'))
+
+
+class BootSlot:
+    """
+        one permit of the boot semaphore; released once, either after the boot window or when the VM exits
+    """
+    def __init__(self, semaphore: threading.Semaphore):
+        self._semaphore = semaphore
+        self._lock = threading.Lock()
+        self._held = False
+
+    def acquire(self) -> None:
+        self._semaphore.acquire()
+        self._held = True
+
+    def release(self) -> None:
+        with self._lock:
+            if self._held:
+                self._held = False
+                self._semaphore.release()
+
+
+def run_fleet(vm_dirs: list[str], mode: str = 'run',
+              max_boots: int = DEFAULT_MAX_BOOTS,
+              boot_window: float = DEFAULT_BOOT_WINDOW,
+              jobs: int | None = None,
+              use_cache: bool = True,
+              app_factory=App) -> dict[str, int]:
+    """
+        runs the VMs concurrently and returns exit codes by VM directory.
+        At most `max_boots` VMs are booting at a time, a VM counts as booting from launch until `boot_window`
+        seconds after QEMU is spawned. `jobs` limits the number of VMs running at the same time (default: all).
+    """
+    boot_semaphore = threading.Semaphore(max_boots)
+    results = {}
+
+    def supervise(vm_dir: str) -> None:
+        thread = threading.current_thread()
+        pool_name, thread.name = thread.name, vm_label(vm_dir)
+        slot = BootSlot(boot_semaphore)
+        try:
+            slot.acquire()
+            app = app_factory(vm_dir, use_cache=use_cache)
+            def on_started(proc):
+                timer = threading.Timer(boot_window, slot.release)
+                timer.daemon = True
+                timer.start()
+            app.on_started = on_started
+            results[vm_dir] = getattr(app, 'act_'+mode)() or 0
+        except BaseException as e:
+            # SystemExit included: one VM refusing to start must not take the others down
+            error('failed to %s VM: %s', mode, e)
+            results[vm_dir] = e.code if isinstance(e, SystemExit) and isinstance(e.code, int) and e.code else 1
+        finally:
+            slot.release()
+            thread.name = pool_name
+
+    with ThreadPoolExecutor(max_workers=jobs or len(vm_dirs) or 1) as pool:
+        for vm_dir in vm_dirs:
+            pool.submit(supervise, vm_dir)
+    return results
+
+
+def _qmp_sock(vm_dir: str, use_cache: bool) -> str:
+    o = App(vm_dir, use_cache=use_cache).options
+    if not o.qmp_enabled:
+        raise FleetError('control_socket is not enabled')
+    return get_unix_sock_path(SockType.QMP, o.name)
+
+
+def qmp_fleet(vm_dirs: list[str], command: str, arguments: dict | None = None,
+              use_cache: bool = True, sock_fn=_qmp_sock) -> dict[str, tuple[bool, object]]:
+    """
+        sends the QMP command to every VM concurrently.
+        Returns (ok, QMP result or error text) by VM directory; VMs without a QMP socket are reported as not running.
+    """
+    results = {}
+    sockets = {}
+    for vm_dir in vm_dirs:
+        try:
+            sock_path = sock_fn(vm_dir, use_cache)
+        except Exception as e:
+            results[vm_dir] = (False, str(e) or type(e).__name__)
+            continue
+        if os.path.exists(sock_path):
+            sockets[vm_dir] = sock_path
+        else:
+            results[vm_dir] = (False, 'not running')
+    for vm_dir, r in qmp_execute_all(sockets, command, arguments).items():
+        results[vm_dir] = (True, r['return']) if 'return' in r else (False, r['error'])
+    return results
+
+
+def fleet_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog='vmvm fleet', description='Run, stop or query many VMs at once')
+    parser.add_argument('cmd', choices=['run','stop','status'])
+    parser.add_argument('targets', nargs='+', help='VM directories or glob patterns')
+    parser.add_argument('--max-boots', type=int, default=DEFAULT_MAX_BOOTS, help='VMs booting at the same time')
+    parser.add_argument('--boot-window', type=float, default=DEFAULT_BOOT_WINDOW, help='seconds a VM counts as booting after QEMU is spawned')
+    parser.add_argument('--jobs', type=int, default=None, help='VMs running at the same time (default: all)')
+    parser.add_argument('--force', action='store_true', help='stop: quit QEMU immediately instead of ACPI powerdown')
+    parser.add_argument('--no-cache', action='store_true', help='ignore and do not write the compiled config cache')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s  %(levelname)s  [%(threadName)s]  %(message)s',
+                        level=logging.DEBUG if args.cmd == 'run' else logging.WARNING)
+
+    try:
+        vm_dirs = expand_targets(args.targets)
+    except FleetError as e:
+        error('%s', e)
+        return 2
+
+    if args.cmd == 'run':
+        if args.max_boots < 1:
+            parser.error('--max-boots must be positive')
+        info('starting %d VMs, at most %d booting at a time', len(vm_dirs), args.max_boots)
+        results = run_fleet(vm_dirs, max_boots=args.max_boots, boot_window=args.boot_window,
+                            jobs=args.jobs, use_cache=not args.no_cache)
+        failed = { d: code for d, code in results.items() if code != 0 }
+        for vm_dir in vm_dirs:
+            print(f'{vm_label(vm_dir):<24} exit code {results.get(vm_dir, 1)}')
+        if failed:
+            error('%d of %d VMs failed: %s', len(failed), len(vm_dirs), ', '.join(map(vm_label, failed)))
+            return 1
+        return 0
+
+    command = 'query-status' if args.cmd == 'status' else ('quit' if args.force else 'system_powerdown')
+    results = qmp_fleet(vm_dirs, command, use_cache=not args.no_cache)
+    exit_code = 0
+    for vm_dir in vm_dirs:
+        ok, value = results[vm_dir]
+        if args.cmd == 'status':
+            state = value['status'] if ok else value
+        else:
+            state = 'stopping' if ok else value
+            if not ok and value != 'not running':
+                exit_code = 1
+        print(f'{vm_label(vm_dir):<24} {state}')
+    return exit_code
@@ -1,4 +1,11 @@
 import re
+import os
+import logging
+import subprocess
+from dataclasses import dataclass
+from .utils import parse_cpu_list, parse_size
+
+SYSFS_ROOT = '/sys'
 
 def check_has_topoext() -> bool:
     """
@@ -9,4 +16,192 @@ def check_has_topoext() -> bool:
             if re.match('^flags.+', line):
                 if re.search('topoext', line):
                     return True
-    return False
\ No newline at end of file
+    return False
+
+
+@dataclass
+class HostCpu:
+    cpu: int
+    package: int
+    core: int
+
+
+@dataclass
+class HostTopology:
+    cpus: list[HostCpu]
+    sockets: int
+    cores: int      # per socket
+    threads: int    # per core
+
+    def sibling_ordered(self) -> list[int]:
+        """
+            host CPU numbers ordered so that SMT siblings of one core are adjacent
+        """
+        return [c.cpu for c in sorted(self.cpus, key=lambda c: (c.package, c.core, c.cpu))]
+
+
+def read_host_topology(sysfs_root: str = SYSFS_ROOT) -> HostTopology:
+    """
+        reads CPU topology of the online host CPUs from sysfs
+    """
+    cpu_dir = f'{sysfs_root}/devices/system/cpu'
+    online_path = f'{cpu_dir}/online'
+    if os.path.exists(online_path):
+        with open(online_path, 'r') as f:
+            online = parse_cpu_list(f.read())
+    else:
+        online = sorted(int(d[3:]) for d in os.listdir(cpu_dir) if re.match(r'^cpu\d+$', d))
+
+    def read_int(cpu: int, name: str) -> int:
+        with open(f'{cpu_dir}/cpu{cpu}/topology/{name}', 'r') as f:
+            return int(f.read().strip())
+
+    cpus = [ HostCpu(cpu=cpu, package=read_int(cpu, 'physical_package_id'), core=read_int(cpu, 'core_id')) for cpu in online ]
+    if not cpus:
+        raise FileNotFoundError(f'no CPUs found in {cpu_dir}')
+
+    packages = { c.package for c in cpus }
+    cores = { (c.package, c.core) for c in cpus }
+    return HostTopology(
+        cpus=cpus,
+        sockets=len(packages),
+        cores=len(cores) // len(packages),
+        threads=len(cpus) // len(cores),
+    )
+
+
+@dataclass
+class HugepagePool:
+    page_size: int      # bytes
+    total: int          # pages
+    free: int
+    reserved: int
+
+    @property
+    def available(self) -> int:
+        """ pages that can still be claimed (free pages minus those promised to other mappings) """
+        return self.free - self.reserved
+
+
+def read_hugepage_pools(sysfs_root: str = SYSFS_ROOT) -> dict[int, HugepagePool]:
+    """
+        reads /sys/kernel/mm/hugepages, returns pools keyed by page size in bytes
+    """
+    pools = {}
+    hp_dir = f'{sysfs_root}/kernel/mm/hugepages'
+    if not os.path.isdir(hp_dir):
+        return pools
+    for d in os.listdir(hp_dir):
+        m = re.match(r'^hugepages-(\d+)kB$', d)
+        if not m:
+            continue
+        def read_int(name: str) -> int:
+            with open(f'{hp_dir}/{d}/{name}', 'r') as f:
+                return int(f.read().strip())
+        page_size = int(m.group(1)) * 1024
+        pools[page_size] = HugepagePool(page_size=page_size, total=read_int('nr_hugepages'), free=read_int('free_hugepages'), reserved=read_int('resv_hugepages'))
+    return pools
+
+
+def check_hugepages(ram: str, page_size: str, sysfs_root: str = SYSFS_ROOT) -> str | None:
+    """
+        checks that the host has enough free huge pages to back `ram`. Returns problem description or None if OK
+    """
+    ram_bytes = parse_size(ram)
+    page_bytes = parse_size(page_size)
+    pools = read_hugepage_pools(sysfs_root)
+    if page_bytes not in pools:
+        return f'host does not support {page_size} huge pages (supported: {", ".join(str(s >> 10) + "K" for s in sorted(pools)) or "none"})'
+    needed = -(-ram_bytes // page_bytes)
+    pool = pools[page_bytes]
+    if pool.available < needed:
+        return f'need {needed} free {page_size} huge pages, only {pool.available} available (see /proc/sys/vm/nr_hugepages)'
+    return None
+
+
+def find_hugetlbfs_mount(page_size: str, mounts_path: str = '/proc/mounts') -> str | None:
+    """
+        finds a hugetlbfs mount point serving pages of `page_size`
+    """
+    page_bytes = parse_size(page_size)
+    default_page_bytes = None
+    with open(mounts_path, 'r') as f:
+        for line in f:
+            _, mount_point, fs_type, mount_opts = line.split()[:4]
+            if fs_type != 'hugetlbfs':
+                continue
+            pagesize_opt = [o for o in mount_opts.split(',') if o.startswith('pagesize=')]
+            if pagesize_opt:
+                if parse_size(pagesize_opt[0][len('pagesize='):]) == page_bytes:
+                    return mount_point
+            else:
+                if default_page_bytes is None:
+                    default_page_bytes = read_default_hugepage_size()
+                if default_page_bytes == page_bytes:
+                    return mount_point
+    return None
+
+
+def read_default_hugepage_size(meminfo_path: str = '/proc/meminfo') -> int | None:
+    with open(meminfo_path, 'r') as f:
+        for line in f:
+            if line.startswith('Hugepagesize:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+SYS_io_uring_setup = 425    # same number on x86_64 and aarch64
+
+def check_kernel_io_uring() -> bool:
+    """
+        detects if the running kernel allows io_uring (probes io_uring_setup syscall)
+    """
+    try:
+        with open('/proc/sys/kernel/io_uring_disabled', 'r') as f:
+            if int(f.read().strip()) == 2:
+                return False
+    except FileNotFoundError:
+        pass
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    params = ctypes.create_string_buffer(120)   # struct io_uring_params
+    fd = libc.syscall(SYS_io_uring_setup, 1, params)
+    if fd < 0:
+        return False
+    os.close(fd)
+    return True
+
+
+def check_qemu_io_uring(qemu_img: str = 'qemu-img', run_fn=subprocess.run) -> bool:
+    """
+        detects if QEMU block layer was built with io_uring support. The probe opens a regular file:
+        the `file` driver refuses character devices such as /dev/null whatever the AIO engine.
+    """
+    import tempfile
+    with tempfile.NamedTemporaryFile(prefix='vmvm-io-uring-') as probe:
+        try:
+            result = run_fn([qemu_img, 'info', '--image-opts', f'driver=file,filename={probe.name},aio=io_uring'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        except FileNotFoundError:
+            return False
+    if result.returncode != 0:
+        logging.debug('qemu-img has no io_uring support: %s', (result.stderr or '').strip())
+    return result.returncode == 0
+
+
+def check_has_io_uring() -> bool:
+    return check_kernel_io_uring() and check_qemu_io_uring()
+
+
+def check_has_vhost_net(dev: str = '/dev/vhost-net') -> bool:
+    """
+        detects if the in-kernel virtio-net backend is usable by the current user
+    """
+    return os.access(dev, os.R_OK | os.W_OK)
+
+
+# setuid helper that creates a TAP device and attaches it to a bridge allowed in /etc/qemu/bridge.conf
+BRIDGE_HELPER_PATHS = [ '/usr/libexec/qemu-bridge-helper', '/usr/lib/qemu/qemu-bridge-helper' ]
+
+def find_bridge_helper() -> str | None:
+    return next((p for p in BRIDGE_HELPER_PATHS if os.path.exists(p)), None)
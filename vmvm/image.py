@@ -0,0 +1,299 @@
+#
+# Disk image management: conversion of foreign images (VMDK, VDI, VHDX, VHD, raw) into tuned qcow2, and compaction.
+# The format of an image is detected from its header magic only when it is imported and then recorded in vmconfig.yml:
+# a guest can write any header into a raw disk, so the format of a VM disk is never probed. `qemu-img convert` copies with several coroutines in parallel (-m) and
+# out-of-order writes (-W); clusters that read as zeroes are not written, so converting an image also sparsifies it.
+# https://www.qemu.org/docs/master/tools/qemu-img.html
+#
+
+import os
+import re
+import sys
+import json
+import yaml
+import shutil
+import logging
+import argparse
+import subprocess
+from logging import info, error
+
+from .exec import RingBuffer, RING_BUFFER_SIZE
+from .utils import disk_image_format_by_name, disk_spec, parse_size, read_running_pid
+
+# (offset, magic, qemu-img format name)
+IMAGE_MAGICS = [
+    (0, b'QFI\xfb', 'qcow2'),
+    (0, b'QED\x00', 'qed'),
+    (0, b'KDMV', 'vmdk'),
+    (0, b'# Disk DescriptorFile', 'vmdk'),
+    (0, b'vhdxfile', 'vhdx'),
+    (0, b'conectix', 'vpc'),             # dynamic VHD; a fixed VHD is raw data with a footer, probed as raw like QEMU does
+    (0x40, b'\x7f\x10\xda\xbe', 'vdi'),
+]
+IMAGE_FORMATS = ( 'qcow2', 'raw', 'qed', 'vmdk', 'vhdx', 'vpc', 'vdi' )
+HEADER_SIZE = 512
+DEFAULT_COROUTINES = 8
+PROGRESS_RE = re.compile(rb'\((\d+(?:\.\d+)?)/100%\)')
+
+
+class ImageError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+def detect_image_format(path: str) -> str:
+    """ qemu-img format name from the header magic, raw if none is recognized; OSError if the file cannot be read """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    return next((fmt for offset, magic, fmt in IMAGE_MAGICS if header[offset:offset + len(magic)] == magic), 'raw')
+
+
+def convert_args(src: str, src_format: str, dst: str, dst_format: str = 'qcow2', coroutines: int = DEFAULT_COROUTINES,
+                 compress: bool = False, cluster_size: int | None = None, preallocation: str | None = None,
+                 backing: str | None = None, backing_format: str | None = None, bitmaps: bool = False) -> list[str]:
+    args = [ 'convert', '-p', '-f', src_format, '-O', dst_format, '-m', str(coroutines) ]
+    # qemu-img refuses out-of-order writes to a compressed target
+    args.append('-c' if compress else '-W')
+    opts = []
+    if dst_format == 'qcow2':
+        if cluster_size is not None:
+            opts.append(f'cluster_size={cluster_size}')
+        if compress:
+            opts.append('compression_type=zstd')
+    if preallocation is not None:
+        opts.append(f'preallocation={preallocation}')
+    if opts:
+        args += [ '-o', ','.join(opts) ]
+    if backing is not None:
+        # only data that differs from the backing image is written
+        args += [ '-B', backing ] + ([ '-F', backing_format ] if backing_format else [])
+    if bitmaps:
+        args.append('--bitmaps')
+    return args + [ src, dst ]
+
+
+class ProgressLine:
+    """
+        progress of one operation: a line updated in place on a terminal, a log line every 10% otherwise
+    """
+    def __init__(self, label: str, stream=sys.stderr):
+        self._label = label
+        self._stream = stream
+        self._tty = stream.isatty()
+        self._logged = -10
+
+    def update(self, percent: float) -> None:
+        if self._tty:
+            self._stream.write(f'\r{self._label}: {percent:5.1f}%')
+            self._stream.flush()
+        elif percent >= self._logged + 10:
+            self._logged = int(percent // 10 * 10)
+            info('%s: %d%%', self._label, self._logged)
+
+    def done(self) -> None:
+        if self._tty:
+            self._stream.write('\n')
+
+
+def run_qemu_img(args: list[str], on_progress=None) -> int:
+    """
+        runs qemu-img, `on_progress(percent)` is called for every progress update of `-p`
+    """
+    logging.info('running qemu-img %s', ' '.join(args))
+    proc = subprocess.Popen([ 'qemu-img' ] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = RingBuffer(RING_BUFFER_SIZE)
+    # qemu-img rewrites the progress in place with \r, so output is read as it comes rather than by lines
+    while True:
+        data = os.read(proc.stdout.fileno(), 4096)
+        if not data:
+            break
+        output.write(data)
+        if on_progress is not None:
+            for m in PROGRESS_RE.finditer(data):
+                on_progress(float(m.group(1)))
+    exit_code = proc.wait()
+    proc.stdout.close()
+    if exit_code != 0:
+        tail = PROGRESS_RE.sub(b'', output.getvalue()).decode('utf-8', errors='replace').strip()
+        logging.error('qemu-img exited with code %d:\n%s', exit_code, tail)
+    return exit_code
+
+
+def image_info(path: str, fmt: str) -> dict:
+    """ `qemu-img info` of the image opened as `fmt` (also of one in use by a running VM) """
+    out = subprocess.run([ 'qemu-img', 'info', '-U', '-f', fmt, '--output=json', path ], check=True, capture_output=True, text=True).stdout
+    return json.loads(out)
+
+
+def allocated_size(path: str) -> int:
+    return os.stat(path).st_blocks * 512
+
+
+def convert_image(src: str, dst: str, dst_format: str = 'qcow2', run_fn=run_qemu_img, **kwargs) -> None:
+    """
+        converts `src` (format detected from its header) into a new image `dst`, which appears only once complete
+    """
+    if os.path.exists(dst):
+        raise ImageError(f'{dst} already exists')
+    try:
+        src_format = detect_image_format(src)
+    except OSError as e:
+        raise ImageError(f'cannot read {src}: {e}')
+    if kwargs.get('compress') and kwargs.get('preallocation') not in (None, 'off'):
+        raise ImageError('a compressed image cannot be preallocated')
+    info('converting %s (%s) to %s (%s)', src, src_format, dst, dst_format)
+    tmp = f'{dst}.part'
+    progress = ProgressLine(os.path.basename(dst))
+    try:
+        exit_code = run_fn(convert_args(src, src_format, tmp, dst_format, **kwargs), progress.update)
+    finally:
+        progress.done()
+    if exit_code != 0:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise ImageError(f'conversion of {src} failed')
+    os.replace(tmp, dst)
+
+
+def compact_image(path: str, fmt: str, coroutines: int = DEFAULT_COROUTINES, compress: bool = False,
+                  run_fn=run_qemu_img, info_fn=image_info) -> tuple[int, int]:
+    """
+        rewrites the image of format `fmt` without its zeroed and unused clusters, keeping the format, cluster size,
+        backing file and dirty bitmaps. Returns the allocated size before and after.
+    """
+    try:
+        img = info_fn(path, fmt)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        raise ImageError(f'cannot read image info of {path}: {e}')
+    is_qcow2 = fmt == 'qcow2'
+    before = allocated_size(path)
+    tmp = f'{path}.compact'
+    progress = ProgressLine(os.path.basename(path))
+    try:
+        exit_code = run_fn(convert_args(path, fmt, tmp, fmt, coroutines, compress=compress and is_qcow2,
+                                        cluster_size=img.get('cluster-size') if is_qcow2 else None,
+                                        backing=img.get('backing-filename'), backing_format=img.get('backing-filename-format'),
+                                        bitmaps=is_qcow2), progress.update)
+    finally:
+        progress.done()
+    if exit_code != 0:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise ImageError(f'compaction of {path} failed')
+    shutil.copymode(path, tmp)
+    os.replace(tmp, path)
+    return before, allocated_size(path)
+
+
+def _vm_disk_paths(conf_dir: str) -> tuple[str, list[tuple[str, str]]]:
+    """ name of the VM in `conf_dir` and (path, configured format) of its image disks """
+    from .main import App
+
+    o = App(conf_dir).options
+    images = [ (os.path.join(os.path.abspath(conf_dir), spec['file']), spec.get('format') or disk_image_format_by_name(spec['file']))
+               for spec in map(disk_spec, o.disks) if not spec['file'].startswith('/dev/') ]
+    return o.name, images
+
+
+def add_disk_to_config(conf_path: str, file: str, fmt: str) -> bool:
+    """
+        appends `{ file: <file>, format: <fmt> }` to the disks in vmconfig.yml, editing the text in place so comments
+        and layout are kept. False if the file does not exist or its disks cannot be extended that way.
+    """
+    try:
+        with open(conf_path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except FileNotFoundError:
+        return False
+    entry = yaml.safe_dump({ 'file': file, 'format': fmt }, default_flow_style=True, width=1 << 16).strip()
+    try:
+        # node positions are character offsets with the pure-Python loader
+        root = yaml.compose(text, Loader=yaml.SafeLoader)
+    except yaml.YAMLError:
+        return False
+    if root is None:
+        root = yaml.MappingNode('tag:yaml.org,2002:map', [])
+    if not isinstance(root, yaml.MappingNode):
+        return False
+    disks = next((value for key, value in root.value if key.value in ('disk', 'disks')), None)
+    if disks is None:
+        text = (text if text.endswith('\n') or not text else text + '\n') + f'disks:\n    - {entry}\n'
+    elif isinstance(disks, yaml.SequenceNode) and disks.flow_style:
+        # before the closing bracket
+        pos = disks.end_mark.index - 1
+        text = text[:pos].rstrip() + (f', {entry} ' if disks.value else f' {entry} ') + text[pos:]
+    elif isinstance(disks, yaml.SequenceNode):
+        # a new item under the last one, with the same indentation
+        first = disks.value[0].start_mark
+        line_start = text.rfind('\n', 0, first.index) + 1
+        dash = text.rfind('-', line_start, first.index)
+        last = disks.value[-1]
+        # a block collection ends where the next token starts, its last scalar ends on the item's own line
+        while isinstance(last, (yaml.MappingNode, yaml.SequenceNode)) and not last.flow_style and last.value:
+            last = last.value[-1][1] if isinstance(last, yaml.MappingNode) else last.value[-1]
+        end = last.end_mark.index
+        pos = end if text[end - 1:end] == '\n' else (text.find('\n', end) + 1 or len(text))
+        text = text[:pos] + ('' if text[:pos].endswith('\n') else '\n') + ' ' * (dash - line_start) + f'- {entry}\n' + text[pos:]
+    elif isinstance(disks, yaml.ScalarNode) or disks.flow_style:
+        # a single disk becomes a list
+        start, end = disks.start_mark.index, disks.end_mark.index
+        text = text[:start] + (f'[ {text[start:end]}, {entry} ]' if end > start else f' [ {entry} ]') + text[end:]
+    else:
+        return False
+    with open(conf_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return True
+
+
+def image_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog='vmvm image', description='Import, convert and compact disk images')
+    parser.add_argument('cmd', choices=['import', 'convert', 'compact'])
+    parser.add_argument('paths', nargs='*', help='import: SRC [CONF_DIR]; convert: SRC DST; compact: [CONF_DIR or IMAGE]')
+    parser.add_argument('-O', '--output-format', choices=IMAGE_FORMATS, default='qcow2', help='convert: target format')
+    parser.add_argument('-m', '--coroutines', type=int, default=DEFAULT_COROUTINES, help='parallel qemu-img coroutines (1-16)')
+    parser.add_argument('--compress', action='store_true', help='zstd-compressed qcow2 clusters (no out-of-order writes)')
+    parser.add_argument('--cluster-size', help='import/convert: qcow2 cluster size (e.g. 64K, 2M)')
+    parser.add_argument('--preallocation', choices=['metadata', 'falloc', 'full'], help='import/convert: preallocate the target')
+    args = parser.parse_args(argv)
+    expected = { 'import': (1, 2), 'convert': (2, 2), 'compact': (0, 1) }[args.cmd]
+    if not expected[0] <= len(args.paths) <= expected[1]:
+        parser.error(f'wrong number of paths for {args.cmd}')
+    if not 1 <= args.coroutines <= 16:
+        parser.error('--coroutines must be between 1 and 16')
+
+    logging.basicConfig(format='%(asctime)s  %(levelname)s  %(message)s', level=logging.INFO)
+    options = dict(coroutines=args.coroutines, compress=args.compress, preallocation=args.preallocation,
+                   cluster_size=parse_size(args.cluster_size, default_suffix='B') if args.cluster_size else None)
+    try:
+        if args.cmd == 'import':
+            src = args.paths[0]
+            conf_dir = args.paths[1] if len(args.paths) > 1 else os.getcwd()
+            dst = os.path.join(conf_dir, os.path.splitext(os.path.basename(src))[0] + '.qcow2')
+            convert_image(src, dst, 'qcow2', **options)
+            conf_path = os.path.join(conf_dir, 'vmconfig.yml')
+            if add_disk_to_config(conf_path, os.path.basename(dst), 'qcow2'):
+                info('imported as %s, added to "disks" in %s', dst, conf_path)
+            else:
+                info('imported as %s, add { file: %s, format: qcow2 } to "disks" in %s', dst, os.path.basename(dst), conf_path)
+        elif args.cmd == 'convert':
+            convert_image(args.paths[0], args.paths[1], args.output_format, **options)
+        else:
+            target = args.paths[0] if args.paths else os.getcwd()
+            if os.path.isdir(target):
+                name, images = _vm_disk_paths(target)
+                pid = read_running_pid(name)
+                if pid is not None:
+                    raise ImageError(f'VM {name} is running (pid {pid}), stop it before compacting its disks')
+            else:
+                # named by the user, not a VM disk: detected from the header like on import
+                try:
+                    images = [ (target, detect_image_format(target)) ]
+                except OSError as e:
+                    raise ImageError(f'cannot read {target}: {e}')
+            for path, fmt in images:
+                before, after = compact_image(path, fmt, args.coroutines, args.compress)
+                info('%s: %d MiB -> %d MiB allocated', path, before >> 20, after >> 20)
+    except ImageError as e:
+        error('%s', e)
+        return 1
+    return 0
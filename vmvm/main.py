@@ -1,102 +1,478 @@
-import logging, yaml, os, socket, argparse
+import logging, os, sys, time, argparse, threading
 from logging import info,error
 
-from .config_parser import parse_config
-from .builder import CmdBuilder, RuntimeOptions, CommonArgsBuildResult
+from .config_parser import parse_config, load_config
+from .config_cache import ConfigCache, CACHE_FILE_NAME
+from .builder import CmdBuilder, RuntimeOptions, CommonArgsBuildResult, CopyFileCommand
 from .exec import exec_with_trace
-from .utils import disk_image_format_by_name, get_unix_sock_path, SockType
-from .tpm_manager import TPMManager
-from .hw_caps import check_has_topoext
+from .utils import disk_image_format_by_name, disk_spec, get_unix_sock_path, get_vm_runtime_dir, get_pid_file_path, copy_file, SockType
+from .tpm_manager import TPMManager, TPMError
+from .startup import StartupPipeline, StartupError
+from .virtiofsd_manager import VirtiofsdManager, VirtiofsdError
+from .passt_manager import PasstManager, PasstError
+from .qcow2 import create_args, l2_cache_sizes
+from .port_registry import PortRegistry, PortRegistryError
+from .hw_caps import (check_has_topoext, check_has_io_uring, read_host_topology, check_hugepages, find_hugetlbfs_mount,
+                      check_has_vhost_net, find_bridge_helper)
 
 SPICE_PORT_BASE=5900
 
 
-def is_port_free(port: int) -> bool:
-    s = socket.socket()
-    try:
-        s.bind(('localhost',port))
-        return True
-    except:
-        pass
-    return False
-
-def find_next_free_port(port: int) -> int:
-    while not is_port_free(port):
-        port += 1
-    return port
-
-
 class App:
 
 
-    def __init__(self, conf_dir: str):
+    def __init__(self, conf_dir: str, use_cache: bool = True):
+        """
+            all relative paths are resolved against `conf_dir`, the process working directory is left alone
+            so that several VMs can be managed from one process
+        """
         self.tpm_manager = None
-        os.chdir(conf_dir)
-        conf = yaml.safe_load(open('vmconfig.yml', 'r'))
-        self._options = parse_config(conf)
+        self.virtiofsd_manager = None
+        self.passt_manager = None
+        self.on_started = None     # optional callable(proc), invoked once QEMU is spawned
+        self.print_timings = False # print the startup phase breakdown once QEMU is spawned
+        self.extra_args = []       # appended to the QEMU argv (not cached)
+        self._pipeline = None
+        self._spawn_start = None
+        self._pinning_plan = None
+        self._use_hugepages = True
+        self._hugetlbfs_path = None
+        self._port_registry = None
+        self._incoming_state = None
+        self._dir = os.path.abspath(conf_dir)
+        self._cache = ConfigCache(self._path('vmconfig.yml'), enabled=use_cache)
+        self._options = self._cache.options(lambda conf_bytes: parse_config(load_config(conf_bytes)))
+        self._cache.save()
         logging.debug('**** options: ****')
         logging.debug(repr(self._options))
         logging.debug('******************')
 
+    def _path(self, path: str) -> str:
+        return os.path.join(self._dir, path)
+
+    @property
+    def options(self):
+        return self._options
+
     def _start_tpm(self):
-        if self._options.enable_tpm:
+        if self.tpm_manager is not None:
             info('starting software TPM daemon')
-            self.tpm_manager = TPMManager(self._options.name)
             self.tpm_manager.run()
 
     def _shutdown_tpm(self):
-        if self._options.enable_tpm:
+        if self.tpm_manager is not None:
             info('shutting down software TPM daemon')
             self.tpm_manager.shutdown()
-
-
-    def act_init(self):
+            self.tpm_manager = None
+
+    def _start_virtiofsd(self):
+        shares = self._options.share_dir_as_fsd or []
+        if any(share['transport'] == 'virtiofs' for share in shares):
+            info('starting virtiofsd for %d shared directories', sum(share['transport'] == 'virtiofs' for share in shares))
+            self.virtiofsd_manager = VirtiofsdManager(self._options.name, shares, base_dir=self._dir)
+            self.virtiofsd_manager.run()
+
+    def _shutdown_virtiofsd(self):
+        if self.virtiofsd_manager is not None:
+            info('shutting down virtiofsd')
+            self.virtiofsd_manager.shutdown()
+            self.virtiofsd_manager = None
+
+    def _start_passt(self):
+        nets = self._options.net or []
+        if any(net['type'] == 'passt' for net in nets):
+            info('starting passt network daemon')
+            self.passt_manager = PasstManager(self._options.name, nets)
+            self.passt_manager.run()
+
+    def _shutdown_passt(self):
+        if self.passt_manager is not None:
+            info('shutting down passt')
+            self.passt_manager.shutdown()
+            self.passt_manager = None
+
+    def _host_topology(self):
+        if self._options.topology != 'host' and self._options.cpu_pinning is None:
+            return None
+        host_topology = self._cache.host_cap(self._options, 'host_topology', read_host_topology)
+        if self._options.cpu_pinning is not None:
+            from .cpu_pinning import make_pinning_plan, CpuPinningError
+            # resolved before launch so that a bad spec refuses to start the VM
+            try:
+                self._pinning_plan = make_pinning_plan(self._options.cpu_pinning, self._options.cpus, host_topology)
+            except CpuPinningError as e:
+                raise StartupError(f'cannot pin vCPUs: {e}')
+        return host_topology
+
+    def _check_hugepages(self):
+        """
+            refuses to start (or falls back to normal pages) before launch if the host cannot back RAM with huge pages
+        """
+        hp = self._options.hugepages
+        if hp is None:
+            return
+        problem = check_hugepages(self._options.ram, hp['size'])
+        if problem is None and hp['backend'] == 'file':
+            self._hugetlbfs_path = find_hugetlbfs_mount(hp['size'])
+            if self._hugetlbfs_path is None:
+                problem = f"no hugetlbfs mount with pagesize={hp['size']} found"
+        if problem is not None:
+            if hp['fallback']:
+                logging.warning('%s, falling back to normal pages', problem)
+                self._use_hugepages = False
+            else:
+                raise StartupError(problem)
+
+    def _write_pid_file(self, pid: int | None):
+        path = get_pid_file_path(self._options.name)
+        if pid is not None:
+            with open(path, 'w') as f:
+                f.write(f'{pid}\n')
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _on_qemu_started(self, proc):
+        if self._pipeline is not None:
+            self._pipeline.mark('qemu_spawn', self._spawn_start)
+            if self.print_timings:
+                print(self._pipeline.format_timings(), file=sys.stderr)
+        self._write_pid_file(proc.pid)
+        if self.on_started is not None:
+            self.on_started(proc)
+        startup_threads = []
+        if self._pinning_plan is not None:
+            from .cpu_pinning import apply_pinning
+            qmp_sock = get_unix_sock_path(SockType.QMP, self._options.name)
+            def pin():
+                try:
+                    apply_pinning(self._pinning_plan, qmp_sock, proc.pid)
+                except Exception as e:
+                    error('failed to pin vCPU threads: %s', e)
+            startup_threads.append(threading.Thread(target=pin, daemon=True))
+        if self._incoming_state is not None:
+            startup_threads.append(threading.Thread(target=self._load_incoming_state, daemon=True))
+        for thread in startup_threads:
+            thread.start()
+        if self._options.balloon is not None and self._options.balloon['auto']:
+            threading.Thread(target=self._run_balloon_controller, args=(startup_threads,), name='balloon', daemon=True).start()
+
+    def _run_balloon_controller(self, after: list[threading.Thread]):
+        from .balloon import run_controller, BalloonPolicy
+        from .qmp import wait_for_qmp
+        from .utils import parse_size
+
+        qmp_sock = get_unix_sock_path(SockType.QMP, self._options.name)
+        policy = BalloonPolicy(min_bytes=self._options.balloon['min'], max_bytes=parse_size(self._options.ram))
+        # pinning and loading the saved state need QMP first, the monitor serves one client at a time
+        for thread in after:
+            thread.join()
+        try:
+            if not wait_for_qmp(qmp_sock, timeout=30):
+                raise RuntimeError(f'QMP socket {qmp_sock} did not come up')
+            run_controller(qmp_sock, policy)
+        except Exception as e:
+            # also the normal way out: QEMU exited and closed the QMP socket
+            logging.debug('balloon controller stopped: %s', e)
+
+
+    def act_init(self) -> int:
+        """
+            creates the first disk as an empty image, every disk with a `base` image as a qcow2 overlay of it
+            and every disk with a `from` image as a copy of it (a reflink where the filesystem supports it)
+        """
         info('action: initializing vm')
 
-        if len(self._options.disks):
-            first_disk = self._options.disks[0]
-            if os.path.exists(first_disk):
-                error('disk already exists, not overwriting: %s', first_disk)
-                return
+        if not len(self._options.disks):
+            error('no disks configured?')
+            return 1
+        exit_code = 0
+        for idx, spec in enumerate(map(disk_spec, self._options.disks)):
+            if idx > 0 and 'base' not in spec and 'from' not in spec:
+                continue
+            if os.path.exists(self._path(spec['file'])):
+                error('disk already exists, not overwriting: %s', spec['file'])
+            elif 'from' in spec:
+                info('creating disk %s as a copy of %s', spec['file'], spec['from'])
+                start = time.monotonic()
+                try:
+                    method = copy_file(self._path(spec['from']), self._path(spec['file']))
+                    info('disk %s copied via %s in %.3fs', spec['file'], method, time.monotonic() - start)
+                except OSError as e:
+                    error('cannot copy %s: %s', spec['from'], e)
+                    exit_code = 1
+            elif 'base' in spec:
+                from .clone import create_overlay, CloneError
+                info('creating disk %s as an overlay of %s', spec['file'], spec['base'])
+                try:
+                    exit_code = create_overlay(spec['file'], spec['base'], cwd=self._dir, spec=spec, base_format=spec.get('base_format')) or exit_code
+                except CloneError as e:
+                    error('%s', e)
+                    exit_code = 1
             else:
-                img_format = disk_image_format_by_name(first_disk)
-                info('creating empty disk %s with size %s and format %s', first_disk, '100G', img_format.upper())
-                exec_with_trace('qemu-img', ['create', '-f', img_format, first_disk, '100G'])
+                format_args, size_args = create_args(spec)
+                info('creating empty disk %s with size %s and format %s', spec['file'], size_args[0], (spec.get('format') or disk_image_format_by_name(spec['file'])).upper())
+                exit_code = exec_with_trace('qemu-img', ['create'] + format_args + [spec['file']] + size_args, cwd=self._dir) or exit_code
+        return exit_code
+
+    def act_flatten(self) -> int:
+        """
+            detaches disks that have a `base` from it; done live with block-stream if the VM is running
+        """
+        info('action: flattening linked clone disks')
+        from .clone import flatten, flatten_offline, CloneError
+        from .port_registry import is_pid_alive
+
+        disks = [ (idx, spec) for idx, spec in enumerate(map(disk_spec, self._options.disks)) if 'base' in spec ]
+        if not disks:
+            error('no disks with a base image configured')
+            return 1
+        try:
+            with open(get_pid_file_path(self._options.name), 'r') as f:
+                running = is_pid_alive(int(f.read()))
+        except (OSError, ValueError):
+            running = False
+        if running:
+            if not self._options.qmp_enabled:
+                error('VM is running, flattening it live requires the control_socket option')
+                return 1
+            try:
+                flatten(get_unix_sock_path(SockType.QMP, self._options.name), [ f'hd{idx}' for idx, _ in disks ])
+            except Exception as e:
+                error('flatten failed: %s', e)
+                return 1
         else:
-            error('no disks configured?')
-
-    def act_install(self):
-        self._start_tpm()
-        info('action: installing operating system inside vm')
-        runtime_options = RuntimeOptions(
-            spice_port=find_next_free_port(SPICE_PORT_BASE),
+            for _, spec in disks:
+                exit_code = flatten_offline(spec['file'], cwd=self._dir)
+                if exit_code:
+                    return exit_code
+        info('disks no longer depend on their base images, the "base" keys can be removed from %s', self._path('vmconfig.yml'))
+        return 0
+
+    def _acquire_spice_port(self) -> int:
+        if self._options.spice != 'auto':
+            return 0
+        self._port_registry = PortRegistry(SPICE_PORT_BASE)
+        try:
+            return self._port_registry.acquire(self._options.name)
+        except PortRegistryError as e:
+            self._port_registry = None     # nothing leased, nothing to release
+            raise StartupError(f'cannot lease a SPICE port: {e}')
+
+    def _release_spice_port(self):
+        if self._port_registry is not None:
+            self._port_registry.release(self._options.name)
+
+    def _firmware(self) -> dict | None:
+        """ EFI firmware from the QEMU firmware descriptors, None to fall back to the edk2 directory scan """
+        if not self._options.enable_efi:
+            return None
+        from .firmware import read_firmware_index, firmware_index_valid, select_firmware
+        index = self._cache.host_cap(self._options, 'firmware_index', read_firmware_index, valid_fn=firmware_index_valid)
+        fw = select_firmware(index['firmware'], self._options.qemu_binary, self._options.machine,
+                             self._options.enable_secureboot, self._options.efi_features)
+        if fw is not None:
+            logging.debug('EFI firmware: %s', fw['name'])
+        elif index['firmware']:
+            logging.warning('no firmware descriptor matches machine "%s" with features %s, looking up edk2 files by name',
+                            self._options.machine, self._options.efi_features + (['secure-boot'] if self._options.enable_secureboot else []))
+        return fw
+
+    def _uses_tap(self) -> bool:
+        return any(net['type'] != 'user' for net in self._options.net or [])
+
+    def _add_probe_steps(self, pipeline: StartupPipeline) -> None:
+        """ host probes and resources the argv depends on, independent of each other """
+        pipeline.add('hugepages', self._check_hugepages)
+        pipeline.add('spice_port', self._acquire_spice_port)
+        pipeline.add('cpu_caps', lambda: (self._cache.host_cap(self._options, 'has_cpu_topoext', check_has_topoext), self._host_topology()))
+        pipeline.add('io_uring', lambda: self._cache.host_cap(self._options, 'has_io_uring', check_has_io_uring))
+        pipeline.add('firmware', self._firmware)
+        pipeline.add('net_caps', lambda: (check_has_vhost_net(), find_bridge_helper()) if self._uses_tap() else (True, None))
+        pipeline.add('l2_cache', lambda: l2_cache_sizes(self._options.disks, self._dir))
+
+    def _runtime_options(self, r: dict) -> RuntimeOptions:
+        """ RuntimeOptions from the results of the probe steps """
+        return RuntimeOptions(
+            spice_port=r['spice_port'],
             tpm_socket=self.tpm_manager.sock if self.tpm_manager else None,
-            has_cpu_topoext=check_has_topoext()
+            has_cpu_topoext=r['cpu_caps'][0],
+            host_topology=r['cpu_caps'][1],
+            use_hugepages=self._use_hugepages,
+            hugetlbfs_path=self._hugetlbfs_path,
+            has_io_uring=r['io_uring'],
+            disk_l2_cache_sizes=r['l2_cache'],
+            firmware=r['firmware'],
+            has_vhost_net=r['net_caps'][0],
+            bridge_helper=r['net_caps'][1],
             )
-        cmd_builder = CmdBuilder()
-        common_args_build_result: CommonArgsBuildResult = cmd_builder.common_args(self._options,runtime_options)
-        for pre_command in common_args_build_result.pre_commands:
-            exec_with_trace(pre_command.exe, pre_command.args)
-        args = common_args_build_result.args + cmd_builder.boot_args(self._options,mode='install') + cmd_builder.cdrom_args(self._options,mount=True)
-        exec_with_trace(f'qemu-system-{self._options.qemu_binary}', args)
+
+    def _build_qemu_args(self, mode: str, runtime_options: RuntimeOptions | None = None) -> CommonArgsBuildResult:
+        if runtime_options is None:
+            pipeline = StartupPipeline()
+            self._add_probe_steps(pipeline)
+            runtime_options = self._runtime_options(pipeline.run())
+        def build() -> CommonArgsBuildResult:
+            cmd_builder = CmdBuilder(pathexists_fn=lambda p: os.path.exists(self._path(p)), base_dir=self._dir)
+            common_args_build_result: CommonArgsBuildResult = cmd_builder.common_args(self._options,runtime_options)
+            args = common_args_build_result.args + cmd_builder.boot_args(self._options,mode=mode) + cmd_builder.cdrom_args(self._options,mount=(mode == 'install'))
+            return CommonArgsBuildResult(args=args, pre_commands=common_args_build_result.pre_commands, messages=common_args_build_result.messages)
+        result = self._cache.build_args(self._options, mode, runtime_options, build)
+        self._cache.save()
+        return result
+
+    def _build_resume_args(self, state, runtime_options: RuntimeOptions) -> CommonArgsBuildResult:
+        """
+            argv of the mode the suspended VM was launched with, validated against the saved state
+        """
+        from .suspend import argv_fingerprint, validate_state, SuspendError
+        from .config_cache import binary_fingerprint
+
+        try:
+            build_result = next((r for r in (self._build_qemu_args(m, runtime_options) for m in ['run', 'install'])
+                                 if argv_fingerprint(r.args) == state.argv_sha256), None)
+            if build_result is None:
+                build_result = self._build_qemu_args('run', runtime_options)
+            validate_state(state, build_result.args, binary_fingerprint(f'qemu-system-{self._options.qemu_binary}'))
+        except SuspendError as e:
+            raise StartupError(f'cannot resume: {e}')
+        return CommonArgsBuildResult(args=build_result.args + ['-incoming', 'defer'], pre_commands=build_result.pre_commands, messages=build_result.messages)
+
+    def _run_pre_commands(self, pre_commands: list) -> None:
+        for pre_command in pre_commands:
+            if isinstance(pre_command, CopyFileCommand):
+                method = copy_file(pre_command.src, self._path(pre_command.dst))
+                logging.debug('copied %s to %s (%s)', pre_command.src, pre_command.dst, method)
+            elif exec_with_trace(pre_command.exe, pre_command.args, cwd=self._dir) != 0:
+                raise StartupError(f'{pre_command.exe} failed')
+
+    def _load_incoming_state(self):
+        from .suspend import load_state, remove_state, STATE_FILE_NAME
+        from .qmp import wait_for_qmp
+
+        state_path = self._path(STATE_FILE_NAME)
+        qmp_sock = get_unix_sock_path(SockType.QMP, self._options.name)
+        try:
+            if not wait_for_qmp(qmp_sock, timeout=30):
+                raise RuntimeError(f'QMP socket {qmp_sock} did not come up')
+            t = time.monotonic()
+            load_state(qmp_sock, state_path, self._incoming_state.streams, self._incoming_state.compress)
+            info('VM state restored in %.1fs', time.monotonic() - t)
+            # the guest runs now (cont succeeded) and its disks diverge from the saved RAM, the state must not be loaded twice
+            remove_state(state_path)
+        except Exception as e:
+            error('failed to restore VM state, saved state is kept: %s', e)
+
+    def _stop_daemons(self):
+        self._release_spice_port()
+        self._shutdown_passt()
+        self._shutdown_virtiofsd()
         self._shutdown_tpm()
 
+    def _launch(self, mode: str, incoming_state=None) -> int:
+        """
+            starts helper daemons, probes the host and builds the argv concurrently, then runs QEMU until it exits
+        """
+        self.tpm_manager = TPMManager(self._options.name) if self._options.enable_tpm else None
+        pipeline = StartupPipeline()
+        self._add_probe_steps(pipeline)
+        pipeline.add('tpm', self._start_tpm)
+        pipeline.add('virtiofsd', self._start_virtiofsd)
+        pipeline.add('passt', self._start_passt)
+        probes = [ 'hugepages', 'spice_port', 'cpu_caps', 'io_uring', 'firmware', 'net_caps', 'l2_cache' ]
+        if incoming_state is not None:
+            pipeline.add('qemu_args', lambda: self._build_resume_args(incoming_state, self._runtime_options(pipeline.results)), deps=probes)
+        else:
+            pipeline.add('qemu_args', lambda: self._build_qemu_args(mode, self._runtime_options(pipeline.results)), deps=probes)
+        # EFI vars copy, overlaps with daemon startup
+        pipeline.add('pre_commands', lambda: self._run_pre_commands(pipeline.results['qemu_args'].pre_commands), deps=['qemu_args'])
+        # daemons and the port lease are released however the launch ends: startup error, Ctrl-C, spawn failure
+        try:
+            try:
+                pipeline.run()
+            except (StartupError, TPMError, VirtiofsdError, PasstError) as e:
+                error('%s', e)
+                return 1
+            self._incoming_state = incoming_state
+            self._pipeline = pipeline
+            build_result = pipeline.results['qemu_args']
+            for level, msg in build_result.messages:
+                logging.log(level, '%s', msg)
+            # QEMU creates its sockets there; /run is emptied on reboot, a cached argv still points into it
+            get_vm_runtime_dir(self._options.name)
+            self._spawn_start = pipeline.elapsed()
+
+            log_file = dict(self._options.log_file, path=self._path(self._options.log_file['path'])) if self._options.log_file else None
+            try:
+                return exec_with_trace(f'qemu-system-{self._options.qemu_binary}', build_result.args + self.extra_args, on_start=self._on_qemu_started, log_file=log_file, cwd=self._dir)
+            except OSError as e:
+                error('cannot start QEMU: %s', e)
+                return 1
+            finally:
+                self._write_pid_file(None)
+        finally:
+            self._stop_daemons()
+
+    def act_install(self) -> int:
+        info('action: installing operating system inside vm')
+        return self._launch('install')
+
 
-    def act_run(self):
-        self._start_tpm()
+    def act_run(self) -> int:
         info('action: running vm')
-        runtime_options = RuntimeOptions(
-            spice_port=find_next_free_port(SPICE_PORT_BASE),
-            tpm_socket=self.tpm_manager.sock if self.tpm_manager else None,
-            has_cpu_topoext=check_has_topoext()
-            )
-        cmd_builder = CmdBuilder()
-        common_args_build_result: CommonArgsBuildResult = cmd_builder.common_args(self._options,runtime_options)
-        for pre_command in common_args_build_result.pre_commands:
-            exec_with_trace(pre_command.exe, pre_command.args)
-        args = common_args_build_result.args + cmd_builder.boot_args(self._options,mode='run') + cmd_builder.cdrom_args(self._options,mount=False)
-        exec_with_trace(f'qemu-system-{self._options.qemu_binary}', args)
-        self._shutdown_tpm()
+        return self._launch('run')
+
+    def act_suspend(self, streams: int = 1, compress: str | None = None) -> int:
+        info('action: suspending vm to file')
+        from .suspend import (save_state, save_metadata, read_process_argv, argv_fingerprint, disk_stats,
+                              SavedState, STATE_FILE_NAME)
+        from .config_cache import binary_fingerprint
+        from .port_registry import is_pid_alive
+
+        if not self._options.qmp_enabled:
+            error('suspend requires the control_socket option')
+            return 1
+        try:
+            with open(get_pid_file_path(self._options.name), 'r') as f:
+                pid = int(f.read())
+            argv = read_process_argv(pid)
+        except (OSError, ValueError):
+            error('VM "%s" is not running', self._options.name)
+            return 1
+        state_path = self._path(STATE_FILE_NAME)
+        t = time.monotonic()
+        try:
+            result = save_state(get_unix_sock_path(SockType.QMP, self._options.name), state_path, streams, compress)
+        except Exception as e:
+            error('failed to save VM state, VM keeps running: %s', e)
+            return 1
+        deadline = time.monotonic() + 30
+        while is_pid_alive(pid) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        # disk images are recorded after QEMU has closed them
+        disks = [ self._path(disk_spec(d)['file']) for d in self._options.disks ]
+        save_metadata(state_path, SavedState(
+            argv_sha256=argv_fingerprint(argv),
+            qemu=binary_fingerprint(f'qemu-system-{self._options.qemu_binary}'),
+            disks=disk_stats(disks),
+            streams=streams,
+            compress=compress,
+        ))
+        info('VM state saved to %s in %.1fs (%d MiB)', state_path, time.monotonic() - t, result.get('ram', {}).get('total', 0) >> 20)
+        return 0
+
+    def act_resume(self) -> int:
+        info('action: resuming vm from file')
+        from .suspend import load_metadata, SuspendError, STATE_FILE_NAME
+
+        if not self._options.qmp_enabled:
+            error('resume requires the control_socket option')
+            return 1
+        try:
+            state = load_metadata(self._path(STATE_FILE_NAME))
+        except SuspendError as e:
+            error('cannot resume: %s', e)
+            return 1
+        return self._launch('run', incoming_state=state)
 
     def act_console(self):
         from qemu.qmp import ConnectError, QMPError
@@ -118,17 +494,63 @@ class App:
 USAGE= '''
 
     vmvm <ACTION> [CONF_DIR]
-
-ACTION = init | install | run
-
-    init          create an image file for the first HDD in the config (if not exist)
+    vmvm clone <TEMPLATE_DIR> <NEW_DIR> [--name NAME]
+    vmvm query <QMP command> [ARGUMENTS_JSON] [--vm NAME]... [--timeout SEC]
+    vmvm metrics [--listen HOST:PORT | --textfile PATH [--interval SEC]] [--once]
+    vmvm fleet <run|stop|status> <CONF_DIR or glob>... [--max-boots N] [--boot-window SEC] [--jobs N] [--force]
+    vmvm image <import SRC [CONF_DIR] | convert SRC DST [-O FORMAT] | compact [CONF_DIR or IMAGE]> [-m N] [--compress]
+    vmvm backup <full|incremental|restore|list> [CONF_DIR] [--dest DIR] [--freeze] [--id ID] [--output DIR]
+    vmvm bench boot [CONF_DIR] [-n RUNS] [--ready-regex REGEX | --guest-agent] [--timeout SEC] [--json]
+    vmvm ci [CONF_DIR] [-j INSTANCES] [--command CMD] [--timeout SEC] [--pass-regex REGEX] [--log-dir DIR] [--overlay-dir DIR]
+
+ACTION = init | install | run | console | suspend | resume | flatten | clone | query | metrics | fleet | image | backup | bench | ci
+
+    init          create an image file for the first HDD in the config (if not exist),
+                  a qcow2 overlay for every disk with a 'base' image and a copy (reflink if possible)
+                  of the 'from' image for every disk with one
     install       boot from 'os_install' device to install operating system
     run           boot from first HDD
     console       open an interactive QMP shell (control_socket option must be enabled)
+    suspend       save the state of the running VM to CONF_DIR/suspended.vmstate and stop it
+                  (control_socket option must be enabled); --streams N writes with N parallel
+                  streams, --compress zstd|gzip compresses the state
+    resume        start the VM from the saved state instead of booting; the state is rejected if the
+                  config, QEMU or the disk images changed since it was saved
+
+    flatten       copy base image data into the disks that have a 'base' and detach them from it
+                  (live with block-stream if the VM is running)
+    clone         create a linked clone: new VM directory whose disks are qcow2 overlays of the
+                  template VM disks (which are made read-only)
+    query         run a QMP command on every running VM with a control socket, prints JSON results by VM name
+    metrics       export CPU, memory, block, balloon and KVM statistics of running VMs for Prometheus,
+                  served on http://127.0.0.1:9477/metrics or written to a textfile collector file
+    fleet         run, stop (ACPI powerdown, or quit with --force) or query many VMs from one process;
+                  --max-boots limits how many VMs boot at the same time, each boot keeps its slot
+                  for --boot-window seconds after QEMU is spawned
+    image         import: convert a VMDK/VDI/VHDX/VHD/raw image into a qcow2 disk in CONF_DIR; convert: to any format;
+                  compact: rewrite the disks (or IMAGE) without zeroed clusters. Source formats are detected from
+                  the image header; -m parallel coroutines, --compress zstd clusters, live progress
+    backup        full: copy every (qcow2) disk and start tracking changed clusters in a persistent dirty bitmap;
+                  incremental: copy only the clusters changed since the previous backup; restore: write the disks
+                  as of a backup (--id, default the latest) back. Works on running (control_socket) and stopped VMs,
+                  --freeze freezes guest filesystems with qemu-guest-agent (guest_agent option)
+    bench boot    boot the VM RUNS times on throwaway overlays of its disks and print percentiles of the
+                  time to QEMU spawn, firmware handoff, QMP and guest readiness (serial console regex,
+                  or --guest-agent: qemu-guest-agent answers guest-ping)
+    ci            run INSTANCES headless copies of the VM in parallel on throwaway disk overlays, each with its
+                  own name, sockets and host ports; serial console saved to --log-dir, --command and --timeout
+                  passed to the guest over fw_cfg, QEMU stopped once --timeout passes
 
 CONF_DIR
     is a directory containing vmconfig.yml. Default is CWD.
 
+--no-cache
+    do not use the compiled config cache (.vmvm-cache.json in CONF_DIR)
+
+--timings
+    print wall-clock start, end and duration of every startup phase (daemons, host probes,
+    argv build, EFI vars copy, QEMU spawn) once QEMU is running
+
 Example:
     vmvm install
 
@@ -143,36 +565,83 @@ Configuration Options:
     tpm                 Enable software TPM emulation (True/False)
     bootmenu            Enable boot menu (True/False)
     floppy              Floppy image file (path)
-    disk (disks)        Disk image file or list (path or list of paths, required)
+    disk (disks)        Disk image file or list (path, dict like "file: data.qcow2, format: qcow2, iothread: db, queues: 8, cache: none, aio: io_uring, base: golden.qcow2, from: template.qcow2", or list of these, required)
     disk_virtio         Disk emulation (blk, scsi, none)
+    disk_iothreads      Run I/O of each virtio disk in a dedicated IOThread (True/False)
+    disk_cache          Default disk cache mode (none, writeback, unsafe)
+    disk_aio            Default disk AIO engine (threads, native, io_uring)
     os_install          mount ISO images if ACTION=='install' (path or list of paths)
     need_cd             always mount ISO images, even if ACTION is not 'install' (True/False)
     usb                 USB Passthrough (pair or list of pairs like vendor:product)
-    share_dir_as_fsd    Share a host directory with virtiofsd (path)
+    share_dir_as_fsd    Share host directories with virtiofsd or 9p (path, dict or list)
     share_dir_as_fat    Map a host directory as a virtual FAT filesystem (path)
     share_dir_as_floppy Map a host directory as a virtual floppy (path)
     nic                 Network interface card (none, virtio, or <specific model>)
-    nic_forward_ports   Forward local port to guest port (scalar or list of dicts like "host: 2222, guest: 22")
+    nic_forward_ports   Forward local port to guest port (scalar or list of dicts like "host: 2222, guest: 22, proto: udp")
+    balloon             virtio-balloon with free page reporting (True/False or dict: auto, min, free_page_reporting, deflate_on_oom)
+    net                 NICs: list of dicts with type user, passt, tap (ifname, queues, vhost) or bridge (bridge), model, mac
     gpu                 GPU model (see qemu-system-<ARCH> -device help and "Display devices" section)
     display             QEMU UI backend (see qemu-system-<ARCH> -display help)
     sound               Sound card type (hda, ac97, sb16, none)
     spice               SPICE server config (unix, auto, <port number>, none)
     control_socket      Enable QMP control socket (True/False)
+    guest_agent         Add a qemu-guest-agent channel, used by "backup --freeze" (True/False)
+    log_file            Save QEMU output to a size-rotated file (path, or dict with path/max_size/backups)
+    topology            Guest CPU topology (host, or dict like "sockets: 1, cores: 4, threads: 2")
+    cpu_pinning         Pin vCPU/emulator threads to host CPUs (auto, or dict like "vcpus: 2-9, emulator: 0-1")
+    hugepages           Back guest RAM with huge pages (True, 2M, 1G, or dict with size/prealloc/share/backend/fallback)
 
 '''
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'fleet':
+        from .fleet import fleet_main
+        sys.exit(fleet_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'clone':
+        from .clone import clone_main
+        sys.exit(clone_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'query':
+        from .qmp import query_main
+        sys.exit(query_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'metrics':
+        from .metrics import metrics_main
+        sys.exit(metrics_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'image':
+        from .image import image_main
+        sys.exit(image_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'backup':
+        from .backup import backup_main
+        sys.exit(backup_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        from .bench import bench_main
+        sys.exit(bench_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'ci':
+        from .ci import ci_main
+        sys.exit(ci_main(sys.argv[2:]))
+
     parser = argparse.ArgumentParser(prog='vmvm', description='User friendly QEMU frontend', usage=USAGE)
-    parser.add_argument('cmd', choices=['init','install','run','console'])
+    parser.add_argument('cmd', choices=['init','install','run','console','suspend','resume','flatten'])
     parser.add_argument('dir_name', nargs='?', default=os.getcwd())
+    parser.add_argument('--no-cache', action='store_true', help=f'ignore and do not write {CACHE_FILE_NAME}')
+    parser.add_argument('--streams', type=int, default=1, help='suspend: parallel migration streams (multifd, QEMU 9.0+)')
+    parser.add_argument('--compress', choices=['zstd','gzip'], default=None, help='suspend: compress the saved state')
+    parser.add_argument('--timings', action='store_true', help='install/run/resume: print wall-clock time of every startup phase')
     args = parser.parse_args()
 
     logging.basicConfig(format='%(asctime)s  %(levelname)s  %(message)s', level=logging.DEBUG if args.cmd != 'console' else logging.WARNING)
 
 
-    app = App(args.dir_name)
-    getattr(app,'act_'+args.cmd)()
+    app = App(args.dir_name, use_cache=not args.no_cache)
+    app.print_timings = args.timings
+    if args.cmd == 'suspend':
+        if args.streams > 1 and args.compress:
+            parser.error('--streams and --compress cannot be combined')
+        exit_code = app.act_suspend(streams=args.streams, compress=args.compress)
+    else:
+        exit_code = getattr(app,'act_'+args.cmd)()
+    if exit_code:
+        sys.exit(exit_code)
 
 
 if __name__ == '__main__':
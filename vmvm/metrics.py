@@ -0,0 +1,329 @@
+#
+# Prometheus/OpenMetrics exporter for running VMs.
+# Sources: /proc/<qemu pid> (CPU time, RSS, I/O of every VM launched by vmvm) and, for VMs with a QMP socket,
+# query-blockstats, query-balloon and query-stats (KVM vm/vcpu statistics).
+# A QMP monitor serves one client at a time, so each scrape opens its connections and closes them when done;
+# per-VM static data (stats schemas, vCPU map, commands the VM does not support) is fetched once per QEMU process.
+#
+
+import os
+import re
+import glob
+import asyncio
+import argparse
+import logging
+from dataclasses import dataclass, field
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from .qmp import QMPPool, QMP_TIMEOUT
+from .utils import get_runtime_dir, SockType, PID_FILE_NAME
+
+DEFAULT_LISTEN = '127.0.0.1:9477'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+BLOCK_STATS = {
+    'rd_bytes':             ('vmvm_block_read_bytes_total', 'Bytes read by the guest'),
+    'wr_bytes':             ('vmvm_block_written_bytes_total', 'Bytes written by the guest'),
+    'rd_operations':        ('vmvm_block_read_ops_total', 'Read operations'),
+    'wr_operations':        ('vmvm_block_write_ops_total', 'Write operations'),
+    'flush_operations':     ('vmvm_block_flush_ops_total', 'Flush operations'),
+    'rd_total_time_ns':     ('vmvm_block_read_time_seconds_total', 'Time spent on reads'),
+    'wr_total_time_ns':     ('vmvm_block_write_time_seconds_total', 'Time spent on writes'),
+    'flush_total_time_ns':  ('vmvm_block_flush_time_seconds_total', 'Time spent on flushes'),
+}
+
+KVM_STAT_TYPES = { 'cumulative': 'counter', 'instant': 'gauge', 'peak': 'gauge' }
+
+
+@dataclass
+class MetricFamily:
+    name: str
+    type: str
+    help: str
+    samples: list[tuple[dict, float]] = field(default_factory=list)
+
+
+class MetricSet:
+    def __init__(self):
+        self.families: dict[str, MetricFamily] = {}
+
+    def add(self, name: str, type: str, help: str, labels: dict, value: float) -> None:
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = MetricFamily(name, type, help)
+        family.samples.append((labels, value))
+
+    def render(self) -> str:
+        """ Prometheus text exposition format """
+        lines = []
+        for f in self.families.values():
+            lines.append(f'# HELP {f.name} {f.help}')
+            lines.append(f'# TYPE {f.name} {f.type}')
+            for labels, value in f.samples:
+                label_str = ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+                lines.append(f'{f.name}{{{label_str}}} {_format_value(value)}' if label_str else f'{f.name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_value(value: float) -> str:
+    # integral counters (bytes, ticks) must not lose precision to exponent notation
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+@dataclass
+class ProcStats:
+    cpu_seconds: float
+    rss_bytes: int
+    threads: int
+    start_ticks: int
+    read_bytes: int | None = None
+    write_bytes: int | None = None
+
+
+def read_proc_stats(pid: int, proc_root: str = '/proc') -> ProcStats | None:
+    """
+        CPU time, RSS and I/O of the process, None if it is gone or is not QEMU (pid reused)
+    """
+    try:
+        with open(f'{proc_root}/{pid}/stat', 'r') as f:
+            stat = f.read()
+        with open(f'{proc_root}/{pid}/statm', 'r') as f:
+            statm = f.read().split()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    comm = stat[stat.index('(') + 1:stat.rindex(')')]
+    if not comm.startswith('qemu'):
+        return None
+    # fields after "(comm)", starting with field 3 (state)
+    fields = stat[stat.rindex(')') + 2:].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    stats = ProcStats(
+        cpu_seconds=(int(fields[11]) + int(fields[12])) / ticks,
+        rss_bytes=int(statm[1]) * os.sysconf('SC_PAGE_SIZE'),
+        threads=int(fields[17]),
+        start_ticks=int(fields[19]),
+    )
+    try:
+        with open(f'{proc_root}/{pid}/io', 'r') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        stats.read_bytes = int(io['read_bytes'])
+        stats.write_bytes = int(io['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return stats
+
+
+@dataclass
+class VMState:
+    """ per QEMU process data that does not change while it runs """
+    start_ticks: int | None = None
+    unsupported: set = field(default_factory=set)
+    kvm_schemas: dict | None = None     # (target, stat name) -> metric type
+    vcpu_index: dict | None = None      # qom path -> cpu index
+
+
+class MetricsCollector:
+    def __init__(self, runtime_dir: str | None = None, proc_root: str = '/proc', timeout: float = QMP_TIMEOUT):
+        self._runtime_dir = runtime_dir or get_runtime_dir()
+        self._proc_root = proc_root
+        self._timeout = timeout
+        self._states: dict[str, VMState] = {}
+
+    def _discover(self) -> dict[str, dict]:
+        """ vm name -> { pid, sock } of VMs that have a pid file or a QMP socket """
+        vms = {}
+        for vm_dir in sorted(glob.glob(os.path.join(glob.escape(self._runtime_dir), '*', ''))):
+            name = os.path.basename(os.path.dirname(vm_dir))
+            sock = os.path.join(vm_dir, f'{SockType.QMP}.sock')
+            pid = None
+            try:
+                with open(os.path.join(vm_dir, PID_FILE_NAME), 'r') as f:
+                    pid = int(f.read().strip())
+            except (FileNotFoundError, ValueError):
+                pass
+            if pid is not None or os.path.exists(sock):
+                vms[name] = { 'pid': pid, 'sock': sock if os.path.exists(sock) else None }
+        return vms
+
+    async def _qmp(self, pool: QMPPool, name: str, state: VMState, command: str, arguments: dict | None = None):
+        """ runs the command unless the VM already refused it, None on failure """
+        from qemu.qmp import ExecuteError
+
+        if command in state.unsupported:
+            return None
+        try:
+            return await pool.execute(name, command, arguments)
+        except ExecuteError as e:
+            # e.g. no balloon device, or QEMU too old for query-stats
+            logging.debug('%s: %s is not available: %s', name, command, e)
+            state.unsupported.add(command)
+            return None
+
+    async def _collect_qmp(self, pool: QMPPool, name: str, state: VMState, m: MetricSet) -> None:
+        labels = { 'vm': name }
+        try:
+            status = await pool.execute(name, 'query-status')
+        except Exception as e:
+            logging.debug('%s: QMP is not reachable: %s', name, e)
+            m.add('vmvm_qmp_up', 'gauge', 'QMP socket responds', labels, 0)
+            return
+        m.add('vmvm_qmp_up', 'gauge', 'QMP socket responds', labels, 1)
+        m.add('vmvm_running', 'gauge', 'Guest CPUs are running', labels, 1 if status['running'] else 0)
+
+        if state.kvm_schemas is None:
+            schemas = await self._qmp(pool, name, state, 'query-stats-schemas', { 'provider': 'kvm' }) or []
+            state.kvm_schemas = { (s['target'], stat['name']): KVM_STAT_TYPES[stat['type']]
+                                  for s in schemas for stat in s['stats'] if stat['type'] in KVM_STAT_TYPES }
+            cpus = await self._qmp(pool, name, state, 'query-cpus-fast') or []
+            state.vcpu_index = { c['qom-path']: c['cpu-index'] for c in cpus }
+
+        block_stats, balloon, vm_stats, vcpu_stats = await asyncio.gather(
+            self._qmp(pool, name, state, 'query-blockstats'),
+            self._qmp(pool, name, state, 'query-balloon'),
+            self._qmp(pool, name, state, 'query-stats', { 'target': 'vm', 'providers': [{ 'provider': 'kvm' }] }) if state.kvm_schemas else _none(),
+            self._qmp(pool, name, state, 'query-stats', { 'target': 'vcpu', 'providers': [{ 'provider': 'kvm' }] }) if state.kvm_schemas else _none(),
+            return_exceptions=True)
+
+        if isinstance(block_stats, list):
+            for dev in block_stats:
+                dev_labels = dict(labels, device=dev.get('node-name') or dev.get('qdev') or dev.get('device', ''))
+                for key, (metric, help) in BLOCK_STATS.items():
+                    if key in dev['stats']:
+                        value = dev['stats'][key] / 1e9 if key.endswith('_ns') else dev['stats'][key]
+                        m.add(metric, 'counter', help, dev_labels, value)
+        if isinstance(balloon, dict):
+            m.add('vmvm_balloon_actual_bytes', 'gauge', 'Guest memory size as set by the balloon', labels, balloon['actual'])
+        for target, result in (('vm', vm_stats), ('vcpu', vcpu_stats)):
+            if not isinstance(result, list):
+                continue
+            for entry in result:
+                entry_labels = labels
+                if target == 'vcpu':
+                    entry_labels = dict(labels, vcpu=state.vcpu_index.get(entry.get('qom-path'), entry.get('qom-path')))
+                for stat in entry['stats']:
+                    metric_type = state.kvm_schemas.get((target, stat['name']))
+                    # histograms are not exported
+                    if metric_type is None or isinstance(stat['value'], list):
+                        continue
+                    suffix = '_total' if metric_type == 'counter' else ''
+                    m.add(f'vmvm_kvm_{target}_{_metric_name(stat["name"])}{suffix}', metric_type,
+                          f'KVM {target} statistic {stat["name"]}', entry_labels, int(stat['value']))
+
+    def _collect_proc(self, name: str, pid: int, m: MetricSet) -> None:
+        stats = read_proc_stats(pid, self._proc_root)
+        if stats is None:
+            return
+        if self._states[name].start_ticks != stats.start_ticks:
+            # QEMU was restarted, the cached per-process data is stale
+            self._states[name] = VMState(start_ticks=stats.start_ticks)
+        labels = { 'vm': name }
+        m.add('vmvm_cpu_seconds_total', 'counter', 'CPU time of the QEMU process', labels, stats.cpu_seconds)
+        m.add('vmvm_memory_rss_bytes', 'gauge', 'Resident memory of the QEMU process', labels, stats.rss_bytes)
+        m.add('vmvm_threads', 'gauge', 'Threads of the QEMU process', labels, stats.threads)
+        if stats.read_bytes is not None:
+            m.add('vmvm_process_read_bytes_total', 'counter', 'Bytes read from storage by the QEMU process', labels, stats.read_bytes)
+            m.add('vmvm_process_written_bytes_total', 'counter', 'Bytes written to storage by the QEMU process', labels, stats.write_bytes)
+
+    async def collect(self) -> MetricSet:
+        m = MetricSet()
+        vms = self._discover()
+        for name in list(self._states):
+            if name not in vms:
+                del self._states[name]
+        for name, vm in vms.items():
+            self._states.setdefault(name, VMState())
+            if vm['pid'] is not None:
+                self._collect_proc(name, vm['pid'], m)
+        qmp_vms = [ name for name, vm in vms.items() if vm['sock'] is not None ]
+        async with QMPPool({ name: vms[name]['sock'] for name in qmp_vms }, self._timeout) as pool:
+            results = await asyncio.gather(*(self._collect_qmp(pool, name, self._states[name], m) for name in qmp_vms),
+                                           return_exceptions=True)
+        for name, result in zip(qmp_vms, results):
+            if isinstance(result, Exception):
+                logging.warning('%s: QMP metrics collection failed: %s', name, result)
+        m.add('vmvm_vms', 'gauge', 'VMs found in the runtime directory', {}, len(vms))
+        return m
+
+
+async def _none():
+    return None
+
+
+def write_textfile(path: str, text: str) -> None:
+    """ atomic replace, so that the node exporter textfile collector never reads a partial file """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+async def run_textfile(collector: MetricsCollector, path: str, interval: float, once: bool = False) -> None:
+    while True:
+        write_textfile(path, (await collector.collect()).render())
+        if once:
+            return
+        await asyncio.sleep(interval)
+
+
+def serve_http(collector: MetricsCollector, host: str, port: int) -> None:
+    """
+        serves /metrics, every request is one collection
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            try:
+                body = asyncio.run(collector.collect()).render().encode()
+            except Exception as e:
+                logging.error('metrics collection failed: %s', e)
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format, *args)
+
+    server = HTTPServer((host, port), Handler)
+    logging.info('serving metrics on http://%s:%d/metrics', host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def metrics_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog='vmvm metrics', description='Export metrics of running VMs in Prometheus format')
+    parser.add_argument('--listen', default=DEFAULT_LISTEN, help='HOST:PORT to serve /metrics on')
+    parser.add_argument('--textfile', metavar='PATH', help='write to a node exporter textfile collector file instead of serving HTTP')
+    parser.add_argument('--interval', type=float, default=15.0, help='textfile update interval in seconds')
+    parser.add_argument('--once', action='store_true', help='write the textfile (or stdout if no --textfile) once and exit')
+    parser.add_argument('--timeout', type=float, default=QMP_TIMEOUT, help='per-VM QMP timeout in seconds')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s  %(levelname)s  %(message)s', level=logging.INFO)
+    collector = MetricsCollector(timeout=args.timeout)
+
+    if args.once and not args.textfile:
+        print(asyncio.run(collector.collect()).render(), end='')
+        return 0
+    if args.textfile:
+        asyncio.run(run_textfile(collector, args.textfile, args.interval, args.once))
+        return 0
+    host, _, port = args.listen.rpartition(':')
+    serve_http(collector, host or '127.0.0.1', int(port))
+    return 0
@@ -0,0 +1,80 @@
+#
+# https://passt.top/passt/about/
+# passt connects the guest to the host network stack without privileges: guest frames arrive over a unix
+# stream socket (QEMU `-netdev stream`) and are translated to ordinary host sockets.
+#
+
+import os
+import shutil
+import logging
+import threading
+import subprocess
+from .utils import get_passt_sock_path, wait_for_socket
+
+SOCKET_TIMEOUT = 5.0
+
+
+class PasstError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+def passt_args(net: dict, sock: str) -> list[str]:
+    args = [ '--foreground', '--socket', sock ]
+    for proto in ('tcp', 'udp'):
+        specs = [ f'{p["host"]}:{p["guest"]}' for p in net['forward_ports'] if p.get('proto', 'tcp') == proto ]
+        if specs:
+            args += [ '-t' if proto == 'tcp' else '-u', ','.join(specs) ]
+    return args
+
+
+class PasstManager:
+    def __init__(self, vm_name: str, nets: list[dict], exe_fn=lambda: shutil.which('passt')):
+        self._vm_name = vm_name
+        # NIC index is kept: it names the netdev and the socket
+        self._nets = [ (idx, net) for idx, net in enumerate(nets) if net['type'] == 'passt' ]
+        self._find_exe = exe_fn
+        self._processes: list[subprocess.Popen] = []
+        self._stopping = False
+
+    @property
+    def socks(self) -> list[str]:
+        return [ get_passt_sock_path(self._vm_name, idx) for idx, _ in self._nets ]
+
+    def run(self) -> None:
+        if not self._nets or self._processes:
+            return
+        exe = self._find_exe()
+        if exe is None:
+            raise PasstError('passt not found. Please install the passt package or use "type: user"')
+        self._stopping = False
+        for (idx, net), sock in zip(self._nets, self.socks):
+            if os.path.exists(sock):
+                os.remove(sock)
+            proc = subprocess.Popen([ exe ] + passt_args(net, sock))
+            self._processes.append(proc)
+            threading.Thread(target=self._watch, args=(proc, idx), name=f'passt-{idx}', daemon=True).start()
+        for proc, (idx, _), sock in zip(self._processes, self._nets, self.socks):
+            problem = wait_for_socket(proc, sock, SOCKET_TIMEOUT)
+            if problem is not None:
+                raise PasstError(f'passt for net{idx} {problem}')
+
+    def _watch(self, proc: subprocess.Popen, idx: int) -> None:
+        exit_code = proc.wait()
+        if not self._stopping:
+            logging.error('passt for net%d exited with code %d, the guest lost this network link', idx, exit_code)
+
+    def shutdown(self) -> None:
+        self._stopping = True
+        for proc in self._processes:
+            if proc.poll() is None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+        self._processes = []
+        for sock in self.socks:
+            if os.path.exists(sock):
+                os.remove(sock)
@@ -0,0 +1,133 @@
+#
+# Leases TCP ports (SPICE) to VMs through a lock-protected state file, so that VMs started
+# at the same time never pick the same port even before QEMU has bound it.
+#
+
+import os
+import json
+import fcntl
+import socket
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+from .utils import get_runtime_dir
+
+
+class PortRegistryError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+def is_port_free(port: int) -> bool:
+    s = socket.socket()
+    try:
+        s.bind(('localhost',port))
+        return True
+    except OSError:
+        pass
+    finally:
+        s.close()
+    return False
+
+
+def is_pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class PortRegistry:
+    """
+        State file layout:
+            leases: vm name -> { port, pid }
+            free:   previously leased ports, reused first
+            next:   lowest never leased port
+        Acquire pops from `free` or bumps `next` instead of probing every port from the base upwards.
+        Leases whose holder pid is gone are reclaimed when `free` runs out.
+    """
+    def __init__(self, base_port: int, name: str = 'spice-ports',
+                 state_dir: str | None = None,
+                 port_free_fn=is_port_free,
+                 pid_alive_fn=is_pid_alive,
+                 max_port: int = 65535):
+        state_dir = state_dir or get_runtime_dir()
+        Path(state_dir).mkdir(parents=True, exist_ok=True)
+        self._path = os.path.join(state_dir, f'{name}.json')
+        self._lock_path = self._path + '.lock'
+        self._base_port = base_port
+        self._max_port = max_port
+        self._port_free = port_free_fn
+        self._pid_alive = pid_alive_fn
+
+    @contextmanager
+    def _locked_state(self):
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self._path, 'r') as f:
+                        state = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    state = { 'leases': {}, 'free': [], 'next': self._base_port }
+                yield state
+                tmp_path = f'{self._path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self._path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _reclaim_stale(self, state: dict) -> None:
+        for vm_name, lease in list(state['leases'].items()):
+            if not self._pid_alive(lease['pid']):
+                logging.debug('reclaiming port %d of %s (pid %d is gone)', lease['port'], vm_name, lease['pid'])
+                state['free'].append(lease['port'])
+                del state['leases'][vm_name]
+
+    def _next_candidate(self, state: dict) -> int:
+        if not state['free']:
+            self._reclaim_stale(state)
+        if state['free']:
+            return state['free'].pop()
+        port = state['next']
+        if port > self._max_port:
+            raise PortRegistryError('no more ports to lease')
+        state['next'] = port + 1
+        return port
+
+    def acquire(self, vm_name: str, pid: int | None = None) -> int:
+        pid = pid or os.getpid()
+        with self._locked_state() as state:
+            lease = state['leases'].get(vm_name)
+            if lease is not None:
+                if lease['pid'] == pid:
+                    return lease['port']
+                if self._pid_alive(lease['pid']):
+                    raise PortRegistryError(f'VM "{vm_name}" is already running (pid {lease["pid"]})')
+                del state['leases'][vm_name]
+                state['free'].append(lease['port'])
+            skipped = []
+            while True:
+                port = self._next_candidate(state)
+                # something outside of vmvm may listen there
+                if self._port_free(port):
+                    break
+                skipped.append(port)
+            # ports busy outside of vmvm go to the far end of the free list
+            state['free'] = skipped + state['free']
+            state['leases'][vm_name] = { 'port': port, 'pid': pid }
+            return port
+
+    def release(self, vm_name: str) -> None:
+        with self._locked_state() as state:
+            lease = state['leases'].pop(vm_name, None)
+            if lease is not None:
+                state['free'].append(lease['port'])
+
+    def leases(self) -> dict[str, dict]:
+        with self._locked_state() as state:
+            return dict(state['leases'])
@@ -0,0 +1,90 @@
+#
+# qcow2 image helpers: creation options and metadata cache sizing.
+# https://www.qemu.org/docs/master/interop/qcow2.html
+# https://www.qemu.org/docs/master/system/qemu-block-drivers.html#disk-image-file-formats (qcow2 cache sizing)
+#
+
+import os
+import struct
+from dataclasses import dataclass
+from .utils import disk_spec, disk_image_format_by_name
+
+QCOW2_MAGIC = 0x514649fb
+# magic, version, backing_file_offset, backing_file_size, cluster_bits, size
+HEADER_FORMAT = '>IIQIIQ'
+INCOMPATIBLE_FEATURES_OFFSET = 72
+EXTENDED_L2_BIT = 1 << 4
+DEFAULT_DISK_SIZE = '100G'
+
+
+@dataclass
+class Qcow2Info:
+    virtual_size: int
+    cluster_size: int
+    extended_l2: bool = False
+
+
+def read_qcow2_info(path: str) -> Qcow2Info | None:
+    """
+        reads the image geometry from the qcow2 header (no qemu-img fork), None if the file is missing or not qcow2
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(INCOMPATIBLE_FEATURES_OFFSET + 8)
+    except OSError:
+        return None
+    if len(header) < struct.calcsize(HEADER_FORMAT):
+        return None
+    magic, version, _, _, cluster_bits, size = struct.unpack_from(HEADER_FORMAT, header)
+    if magic != QCOW2_MAGIC:
+        return None
+    incompatible = struct.unpack_from('>Q', header, INCOMPATIBLE_FEATURES_OFFSET)[0] if version >= 3 and len(header) >= INCOMPATIBLE_FEATURES_OFFSET + 8 else 0
+    return Qcow2Info(virtual_size=size, cluster_size=1 << cluster_bits, extended_l2=bool(incompatible & EXTENDED_L2_BIT))
+
+
+def l2_cache_size(info: Qcow2Info) -> int:
+    """
+        L2 cache that maps the whole image: one 8 byte entry (16 with extended L2) per cluster,
+        rounded up to whole L2 tables (a table is one cluster)
+    """
+    entry_size = 16 if info.extended_l2 else 8
+    clusters = -(-info.virtual_size // info.cluster_size)
+    size = clusters * entry_size
+    return -(-size // info.cluster_size) * info.cluster_size
+
+
+def l2_cache_sizes(disks: list, base_dir: str = '.') -> list[int | None]:
+    """
+        `l2-cache-size` for every disk: computed from the image header for `l2_cache: auto` (the default),
+        explicit size in bytes, or None to keep the QEMU default (non-qcow2 disks, `l2_cache: false`, image not created yet)
+    """
+    sizes = []
+    for spec in map(disk_spec, disks):
+        l2_cache = spec.get('l2_cache', 'auto')
+        if (spec.get('format') or disk_image_format_by_name(spec['file'])) != 'qcow2' or spec['file'].startswith('/dev/') or l2_cache is None:
+            sizes.append(None)
+        elif l2_cache == 'auto':
+            info = read_qcow2_info(os.path.join(base_dir, spec['file']))
+            sizes.append(l2_cache_size(info) if info is not None else None)
+        else:
+            sizes.append(l2_cache)
+    return sizes
+
+
+def create_args(spec: dict, with_size: bool = True) -> tuple[list[str], list[str]]:
+    """
+        `qemu-img create` format options and size arguments
+        (the size is omitted for overlays unless set, they inherit it from the base)
+    """
+    img_format = spec.get('format') or disk_image_format_by_name(spec['file'])
+    opts = []
+    if 'cluster_size' in spec:
+        opts.append(f'cluster_size={spec["cluster_size"]}')
+    if 'preallocation' in spec:
+        opts.append(f'preallocation={spec["preallocation"]}')
+    if spec.get('lazy_refcounts'):
+        opts.append('lazy_refcounts=on')
+    if spec.get('extended_l2'):
+        opts.append('extended_l2=on')
+    args = [ '-f', img_format ] + ([ '-o', ','.join(opts) ] if opts else [])
+    return args, ([ str(spec.get('size', DEFAULT_DISK_SIZE)) ] if with_size or 'size' in spec else [])
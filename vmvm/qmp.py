@@ -0,0 +1,175 @@
+#
+# https://www.qemu.org/docs/master/interop/qemu-qmp-ref.html
+#
+
+import os
+import glob
+import json
+import asyncio
+import argparse
+import time
+from typing import Any
+from .utils import get_runtime_dir, SockType
+
+QMP_TIMEOUT = 5.0
+
+
+async def qmp_execute_async(sock_path: str, command: str, arguments: dict | None = None, timeout: float = QMP_TIMEOUT) -> Any:
+    """
+        connects to the QMP socket, runs one command and disconnects
+    """
+    from qemu.qmp import QMPClient
+
+    client = QMPClient('vmvm')
+    await asyncio.wait_for(client.connect(sock_path), timeout)
+    try:
+        return await asyncio.wait_for(client.execute(command, arguments), timeout)
+    finally:
+        await client.disconnect()
+
+
+def qmp_execute(sock_path: str, command: str, arguments: dict | None = None, timeout: float = QMP_TIMEOUT) -> Any:
+    return asyncio.run(qmp_execute_async(sock_path, command, arguments, timeout))
+
+
+def wait_for_qmp(sock_path: str, timeout: float, poll_interval: float = 0.1) -> bool:
+    """
+        waits until QEMU accepts connections on the QMP socket
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            qmp_execute(sock_path, 'query-status', timeout=max(0.1, deadline - time.monotonic()))
+            return True
+        except Exception:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll_interval)
+
+
+def discover_qmp_sockets(runtime_dir: str | None = None) -> dict[str, str]:
+    """
+        QMP sockets of VMs by name, found as <runtime dir>/<vm name>/qmp.sock (see utils.get_unix_sock_path)
+    """
+    runtime_dir = runtime_dir or get_runtime_dir()
+    paths = sorted(glob.glob(os.path.join(glob.escape(runtime_dir), '*', f'{SockType.QMP}.sock')))
+    return { os.path.basename(os.path.dirname(p)): p for p in paths }
+
+
+class QMPPool:
+    """
+        persistent QMP connections to many VMs, opened on first use and reopened when QEMU went away.
+        Commands to different VMs run concurrently, each with its own timeout.
+    """
+    def __init__(self, sockets: dict[str, str] | None = None, timeout: float = QMP_TIMEOUT):
+        self.sockets = dict(sockets) if sockets is not None else discover_qmp_sockets()
+        self._timeout = timeout
+        self._clients = {}
+        self._locks = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _client(self, name: str, timeout: float):
+        from qemu.qmp import QMPClient, Runstate
+
+        async with self._locks.setdefault(name, asyncio.Lock()):
+            client = self._clients.get(name)
+            if client is not None and client.runstate == Runstate.RUNNING:
+                return client
+            await self._drop(name)
+            client = QMPClient(name)
+            try:
+                await asyncio.wait_for(client.connect(self.sockets[name]), timeout)
+            except BaseException:
+                await self._disconnect(client)
+                raise
+            self._clients[name] = client
+            return client
+
+    @staticmethod
+    async def _disconnect(client) -> None:
+        try:
+            await client.disconnect()
+        except Exception:
+            # disconnect() re-raises whatever broke the connection, it is closed either way
+            pass
+
+    async def _drop(self, name: str) -> None:
+        client = self._clients.pop(name, None)
+        if client is not None:
+            await self._disconnect(client)
+
+    async def execute(self, name: str, command: str, arguments: dict | None = None, timeout: float | None = None) -> Any:
+        """
+            runs the command on VM `name`. A broken pooled connection is reopened and the command retried once.
+        """
+        from qemu.qmp import ExecuteError
+
+        timeout = timeout or self._timeout
+        for attempt in range(2):
+            client = await self._client(name, timeout)
+            try:
+                return await asyncio.wait_for(client.execute(command, arguments), timeout)
+            except ExecuteError:
+                raise
+            except Exception as e:
+                await self._drop(name)
+                if attempt or isinstance(e, asyncio.TimeoutError):
+                    raise
+
+    async def execute_all(self, command: str, arguments: dict | None = None,
+                          names: list[str] | None = None, timeout: float | None = None) -> dict[str, dict]:
+        """
+            runs the command on every VM (or on `names`) concurrently.
+            Returns { vm name: {'return': result} or {'error': text} }
+        """
+        names = list(self.sockets) if names is None else names
+
+        async def one(name: str) -> dict:
+            if name not in self.sockets:
+                return { 'error': 'no QMP socket' }
+            try:
+                return { 'return': await self.execute(name, command, arguments, timeout) }
+            except asyncio.TimeoutError:
+                return { 'error': f'timed out after {timeout or self._timeout}s' }
+            except Exception as e:
+                return { 'error': str(e) or type(e).__name__ }
+
+        return dict(zip(names, await asyncio.gather(*map(one, names))))
+
+    async def remove(self, name: str) -> None:
+        """ forgets the VM and closes its connection """
+        self.sockets.pop(name, None)
+        await self._drop(name)
+
+    async def close(self) -> None:
+        for name in list(self._clients):
+            await self._drop(name)
+
+
+def qmp_execute_all(sockets: dict[str, str], command: str, arguments: dict | None = None,
+                    timeout: float = QMP_TIMEOUT) -> dict[str, dict]:
+    async def run():
+        async with QMPPool(sockets, timeout) as pool:
+            return await pool.execute_all(command, arguments)
+    return asyncio.run(run())
+
+
+def query_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog='vmvm query', description='Run a QMP command on all running VMs')
+    parser.add_argument('command', help='QMP command, e.g. query-status')
+    parser.add_argument('arguments', nargs='?', type=json.loads, default=None, help='command arguments as JSON object')
+    parser.add_argument('--vm', action='append', help='limit to this VM (repeatable)')
+    parser.add_argument('--timeout', type=float, default=QMP_TIMEOUT, help='per-VM timeout in seconds')
+    args = parser.parse_args(argv)
+
+    sockets = discover_qmp_sockets()
+    if args.vm:
+        sockets = { name: sockets.get(name, os.path.join(get_runtime_dir(), name, f'{SockType.QMP}.sock')) for name in args.vm }
+    results = qmp_execute_all(sockets, args.command, args.arguments, args.timeout)
+    print(json.dumps(results, indent=4))
+    return 1 if any('error' in r for r in results.values()) else 0
@@ -0,0 +1,89 @@
+#
+# VM startup pipeline: launch steps (daemons, host probes, argv build, EFI vars copy) declare what they depend on
+# and independent steps run concurrently. Wall-clock start/end of every step is recorded for `--timings`.
+#
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+
+class StartupError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+@dataclass
+class Step:
+    name: str
+    fn: Callable[[], Any]
+    deps: list[str] = field(default_factory=list)
+
+
+class StartupPipeline:
+    def __init__(self, max_workers: int = 8):
+        self._steps: dict[str, Step] = {}
+        self._max_workers = max_workers
+        self._t0 = None
+        self.results: dict[str, Any] = {}
+        self.timings: dict[str, tuple[float, float]] = {}  # step -> (start, end) seconds since the pipeline start
+
+    def add(self, name: str, fn: Callable[[], Any], deps: list[str] = []) -> None:
+        """ `fn` can read the results of its dependencies from `results` """
+        unknown = [ d for d in deps if d not in self._steps ]
+        if unknown:
+            raise ValueError(f'step "{name}" depends on unknown steps {unknown}')
+        self._steps[name] = Step(name, fn, list(deps))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._t0
+
+    def mark(self, name: str, start: float) -> None:
+        """ records a step that ran outside of the pipeline (e.g. QEMU spawn) """
+        self.timings[name] = (start, self.elapsed())
+
+    def _run_step(self, step: Step) -> Any:
+        start = self.elapsed()
+        try:
+            return step.fn()
+        finally:
+            self.timings[step.name] = (start, self.elapsed())
+
+    def run(self) -> dict[str, Any]:
+        """
+            runs every step once all of its dependencies are done. After the first failure no new step is started,
+            running ones are waited for and the error is raised.
+        """
+        self._t0 = time.perf_counter()
+        pending = dict(self._steps)
+        running = {}
+        failure = None
+        with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='startup') as executor:
+            while pending or running:
+                if failure is None:
+                    for step in [ s for s in pending.values() if all(d in self.results for d in s.deps) ]:
+                        del pending[step.name]
+                        running[executor.submit(self._run_step, step)] = step.name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except BaseException as e:
+                        logging.debug('startup step "%s" failed: %s', name, e)
+                        failure = failure or e
+        if failure is not None:
+            raise failure
+        return self.results
+
+    def format_timings(self) -> str:
+        lines = [ 'startup timings (ms):      start      end   duration' ]
+        for name, (start, end) in sorted(self.timings.items(), key=lambda kv: kv[1]):
+            lines.append(f'  {name:<20} {start * 1000:9.1f} {end * 1000:8.1f} {(end - start) * 1000:10.1f}')
+        if self.timings:
+            lines.append(f'  {"total":<20} {0:9.1f} {max(end for _, end in self.timings.values()) * 1000:8.1f}')
+        return '\n'.join(lines)
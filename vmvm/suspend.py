@@ -0,0 +1,201 @@
+#
+# Suspend to file / resume: the VM RAM and device state is saved with QMP migration to a local file,
+# and loaded back by a new QEMU started with `-incoming defer`.
+# https://www.qemu.org/docs/master/devel/migration/main.html
+#
+# Streams:     one stream uses the file: URI; more streams use multifd with mapped-ram (QEMU 9.0+),
+#              each channel writes its pages at fixed offsets of the same file in parallel.
+# Compression: the stream is piped through multithreaded zstd (or gzip) with an exec: URI.
+#
+
+import os
+import re
+import json
+import time
+import shlex
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass, asdict
+
+from .qmp import QMPPool
+
+STATE_FORMAT = 1
+STATE_FILE_NAME = 'suspended.vmstate'
+COMPRESSORS = {
+    'zstd': ('zstd -q -T0 -o {path}', 'zstd -q -d -c {path}'),
+    'gzip': ('gzip -c > {path}', 'gzip -d -c {path}'),
+}
+MIGRATION_POLL_INTERVAL = 0.2
+
+
+class SuspendError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+@dataclass
+class SavedState:
+    """ metadata stored next to the state file (<state file>.json) """
+    argv_sha256: str
+    qemu: list | None
+    disks: dict[str, list]      # path -> [size, mtime_ns] when the state was saved
+    streams: int = 1
+    compress: str | None = None
+    format: int = STATE_FORMAT
+
+
+def metadata_path(state_path: str) -> str:
+    return state_path + '.json'
+
+
+def normalize_argv(args: list[str]) -> list[str]:
+    """
+        drops parts of the QEMU argv that do not affect the saved state: boot order, the SPICE port (leased per launch)
+        and `-incoming` (a resumed VM runs with `-incoming defer` and must be suspendable again)
+    """
+    result = []
+    it = iter(args)
+    for arg in it:
+        if arg in ('-boot', '-incoming'):
+            next(it, None)
+            continue
+        if arg.startswith('port=') and result and result[-1] == '-spice':
+            arg = re.sub(r'^port=\d+', 'port=*', arg)
+        result.append(arg)
+    return result
+
+
+def argv_fingerprint(args: list[str]) -> str:
+    return hashlib.sha256(json.dumps(normalize_argv(args)).encode()).hexdigest()
+
+
+def read_process_argv(pid: int, proc_root: str = '/proc') -> list[str]:
+    """ argv of the running QEMU without the executable """
+    with open(f'{proc_root}/{pid}/cmdline', 'rb') as f:
+        return [ a.decode() for a in f.read().split(b'\0')[1:-1] ]
+
+
+def disk_stats(paths: list[str]) -> dict[str, list]:
+    stats = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats[path] = [st.st_size, st.st_mtime_ns]
+        except FileNotFoundError:
+            stats[path] = None
+    return stats
+
+
+def save_metadata(state_path: str, state: SavedState) -> None:
+    with open(metadata_path(state_path), 'w') as f:
+        json.dump(asdict(state), f, indent=4)
+
+
+def load_metadata(state_path: str) -> SavedState:
+    try:
+        with open(metadata_path(state_path), 'r') as f:
+            return SavedState(**json.load(f))
+    except FileNotFoundError:
+        raise SuspendError(f'no saved state found ({metadata_path(state_path)} does not exist)')
+    except (ValueError, TypeError) as e:
+        raise SuspendError(f'corrupted saved state metadata: {e}')
+
+
+def remove_state(state_path: str) -> None:
+    for path in (state_path, metadata_path(state_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def validate_state(state: SavedState, args: list[str], qemu: list | None) -> None:
+    """
+        rejects the saved state if it cannot be loaded safely by a QEMU started with `args`
+    """
+    if state.format != STATE_FORMAT:
+        raise SuspendError(f'saved state format {state.format} is not supported')
+    if state.argv_sha256 != argv_fingerprint(args):
+        raise SuspendError('the VM configuration changed since the state was saved, the saved state does not match the QEMU command line')
+    if state.qemu != qemu:
+        raise SuspendError(f'QEMU binary changed since the state was saved ({state.qemu} -> {qemu})')
+    changed = [ path for path, st in disk_stats(list(state.disks)).items() if st != state.disks[path] ]
+    if changed:
+        raise SuspendError(f'disk images were modified since the state was saved: {", ".join(changed)}')
+
+
+def migration_uri(state_path: str, streams: int, compress: str | None, incoming: bool) -> str:
+    if compress is not None:
+        return 'exec:' + COMPRESSORS[compress][1 if incoming else 0].format(path=shlex.quote(state_path))
+    return f'file:{state_path}'
+
+
+async def _set_migration_options(pool: QMPPool, name: str, streams: int) -> None:
+    if streams > 1:
+        await pool.execute(name, 'migrate-set-capabilities', { 'capabilities': [
+            { 'capability': 'multifd', 'state': True },
+            { 'capability': 'mapped-ram', 'state': True },
+        ] })
+        await pool.execute(name, 'migrate-set-parameters', { 'multifd-channels': streams })
+
+
+async def _wait_migration(pool: QMPPool, name: str, timeout: float | None) -> dict:
+    deadline = None if timeout is None else time.monotonic() + timeout
+    last_report = 0.0
+    while True:
+        info = await pool.execute(name, 'query-migrate')
+        status = info.get('status')
+        if status == 'completed':
+            return info
+        if status in ('failed', 'cancelled'):
+            raise SuspendError(f'migration {status}: {info.get("error-desc", "unknown error")}')
+        if 'ram' in info and time.monotonic() - last_report > 5:
+            last_report = time.monotonic()
+            logging.info('saved %d of %d MiB', info['ram']['transferred'] >> 20, info['ram']['total'] >> 20)
+        if deadline is not None and time.monotonic() > deadline:
+            raise SuspendError('migration did not complete in time')
+        await asyncio.sleep(MIGRATION_POLL_INTERVAL)
+
+
+async def save_state_async(qmp_sock: str, state_path: str, streams: int = 1, compress: str | None = None,
+                           timeout: float | None = None) -> dict:
+    """
+        pauses the VM, streams its state to `state_path` and quits QEMU. On failure the VM is resumed.
+    """
+    async with QMPPool({ 'vm': qmp_sock }) as pool:
+        await _set_migration_options(pool, 'vm', streams)
+        # paused VM: pages are not dirtied, every page is written exactly once
+        await pool.execute('vm', 'stop')
+        try:
+            await pool.execute('vm', 'migrate', { 'uri': migration_uri(state_path, streams, compress, incoming=False) })
+            info = await _wait_migration(pool, 'vm', timeout)
+        except BaseException:
+            await pool.execute('vm', 'cont')
+            raise
+        try:
+            await pool.execute('vm', 'quit')
+        except Exception as e:
+            # QEMU may exit before the reply reaches us
+            logging.debug('quit: %s', e)
+        return info
+
+
+async def load_state_async(qmp_sock: str, state_path: str, streams: int = 1, compress: str | None = None,
+                           timeout: float | None = None) -> dict:
+    """
+        feeds the saved state to a QEMU started with `-incoming defer` and continues the VM once loaded
+        (it was paused when saved, so it stays paused after the migration otherwise)
+    """
+    async with QMPPool({ 'vm': qmp_sock }) as pool:
+        await _set_migration_options(pool, 'vm', streams)
+        await pool.execute('vm', 'migrate-incoming', { 'uri': migration_uri(state_path, streams, compress, incoming=True) })
+        info = await _wait_migration(pool, 'vm', timeout)
+        await pool.execute('vm', 'cont')
+        return info
+
+
+def save_state(*args, **kwargs) -> dict:
+    return asyncio.run(save_state_async(*args, **kwargs))
+
+
+def load_state(*args, **kwargs) -> dict:
+    return asyncio.run(load_state_async(*args, **kwargs))
@@ -5,6 +5,13 @@
 import os
 import subprocess
 from shutil import rmtree
+from .utils import wait_for_socket
+
+SOCKET_TIMEOUT = 5.0
+
+class TPMError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
 
 class TPMManager:
     def __init__(self, tag: str):
@@ -16,14 +23,21 @@ class TPMManager:
             os.mkdir(self._tpmdir)
 
         if self._process is None:
-            self._process = subprocess.Popen([
-                'swtpm',
-                'socket',
-                '--tpmstate', f'dir={self._tpmdir}',
-                '--ctrl', f'type=unixio,path={self.sock}',
-                '--tpm2',
-                #'--log', 'level=20',
-                ])
+            try:
+                self._process = subprocess.Popen([
+                    'swtpm',
+                    'socket',
+                    '--tpmstate', f'dir={self._tpmdir}',
+                    '--ctrl', f'type=unixio,path={self.sock}',
+                    '--tpm2',
+                    #'--log', 'level=20',
+                    ])
+            except FileNotFoundError:
+                raise TPMError('swtpm not found. Please install the swtpm package.')
+            # QEMU gives up at once if the control socket is not accepting yet
+            problem = wait_for_socket(self._process, self.sock, SOCKET_TIMEOUT, connect=True)
+            if problem is not None:
+                raise TPMError(f'swtpm {problem}')
 
     def shutdown(self) -> None:
         if self._process is not None:
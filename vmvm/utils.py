@@ -1,15 +1,170 @@
 import os
+import errno
 from pathlib import Path
 from enum import StrEnum
 
 def disk_image_format_by_name(filename: str) -> str:
     return 'qcow2' if 'qcow2' in filename else 'raw'
 
+def disk_spec(disk: str | dict) -> dict:
+    """
+        disks are configured either as plain path or as dict with 'file' and per-disk settings
+    """
+    return disk if type(disk) == dict else { 'file': disk }
+
 class SockType(StrEnum):
     SPICE = 'spice'
     QMP = 'qmp'
+    QGA = 'qga'
 
-def get_unix_sock_path(sock_type: SockType, vm_name: str) -> str:
-    dir = f'/run/user/{os.getuid()}/qemu/{vm_name}/'
+def get_runtime_dir() -> str:
+    """ per-user directory for sockets and state of running VMs """
+    return f'/run/user/{os.getuid()}/qemu/'
+
+def get_vm_runtime_dir(vm_name: str) -> str:
+    dir = get_runtime_dir() + f'{vm_name}/'
     Path(dir).mkdir(parents=True,exist_ok=True)
-    return dir + f'{sock_type}.sock'
+    return dir
+
+def get_unix_sock_path(sock_type: SockType, vm_name: str) -> str:
+    return get_vm_runtime_dir(vm_name) + f'{sock_type}.sock'
+
+def get_virtiofs_sock_path(vm_name: str, tag: str) -> str:
+    """ vhost-user socket of the virtiofsd serving share `tag` """
+    return get_vm_runtime_dir(vm_name) + f'virtiofsd-{tag}.sock'
+
+def get_passt_sock_path(vm_name: str, idx: int) -> str:
+    """ unix stream socket of the passt instance backing NIC `idx` """
+    return get_vm_runtime_dir(vm_name) + f'passt-{idx}.sock'
+
+def wait_for_socket(proc, path: str, timeout: float, connect: bool = False) -> str | None:
+    """
+        waits until the daemon `proc` (subprocess.Popen) creates its listening socket, returns the reason if it did not.
+        With `connect` the socket must also accept a connection (not for single-client daemons like virtiofsd).
+    """
+    import time
+    import socket
+    deadline = time.monotonic() + timeout
+    while True:
+        if os.path.exists(path):
+            if not connect:
+                return None
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                try:
+                    s.connect(path)
+                    return None
+                except OSError:
+                    pass
+        if proc.poll() is not None:
+            return f'exited with code {proc.returncode}'
+        if time.monotonic() > deadline:
+            return f'did not create {path}' if not os.path.exists(path) else f'does not accept connections on {path}'
+        time.sleep(0.01)
+
+PID_FILE_NAME = 'qemu.pid'
+
+def get_pid_file_path(vm_name: str) -> str:
+    """ pid of the QEMU process of a running VM, written by vmvm on launch """
+    return get_vm_runtime_dir(vm_name) + PID_FILE_NAME
+
+def read_running_pid(vm_name: str) -> int | None:
+    """ pid of the QEMU process of the VM, None if it is not running """
+    from .port_registry import is_pid_alive
+    try:
+        with open(get_pid_file_path(vm_name), 'r') as f:
+            pid = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return pid if is_pid_alive(pid) else None
+
+def parse_cpu_list(spec: str | int | list) -> list[int]:
+    """
+        parses kernel-style CPU list such as "0-3,8,10-11" (also accepts int or list of ints/specs)
+    """
+    if type(spec) == int:
+        return [spec]
+    if type(spec) == list:
+        return [cpu for item in spec for cpu in parse_cpu_list(item)]
+    cpus = []
+    for part in str(spec).strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus += list(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def parse_size(size: str | int, default_suffix: str = 'M') -> int:
+    """
+        converts QEMU-style size like "512M" or "8G" to bytes. Plain numbers use `default_suffix` (QEMU treats -m 512 as MiB)
+    """
+    units = { 'B': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+    s = str(size).strip().upper()
+    if s.endswith('IB'):
+        s = s[:-2]
+    suffix = s[-1] if s and s[-1] in units else default_suffix
+    number = s[:-1] if s and s[-1] in units else s
+    return int(float(number) * units[suffix])
+
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1 << 20
+
+def _copy_data_extents(src_fd: int, dst_fd: int, size: int) -> str:
+    """
+        copies only the data extents of `src_fd` (found with SEEK_DATA/SEEK_HOLE), holes stay holes in `dst_fd`.
+        Extents are copied in-kernel with copy_file_range, else with pread/pwrite. Returns the method used.
+    """
+    method = 'copy_file_range'
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(src_fd, offset, os.SEEK_DATA)
+            end = min(os.lseek(src_fd, start, os.SEEK_HOLE), size)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break           # only a hole is left
+            start, end = offset, size   # no SEEK_DATA support, the rest is one extent
+        while start < end:
+            if method == 'copy_file_range':
+                try:
+                    n = os.copy_file_range(src_fd, dst_fd, end - start, start, start)
+                except OSError:
+                    # e.g. EXDEV across filesystems on older kernels
+                    method = 'copy'
+                    continue
+            else:
+                n = os.pwrite(dst_fd, os.pread(src_fd, min(COPY_CHUNK_SIZE, end - start), start), start)
+            if n == 0:
+                end = size = start  # the source shrank while copying
+                break
+            start += n
+        offset = end
+    os.ftruncate(dst_fd, size)
+    return method
+
+def copy_file(src: str, dst: str) -> str:
+    """
+        copies `src` to `dst` without forking: a reflink (shared extents) on CoW filesystems (btrfs, XFS),
+        else a sparse copy of the data extents only (see `_copy_data_extents`). Returns the method used:
+        reflink, copy_file_range or copy. The copy is written to a temporary file and renamed,
+        so `dst` is never seen half-written.
+    """
+    import fcntl
+    import threading
+    # unique per thread too, several VMs of one process may copy the same file at once
+    tmp = f'{dst}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                method = 'reflink'
+            except OSError:
+                method = _copy_data_extents(fsrc.fileno(), fdst.fileno(), os.fstat(fsrc.fileno()).st_size)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return method
@@ -0,0 +1,98 @@
+#
+# https://gitlab.com/virtio-fs/virtiofsd
+# https://www.qemu.org/docs/master/system/devices/vhost-user.html
+#
+
+import os
+import shutil
+import logging
+import threading
+import subprocess
+from .utils import get_virtiofs_sock_path, wait_for_socket
+
+# distributions install virtiofsd outside of PATH
+VIRTIOFSD_PATHS = [ '/usr/libexec/virtiofsd', '/usr/lib/qemu/virtiofsd', '/usr/lib/virtiofsd' ]
+SOCKET_TIMEOUT = 5.0
+
+
+class VirtiofsdError(Exception):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+def find_virtiofsd() -> str | None:
+    return shutil.which('virtiofsd') or next((p for p in VIRTIOFSD_PATHS if os.access(p, os.X_OK)), None)
+
+
+def virtiofsd_args(share: dict, sock: str, shared_dir: str) -> list[str]:
+    args = [
+        f'--socket-path={sock}',
+        f'--shared-dir={shared_dir}',
+        f'--cache={share["cache"]}',
+    ]
+    if share['thread_pool_size'] is not None:
+        args.append(f'--thread-pool-size={share["thread_pool_size"]}')
+    if os.getuid() != 0:
+        # the namespace sandbox needs privileges (or a user namespace uid map) an ordinary user does not have
+        args.append('--sandbox=none')
+    return args
+
+
+class VirtiofsdManager:
+    def __init__(self, vm_name: str, shares: list[dict], base_dir: str = '.', exe_fn=find_virtiofsd):
+        self._vm_name = vm_name
+        self._shares = [ s for s in shares if s['transport'] == 'virtiofs' ]
+        self._base_dir = base_dir
+        self._find_exe = exe_fn
+        self._processes: list[subprocess.Popen] = []
+        self._stopping = False
+
+    @property
+    def socks(self) -> list[str]:
+        return [ get_virtiofs_sock_path(self._vm_name, s['tag']) for s in self._shares ]
+
+    def run(self) -> None:
+        """
+            starts one virtiofsd per share and waits until all of them listen (QEMU fails to start otherwise)
+        """
+        if not self._shares or self._processes:
+            return
+        exe = self._find_exe()
+        if exe is None:
+            raise VirtiofsdError('virtiofsd not found. Please install the virtiofsd package or use "transport: 9p"')
+        self._stopping = False
+        for share, sock in zip(self._shares, self.socks):
+            shared_dir = os.path.abspath(os.path.join(self._base_dir, share['path']))
+            if not os.path.isdir(shared_dir):
+                raise VirtiofsdError(f'shared directory {shared_dir} does not exist')
+            if os.path.exists(sock):
+                os.remove(sock)
+            proc = subprocess.Popen([ exe ] + virtiofsd_args(share, sock, shared_dir))
+            self._processes.append(proc)
+            threading.Thread(target=self._watch, args=(proc, share['tag']), name=f'virtiofsd-{share["tag"]}', daemon=True).start()
+        for proc, share, sock in zip(self._processes, self._shares, self.socks):
+            problem = wait_for_socket(proc, sock, SOCKET_TIMEOUT)
+            if problem is not None:
+                raise VirtiofsdError(f'virtiofsd for share "{share["tag"]}" {problem}')
+
+    def _watch(self, proc: subprocess.Popen, tag: str) -> None:
+        """ virtiofsd cannot be restarted under a running guest, but its death must not go unnoticed """
+        exit_code = proc.wait()
+        if not self._stopping:
+            logging.error('virtiofsd for share "%s" exited with code %d, the share is no longer accessible in the guest', tag, exit_code)
+
+    def shutdown(self) -> None:
+        # virtiofsd normally exits on its own once QEMU disconnects
+        self._stopping = True
+        for proc in self._processes:
+            if proc.poll() is None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+        self._processes = []
+        for sock in self.socks:
+            if os.path.exists(sock):
+                os.remove(sock)